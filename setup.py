@@ -14,6 +14,11 @@ install_requires = [ 'PyYAML', 'Mako', 'rpy2',
     # http://packages.python.org/distribute/setuptools.html#declaring-dependencies
 ]
 
+extras_require = {
+    # blacktie-fastq-qc (the fastq_qc stage)
+    'qc': ['numpy'],
+}
+
 
 setup(name='blacktie',
     version=version,
@@ -31,10 +36,20 @@ setup(name='blacktie',
     package_dir = {'': 'src'},include_package_data=True,
     zip_safe=False,
     install_requires=install_requires,
+    extras_require=extras_require,
     entry_points={
         'console_scripts':
             ['blacktie=blacktie:main',
              'blacktie-encode=blacktie.scripts.encode_mail_li_file:main',
-             'blacktie-cummerbund=blacktie.scripts.cummerbund:main']
+             'blacktie-cummerbund=blacktie.scripts.cummerbund:main',
+             'blacktie-progress=blacktie.scripts.show_progress:main',
+             'blacktie-stage=blacktie.scripts.stage_inputs:main',
+             'blacktie-pack=blacktie.scripts.pack_outputs:main',
+             'blacktie-tophat-shards=blacktie.scripts.tophat_shards:main',
+             'blacktie-stream-reads=blacktie.scripts.stream_reads:main',
+             'blacktie-fastq-qc=blacktie.scripts.fastq_qc:main',
+             'blacktie-bam-stats=blacktie.scripts.bam_stats:main',
+             'blacktie-warm-index=blacktie.scripts.warm_index:main',
+             'blacktie-transcriptome-index=blacktie.scripts.transcriptome_index:main']
     }
 )
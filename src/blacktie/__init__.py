@@ -10,10 +10,16 @@ This exposes script to analyze with the pipeline.
 __version__ = '0.2.1.2'
 
 
-from blacktie.scripts.blacktie_pipeline import *
+def main():
+    """
+    Runs the ``blacktie`` script.
 
+    The pipeline (and everything it imports) is only loaded here so that
+    ``import blacktie`` stays cheap for the other scripts.
+    """
+    from blacktie.scripts.blacktie_pipeline import main as pipeline_main
+    pipeline_main()
 
-    
 
 if __name__ == "__main__":
     
@@ -0,0 +1,101 @@
+#*****************************************************************************
+#  bam_stats.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+bam_stats.py
+######################
+Script that summarizes one tophat call's alignments (flagstat-style counts,
+spliced fraction, per-reference totals) into ``<out>/bam_stats.json`` and
+fails when the library is below the given thresholds.  Run by the
+pipeline's bam_stats stage.
+"""
+import os
+import sys
+import json
+import argparse
+import time
+
+import blacktie
+from blacktie.utils.bamstats import BamStats,check_library
+from blacktie.utils.externals import mkdirp
+from blacktie.utils import errors
+
+
+def main():
+    """
+    The main loop.
+    """
+    desc = """Summarize tophat's accepted_hits.bam (and the unmapped.bam beside it) without samtools: flagstat-style
+    counts, mapping rate, spliced-read fraction and aligned bases per reference, written to <out>/bam_stats.json.
+    Exits with status 1 if the library is below any of the given minimums."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('--out', type=str, required=True,
+                        help="""Directory to write bam_stats.json into.""")
+    parser.add_argument('-p', type=int, default=4,
+                        help="""Number of threads inflating BGZF blocks. (default: %(default)s)""")
+    parser.add_argument('--unmapped', type=str, default=None,
+                        help="""BAM of the reads that did not align. (default: unmapped.bam beside accepted_hits, if present)""")
+    parser.add_argument('--min-mapped-percent', type=float, default=None,
+                        help="""Flag the library if fewer reads than this percent mapped.""")
+    parser.add_argument('--min-properly-paired-percent', type=float, default=None,
+                        help="""Flag the library if fewer paired reads than this percent are properly paired.""")
+    parser.add_argument('--min-reads', type=int, default=None,
+                        help="""Flag the library if it has fewer reads than this.""")
+    parser.add_argument('accepted_hits', type=str,
+                        help="""Path to tophat's accepted_hits.bam.""")
+
+    args = parser.parse_args()
+
+    unmapped = args.unmapped
+    if unmapped is None:
+        unmapped = '%s/unmapped.bam' % (os.path.dirname(os.path.abspath(args.accepted_hits)))
+        if not os.path.exists(unmapped):
+            unmapped = None
+
+    start = time.time()
+    try:
+        stats = BamStats(threads=args.p)
+        stats.add_bam(args.accepted_hits)
+        if unmapped is not None:
+            stats.add_bam(unmapped,unmapped_file=True)
+    except (IOError,errors.BlacktieError) as exc:
+        sys.stderr.write("Error: %s\n" % (exc))
+        exit(1)
+    result = stats.summary()
+    result['files'] = [p for p in [args.accepted_hits,unmapped] if p]
+    result['flagged'] = check_library(result,min_mapped_percent=args.min_mapped_percent,
+                                      min_properly_paired_percent=args.min_properly_paired_percent,
+                                      min_reads=args.min_reads)
+    result['elapsed'] = round(time.time() - start,2)
+
+    mkdirp(args.out)
+    out_path = '%s/bam_stats.json' % (args.out.rstrip('/'))
+    out_file = open(out_path,'w')
+    json.dump(result,out_file,indent=2,sort_keys=True)
+    out_file.close()
+
+    rates = result['rates']
+    sys.stderr.write('[blacktie-bam-stats] %s reads, %s%% mapped, %s%% of mapped spliced, %s%% properly paired\n'
+                     % (result['reads'],rates['mapped_percent'],rates['spliced_percent'],rates['properly_paired_percent']))
+    sys.stderr.write('[blacktie-bam-stats] wrote %s in %.1fs\n' % (out_path,result['elapsed']))
+    if result['flagged']:
+        sys.stderr.write('Library flagged:\n  %s\n' % ('\n  '.join(result['flagged'])))
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
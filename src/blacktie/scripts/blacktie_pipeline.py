@@ -30,21 +30,25 @@ import socket
 import shutil
 from collections import defaultdict
 
-import yaml
-
-try:
-    import pprocess
-except ImportError:
-    pass
-
 import blacktie
 
 from blacktie.utils.misc import Bunch,bunchify
+from blacktie.utils.misc import load_config,config_cache_dir
 from blacktie.utils.misc import email_notification
 from blacktie.utils.misc import get_time
 from blacktie.utils.misc import map_condition_groups
+from blacktie.utils.misc import uniques
+from blacktie.utils.samples import build_condition_queue
+from blacktie.utils.preflight import PreflightCheck,GZIP_CHECKS,STAGES
+from blacktie.utils.executors import build_executor,EXECUTORS
+from blacktie.utils.metrics import RunMetrics
+from blacktie.utils.runlog import RunLogger
+from blacktie.utils.warmup import IndexWarmer,warm_method,describe
+from blacktie.utils.references import ReferenceCache,reference_needs,check_gtf_against_genome
+from blacktie.utils.references import build_transcriptome_index
 
 from blacktie.utils.externals import runExternalApp
+from blacktie.utils.externals import resolve_tools
 from blacktie.utils.externals import mkdirp
 
 from blacktie.utils import errors
@@ -64,8 +68,9 @@ def main():
                         help="""Print version number.""")    
     parser.add_argument('config_file', type=str,
                         help="""Path to a yaml formatted config file containing setup options for the runs.""")
-    parser.add_argument('--prog', type=str, choices=['tophat','cufflinks','cuffmerge','cuffdiff','cummerbund','all'], default='tophat',
-                        help="""Which program do you want to run? (default: %(default)s)""")
+    parser.add_argument('--prog', type=str, choices=['fastq_qc','tophat','bam_stats','cufflinks','cuffmerge','cuffdiff','cummerbund','all'], default='tophat',
+                        help="""Which program do you want to run?  'all' includes fastq_qc and bam_stats only if the
+                        config file has a 'fastq_qc_options' or 'bam_stats_options' section. (default: %(default)s)""")
     parser.add_argument('--hide-logs', action='store_true', default=False,
                         help="""Make your log directories hidden to keep a tidy 'looking' base directory. (default: %(default)s)""")
     parser.add_argument('--no-email', action='store_true', default=False,
@@ -75,6 +80,29 @@ def main():
                         would be run and print out the command lines; however, do not send the commands to the
                         system to be run. 3) 'qsub_script': generate bash scripts suitable to be sent to a compute cluster's
                         SGE through the qsub command. (default: %(default)s)""")    
+    parser.add_argument('--executor', type=str, choices=EXECUTORS, default='local',
+                        help="""Where 'analyze' runs the calls: 'local' runs them on this machine, 'sge' and 'slurm'
+                        write qsub scripts, submit them all with dependencies that mirror the call graph, and follow
+                        the jobs until they finish.  With --mode qsub_script it picks the scheduler the scripts are
+                        written for. (default: %(default)s)""")
+    parser.add_argument('--submit', action='store_true', default=False,
+                        help="""With --mode qsub_script, also submit the scripts to the cluster with dependencies that
+                        mirror the call graph (each cufflinks job waits only for its own tophat job, and so on).  The
+                        scripts can be submitted later the same way with the submit_all.sh written next to them.
+                        (default: %(default)s)""")
+    parser.add_argument('--preflight', type=str, choices=GZIP_CHECKS, default='quick',
+                        help="""Before any program starts, check that every input of every call exists.  'quick' also
+                        decompresses the start of each gzipped fastq, 'full' decompresses all of it and verifies its
+                        checksum, 'off' skips the check. (default: %(default)s)""")
+    parser.add_argument('--no-config-cache', action='store_true', default=False,
+                        help="""Always parse the yaml config file instead of reusing the compiled copy kept in
+                        %s. (default: %%(default)s)""" % (config_cache_dir()))
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help="""Profile blacktie's own python work with cProfile and write a pstats file and a
+                        summary of the top functions to the run's log directory.  External programs are not
+                        profiled. (default: %(default)s)""")
+    parser.add_argument('--profile-top', type=int, default=30,
+                        help="""Number of functions to list in the --profile summary. (default: %(default)s)""")
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -82,7 +110,200 @@ def main():
 
     args = parser.parse_args()
 
-    yargs = bunchify(yaml.load(open(args.config_file,'rU')))
+    if args.submit and args.mode != 'qsub_script':
+        parser.error('--submit only works with --mode qsub_script')
+
+    if args.profile:
+        from blacktie.utils.profiling import OrchestratorProfiler
+        profiler = OrchestratorProfiler(top=args.profile_top)
+        profiler.start()
+        try:
+            run_pipeline(args,profiler=profiler)
+        finally:
+            profiler.stop()
+            profiler.dump()
+    else:
+        run_pipeline(args)
+
+
+# programs each --prog choice calls (first) or depends on (rest)
+stage_tools = {'fastq_qc':['blacktie-fastq-qc'],
+               'tophat':['tophat','bowtie2','samtools'],
+               'bam_stats':['blacktie-bam-stats'],
+               'cufflinks':['cufflinks'],
+               'cuffmerge':['cuffmerge'],
+               'cuffdiff':['cuffdiff'],
+               'cummerbund':['blacktie-cummerbund']}
+
+def report_tools(prog,mode,run_log=None,run_logger=None,required=None):
+    """
+    resolves the programs needed for ``prog`` once for the whole run and records their paths and versions.
+
+    :param prog: the ``--prog`` choice
+    :param mode: the ``--mode`` choice; in 'analyze' mode a missing program is fatal
+    :param run_log: path of the run-wide log file to record the tools in (``None`` to print them instead)
+    :param run_logger: the run's ``RunLogger``, if there is one
+    :param required: whether a missing program is fatal (default: only in 'analyze' mode)
+    """
+    if required is None:
+        required = (mode == 'analyze')
+    stages = [p for p in ['fastq_qc','tophat','bam_stats','cufflinks','cuffmerge','cuffdiff','cummerbund'] if prog in [p,'all']]
+    programs = []
+    for stage in stages:
+        programs.extend(stage_tools[stage])
+    tools = resolve_tools(programs)
+
+    lines = ['[tools %s]' % (get_time())]
+    missing = []
+    for program in programs:
+        path,version = tools[program]
+        lines.append('%s\t%s\t%s' % (program,path or 'NOT FOUND',version or 'unknown version'))
+        if path is None and program in [stage_tools[s][0] for s in stages]:
+            missing.append(program)
+        if run_logger is not None:
+            run_logger.event('tool',program=program,path=path,version=version)
+
+    if run_logger is not None:
+        run_logger.log(run_log,'\n%s\n' % ('\n'.join(lines)))
+    elif run_log is not None:
+        log = open(run_log,'a')
+        log.write('\n%s\n' % ('\n'.join(lines)))
+        log.close()
+    else:
+        print '\n'.join(lines) + '\n'
+
+    if missing and required:
+        raise errors.SystemCallError(None,'%s not found in your PATH environmental variable' % (', '.join(missing)))
+
+
+def run_preflight(yargs,args,run_log):
+    """
+    checks the inputs of every call in the run and reports all problems together.
+
+    In 'analyze' mode any problem stops the run before the first program starts.
+    """
+    preflight = PreflightCheck(yargs,args.prog,gzip_check=args.preflight)
+    problems = preflight.check()
+    report = preflight.report()
+
+    if yargs.run_logger is not None:
+        yargs.run_logger.event('preflight',inputs=len(preflight.requirements),problems=problems)
+        yargs.run_logger.log(run_log,'\n%s\n' % (report))
+
+    if problems and args.mode == 'analyze':
+        raise errors.SanityCheckError('%s\nFix these or run with --preflight off.' % (report))
+    print '%s\n' % (report)
+
+
+def prepare_references(yargs,args,run_log):
+    """
+    prepares each distinct genome and GTF the run's calls read under ``run_options.reference_dir``
+    (``.fai`` built once, GTF summarized and checked against its genome) and points the calls at them.
+    """
+    stages = [s for s in STAGES if args.prog in [s,'all']]
+    genomes,gtfs,pairs = reference_needs(yargs,stages)
+    cache = ReferenceCache(yargs.run_options.reference_dir)
+    lines = []
+    prepared = {}
+    for path in genomes:
+        genome = cache.prepare_genome(path)
+        prepared[path] = genome
+        lines.append('genome %s: %s sequences, %s bp%s'
+                     % (path,genome['sequences'],genome['length'],_prep_time(genome['seconds'])))
+    summaries = {}
+    for path in gtfs:
+        summary = cache.prepare_gtf(path)
+        summaries[path] = summary
+        lines.append('gtf %s: %s genes, %s transcripts on %s seqnames%s'
+                     % (path,summary['genes'],summary['transcripts'],len(summary['seqnames']),_prep_time(summary['seconds'])))
+    for genome_path,gtf_path in pairs:
+        if genome_path in prepared and gtf_path in summaries:
+            for problem in check_gtf_against_genome(summaries[gtf_path],cache.genome_lengths(prepared[genome_path])):
+                lines.append('WARNING %s vs %s: %s' % (gtf_path,genome_path,problem))
+                print "[Warning] %s vs %s: %s\n" % (gtf_path,genome_path,problem)
+    yargs.prepared_references = dict([(path,genome['path']) for path,genome in prepared.iteritems()])
+
+    report = '[references] %s\n  %s' % (cache.reference_dir,'\n  '.join(lines))
+    print "[Note] Prepared %s genome(s) and %s GTF(s) under %s.\n" % (len(genomes),len(gtfs),cache.reference_dir)
+    if yargs.run_logger is not None:
+        yargs.run_logger.event('references',reference_dir=cache.reference_dir,
+                               genomes=[prepared[p] for p in genomes],
+                               gtfs=[dict([(k,summaries[p][k]) for k in ['source','genes','transcripts','seconds']]) for p in gtfs])
+        yargs.run_logger.log(run_log,'\n%s\n' % (report))
+
+def _prep_time(seconds):
+    if seconds is None:
+        return ' (cached)'
+    return ' (prepared in %.1fs)' % (seconds)
+
+
+def build_transcriptome_indexes(yargs,tophat_calls,run_log):
+    """
+    builds the shared transcriptome index of each distinct GTF and bowtie2 index of ``tophat_calls``
+    that is not built yet and records how long it took.
+    """
+    built = []
+    for call in tophat_calls:
+        prefix = call.transcriptome_index
+        if not prefix or prefix in built:
+            continue
+        built.append(prefix)
+        try:
+            seconds = build_transcriptome_index(prefix,call.gtf_annotation,call.bowtie_index,threads=call.opt_dict.get('p'))
+        except (IOError,OSError,errors.BlacktieError) as exc:
+            # each call tries again and falls back to -G if it has to
+            print "[Warning] Unable to build the transcriptome index %s: %s\n" % (prefix,exc)
+            continue
+        if seconds is None:
+            print "[Note] Using the transcriptome index %s\n" % (prefix)
+            continue
+        print "[Note] Built the transcriptome index %s in %.1fs\n" % (prefix,seconds)
+        if yargs.run_logger is not None:
+            yargs.run_logger.event('transcriptome_index',prefix=prefix,gtf=call.gtf_annotation,
+                                   bowtie2_index=call.bowtie_index,seconds=seconds)
+            yargs.run_logger.log(run_log,'\n[%s] built transcriptome index %s from %s and %s in %.1fs\n'
+                                 % (get_time(),prefix,call.gtf_annotation,call.bowtie_index,seconds))
+
+
+def warm_indexes(yargs,indexes,run_log):
+    """
+    pulls each distinct bowtie2 index in ``indexes`` into this host's page cache and records how long it took.
+    """
+    warmer = IndexWarmer(method=warm_method(yargs.run_options.warm_indexes))
+    for index in uniques(indexes):
+        try:
+            result = warmer.warm_index(index)
+        except (IOError,OSError,errors.BlacktieError) as exc:
+            # tophat still finds the index where it is
+            print "[Warning] Index warm-up failed: %s\n" % (exc)
+            continue
+        print "[Note] Warmed %s\n" % (describe(result))
+        if yargs.run_logger is not None:
+            yargs.run_logger.event('index_warmup',**result)
+            yargs.run_logger.log(run_log,'\n[%s] warmed %s\n' % (get_time(),describe(result)))
+
+
+def end_stage(yargs,prog_name):
+    """
+    tells the run's ``Notifier`` (if any) and executor that every call of ``prog_name`` has been made.
+    """
+    if yargs.notifier is not None:
+        yargs.notifier.end_stage(prog_name)
+    yargs.executor.end_stage(prog_name)
+
+
+def run_pipeline(args,profiler=None):
+    """
+    Runs the pipeline steps requested in ``args``.
+
+    :param args: parsed command line arguments from ``main()``
+    :param profiler: an ``OrchestratorProfiler`` to tell where this run's logs go, if profiling
+    """
+
+    if args.no_config_cache:
+        yargs = load_config(args.config_file)
+    else:
+        yargs = load_config(args.config_file,cache_dir=config_cache_dir())
 
     # set up run_id, log files, and email info
     if yargs.run_options.run_id:
@@ -91,6 +312,17 @@ def main():
 
         run_id = get_time()
 
+    # the QC stages are opt-in: 'all' only runs them for configs that set them up
+    run_fastq_qc = (args.prog == 'fastq_qc') or (args.prog == 'all' and bool(yargs.get('fastq_qc_options')))
+    if run_fastq_qc and not yargs.get('fastq_qc_options'):
+        raise errors.MissingArgumentError('--prog fastq_qc needs a "fastq_qc_options" section in %s.' % (args.config_file))
+    run_bam_stats = (args.prog == 'bam_stats') or (args.prog == 'all' and bool(yargs.get('bam_stats_options')))
+    if run_bam_stats and not yargs.get('bam_stats_options'):
+        raise errors.MissingArgumentError('--prog bam_stats needs a "bam_stats_options" section in %s.' % (args.config_file))
+
+    if yargs.run_options.get('transcriptome_index') and not yargs.run_options.get('reference_dir'):
+        raise errors.MissingArgumentError('run_options.transcriptome_index needs run_options.reference_dir to keep the indexes in.')
+
     base_dir = yargs.run_options.base_dir.rstrip('/')
     if args.hide_logs:
         run_logs  = '%s/.%s.logs' % (base_dir,run_id)
@@ -105,12 +337,19 @@ def main():
 
 
     yaml_out = '%s/%s.yaml' % (run_logs,run_id)
+    run_log = '%s/%s.log' % (run_logs,run_id)
+
+    if profiler is not None:
+        profiler.set_destination(run_logs,run_id)
 
 
 
-    # copy yaml config file with run_id as name for records
+    # copy yaml config file (and sample sheet) with run_id as name for records
+    sample_sheet = yargs.run_options.get('sample_sheet')
     if not args.mode == 'dry_run':
         shutil.copyfile(args.config_file,yaml_out)
+        if sample_sheet:
+            shutil.copyfile(sample_sheet,'%s/%s.samples%s' % (run_logs,run_id,os.path.splitext(sample_sheet)[1]))
     else:
         pass
 
@@ -123,33 +362,152 @@ def main():
                             'email_to' : False,
                             'email_li' : ''})
 
+    # one writer for all log files and the JSON-lines event log
+    if args.mode == 'analyze':
+        yargs.run_logger = RunLogger('%s/%s.events.jsonl' % (run_logs,run_id))
+        yargs.run_logger.event('run_start',run_id=run_id,prog=args.prog,config_file=os.path.abspath(args.config_file))
+    else:
+        yargs.run_logger = None
+
+    # queue notifications and send them from one thread over one SMTP connection
+    if args.mode == 'analyze' and email_info.email_from:
+        from blacktie.utils.notify import Notifier
+        e = yargs.run_options.email_info
+        yargs.notifier = Notifier(email_info.email_from,email_info.email_to,
+                                  base64.b64decode(email_info.email_li),
+                                  yargs.run_options.custom_smtp,
+                                  digest=e.get('digest') or None,
+                                  digest_interval=e.get('digest_interval') or 3600,
+                                  digest_title='[SITREP from %s] Run %s' % (socket.gethostname(),run_id))
+    else:
+        yargs.notifier = None
+
+    # look up the programs once; calls reuse the cached paths
+    if args.mode == 'analyze':
+        # cluster jobs find their programs on the compute nodes
+        report_tools(args.prog,args.mode,run_log=run_log,run_logger=yargs.run_logger,
+                     required=(args.executor == 'local'))
+    elif args.mode == 'dry_run':
+        report_tools(args.prog,args.mode)
+
     yargs.prgbar_regex = re.compile('>.+Processing.+\[.+\].+%\w*$')
+    yargs.condition_queue = build_condition_queue(yargs)
     yargs.groups = map_condition_groups(yargs)
     yargs.call_records = {}
 
+    # run calls here, print them, write their qsub scripts or submit them to a cluster
+    yargs.executor = build_executor(yargs,args.mode,args.executor,run_id,run_logs,submit=args.submit)
+    yargs.qsub_writer = getattr(yargs.executor,'writer',None)
+
+    # find every missing or broken input now instead of hours into the run
+    if args.preflight != 'off' and args.mode in ['analyze','dry_run']:
+        run_preflight(yargs,args,run_log)
+
+    # build each distinct genome's .fai and summarize each GTF once, before any call races to do it
+    yargs.prepared_references = {}
+    if yargs.run_options.get('reference_dir') and args.mode in ['analyze','qsub_script']:
+        try:
+            prepare_references(yargs,args,run_log)
+        except (IOError,OSError) as exc:
+            raise errors.SanityCheckError('Unable to prepare the references under %s: %s' % (yargs.run_options.reference_dir,exc))
+
+    # record call states for metrics export and blacktie-progress
+    if args.mode == 'analyze':
+        yargs.run_metrics = RunMetrics.from_yargs(yargs,run_logs)
+    else:
+        yargs.run_metrics = None
+
+    if yargs.run_metrics is not None:
+        if run_fastq_qc:
+            yargs.run_metrics.plan('blacktie-fastq-qc',len(yargs.condition_queue))
+        if run_bam_stats:
+            yargs.run_metrics.plan('blacktie-bam-stats',len(yargs.condition_queue))
+        stage_sizes = [('tophat',len(yargs.condition_queue)),
+                       ('cufflinks',len(yargs.condition_queue)),
+                       ('cuffmerge',len(yargs.groups)),
+                       ('cuffdiff',len(yargs.groups)),
+                       ('blacktie-cummerbund',len(yargs.groups))]
+        for prog_name,count in stage_sizes:
+            if args.prog in [prog_name.replace('blacktie-',''),'all']:
+                yargs.run_metrics.plan(prog_name,count)
+        yargs.run_metrics.start()
+
+    # summarize each condition's reads before any of them are aligned
+    if run_fastq_qc:
+        print '[Note] Starting fastq_qc step.\n'
+        for condition in yargs.condition_queue:
+            qc_call = FastqQCCall(yargs,email_info,run_id,run_logs,conditions=condition,mode=args.mode)
+            qc_call.execute()
+            yargs.call_records[qc_call.call_id] = qc_call
+        end_stage(yargs,'blacktie-fastq-qc')
+    elif args.prog == 'all':
+        print "[Note] Skipping fastq_qc step.\n"
+
     # loop through the queued conditions and send reports for tophat 
     if args.prog in ['tophat','all']:
         print '[Note] Starting tophat step.\n'
-        for condition in yargs.condition_queue:
+        tophat_calls = [TophatCall(yargs,email_info,run_id,run_logs,conditions=condition,mode=args.mode)
+                        for condition in yargs.condition_queue]
 
-            # Prep Tophat Call
-            tophat_call = TophatCall(yargs,email_info,run_id,run_logs,conditions=condition,mode=args.mode)
+        # read each distinct index once so the alignments start from a warm page cache
+        if yargs.executor.name == 'local' and warm_method(yargs.run_options.get('warm_indexes')):
+            warm_indexes(yargs,[c.bowtie_index for c in tophat_calls],run_log)
+
+        # build each distinct (GTF, bowtie2 index) transcriptome index once instead of once per call
+        if yargs.executor.name == 'local':
+            build_transcriptome_indexes(yargs,tophat_calls,run_log)
+
+        for tophat_call in tophat_calls:
             tophat_call.execute()
 
             # record the tophat_call object
             yargs.call_records[tophat_call.call_id] = tophat_call
+        end_stage(yargs,'tophat')
     else:
         print "[Note] Skipping tophat step.\n"
 
+    # summarize each condition's alignments and flag bad libraries before cufflinks starts
+    if run_bam_stats:
+        print '[Note] Starting bam_stats step.\n'
+        flagged = []
+        for condition in yargs.condition_queue:
+            bam_stats_call = BamStatsCall(yargs,email_info,run_id,run_logs,conditions=condition,mode=args.mode)
+            bam_stats_call.execute()
+            yargs.call_records[bam_stats_call.call_id] = bam_stats_call
+            # on a cluster the calls are only submitted at the end: the cufflinks/cuffdiff jobs of a
+            # flagged library are held on its failed bam_stats job and cancelled instead
+            if yargs.executor.name == 'local' and bam_stats_call.returncode != 0:
+                flagged.append((bam_stats_call.call_id,condition))
+        end_stage(yargs,'blacktie-bam-stats')
+        if flagged:
+            print "[Warning] bam_stats flagged (or could not read) these libraries; see bam_stats.json in their FAILED.* directories:\n  %s\n" \
+                % ('\n  '.join([call_id for call_id,condition in flagged]))
+            # leave the flagged libraries out of cufflinks, cuffmerge and cuffdiff
+            yargs.condition_queue = [c for c in yargs.condition_queue if c not in [f[1] for f in flagged]]
+            yargs.groups = map_condition_groups(yargs)
+            if yargs.run_metrics is not None and args.prog == 'all':
+                for prog_name,count in [('cufflinks',len(yargs.condition_queue)),('cuffmerge',len(yargs.groups)),
+                                        ('cuffdiff',len(yargs.groups)),('blacktie-cummerbund',len(yargs.groups))]:
+                    yargs.run_metrics.plan(prog_name,count)
+            print "[Note] Continuing without them.\n"
+    elif args.prog == 'all':
+        print "[Note] Skipping bam_stats step.\n"
+
     if args.prog in ['cufflinks','all']:
         # attempt to run more than one cufflinks call in parallel since cufflinks
         # seems to use only one processor no matter the value of -p you give it and
         # doesn't seem to consume massive amounts of memory 
         print "[Note] Starting cufflinks step.\n"
         try:
-            if args.mode == 'dry_run':
-                raise errors.BlacktieError("dry run")
-            
+            # only calls run on this machine need parallel workers
+            if yargs.executor.name != 'local':
+                raise errors.BlacktieError("not analyze")
+
+            try:
+                import pprocess
+            except ImportError:
+                raise errors.BlacktieError('no pprocess')
+
             #TODO: on mac pprocess raised AttributeError "module" has no attrb "poll" or some crap
             try:
                 queue = pprocess.Queue(limit=yargs.cufflinks_options.p)
@@ -174,7 +532,7 @@ def main():
                 cufflinks_call.opt_dict['p'] = 2
                 cufflinks_call.construct_options_list()
                 cufflinks_call.options_list.extend([cufflinks_call.accepted_hits])
-                cufflinks_call.arg_str = ' '.join(cufflinks_call.options_list)
+                cufflinks_call.set_arg_list(cufflinks_call.options_list)
                 return cufflinks_call
 
             execute = queue.manage(pprocess.MakeParallel(run_cufflinks_call))
@@ -189,9 +547,9 @@ def main():
             for call in queue:
                 yargs.call_records[call.call_id] = call
 
-        except (NameError, errors.BlacktieError) as exc:
+        except errors.BlacktieError as exc:
 
-            if ("'pprocess' is not defined" in str(exc)) or (str(exc) == "dry run") or (str(exc) == 'no poll'):
+            if str(exc) in ['no pprocess','not analyze','no poll']:
                 pass
             else:
                 raise
@@ -205,6 +563,7 @@ def main():
 
                 # record the cufflinks_call object
                 yargs.call_records[cufflinks_call.call_id] = cufflinks_call
+        end_stage(yargs,'cufflinks')
     else:
         print "[Note] Skipping cufflinks step.\n"
 
@@ -220,6 +579,7 @@ def main():
 
             # record the cuffmerge_call object
             yargs.call_records[cuffmerge_call.call_id] = cuffmerge_call
+        end_stage(yargs,'cuffmerge')
 
     else:
         print "[Note] Skipping cuffmerge step.\n"
@@ -235,6 +595,7 @@ def main():
 
             # record the cuffdiff_call object
             yargs.call_records[cuffdiff_call.call_id] = cuffdiff_call
+        end_stage(yargs,'cuffdiff')
 
     else:
         print "[Note] Skipping cuffdiff step.\n"    
@@ -255,10 +616,24 @@ def main():
 
             # record the cummerbund_call object
             yargs.call_records[cummerbund_call.call_id] = cummerbund_call
+        end_stage(yargs,'blacktie-cummerbund')
 
     else:
         print "[Note] Skipping cummerbund step.\n"
 
+    # cluster runs wait here for their jobs
+    yargs.executor.close()
+
+    if yargs.run_metrics is not None:
+        yargs.run_metrics.stop()
+
+    if yargs.notifier is not None:
+        yargs.notifier.close()
+
+    if yargs.run_logger is not None:
+        yargs.run_logger.event('run_end',run_id=run_id)
+        yargs.run_logger.close()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
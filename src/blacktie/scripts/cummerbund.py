@@ -28,21 +28,34 @@ import os
 import sys
 import argparse
 
-try:
-    from rpy2.robjects import r
-    from rpy2.rinterface import RRuntimeError
-except ImportError as ie:
-    raise errors.BlacktieError('Unable to import required module: "rpy2".  Try installing it with "[sudo] pip install rpy2".')
-except RuntimeError as rte:
-    raise errors.BlacktieError('Importing required module "rpy2" failed because no R application could be found on your system. Try again after instaling R.')
-
-
 import blacktie
 from blacktie.utils import errors
 from blacktie.utils.misc import Bunch
 from blacktie.utils.externals import mkdirp
 from blacktie.utils.externals import runExternalApp
 
+# set by load_r(): importing rpy2 starts an embedded R, so wait until R is needed
+r = None
+RRuntimeError = None
+
+def load_r():
+    """
+    imports rpy2 (starting the embedded R) the first time it is called.
+
+    :returns: pointer to the R instance
+    """
+    global r,RRuntimeError
+    if r is None:
+        try:
+            from rpy2.robjects import r as rpy2_r
+            from rpy2.rinterface import RRuntimeError as rpy2_RRuntimeError
+        except ImportError as ie:
+            raise errors.BlacktieError('Unable to import required module: "rpy2".  Try installing it with "[sudo] pip install rpy2".')
+        except RuntimeError as rte:
+            raise errors.BlacktieError('Importing required module "rpy2" failed because no R application could be found on your system. Try again after instaling R.')
+        r,RRuntimeError = rpy2_r,rpy2_RRuntimeError
+    return r
+
 def print_my_plots(r, rplots, out='', file_type='pdf'):
     """
     saves our plots to files named with the plotting method used.
@@ -64,6 +77,7 @@ def run_cummeRbund_install():
     """
     provides R install of cummeRbund and provides user with all R output and prompts.
     """
+    load_r()
     r.source("http://bioconductor.org/biocLite.R")
     r.biocLite('cummeRbund')
     
@@ -72,6 +86,7 @@ def import_cummeRbund_library():
     """
     imports cummeRbund library [r.library('cummeRbund')] or asks to install it otherwise.
     """
+    load_r()
     try:
         r.library('cummeRbund')
     
@@ -0,0 +1,89 @@
+#*****************************************************************************
+#  fastq_qc.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+fastq_qc.py
+######################
+Script that summarizes one condition's left/right fastqs (read counts,
+length distribution, per-position mean quality, GC content, mate agreement)
+into ``<out>/fastq_qc.json``.  Run by the pipeline's fastq_qc stage.
+"""
+import sys
+import json
+import argparse
+import time
+
+import blacktie
+from blacktie.utils.readqc import FastqQC,CHUNK_SIZE
+from blacktie.utils.externals import mkdirp
+from blacktie.utils import errors
+
+
+def main():
+    """
+    The main loop.
+    """
+    desc = """Summarize a condition's fastqs (gzipped or not) before alignment: read counts, length distribution,
+    per-position mean quality, GC content and left/right agreement, written to <out>/fastq_qc.json.  Problems
+    (including -r/--mate-std-dev values that do not fit the reads) are listed under "warnings"."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('--out', type=str, required=True,
+                        help="""Directory to write fastq_qc.json into.""")
+    parser.add_argument('-p', type=int, default=4,
+                        help="""Number of files scanned at once. (default: %(default)s)""")
+    parser.add_argument('--chunk-mb', type=int, default=CHUNK_SIZE / (1024 * 1024),
+                        help="""MB of each file read and scanned at a time. (default: %(default)s)""")
+    parser.add_argument('--mate-inner-dist', type=float, default=None,
+                        help="""Tophat's -r for this condition, checked against the read lengths seen.""")
+    parser.add_argument('--mate-std-dev', type=float, default=None,
+                        help="""Tophat's --mate-std-dev for this condition, checked against the read lengths seen.""")
+    parser.add_argument('left_reads', type=str,
+                        help="""Comma separated left-mate (or single-end) fastqs.""")
+    parser.add_argument('right_reads', type=str, nargs='?', default='',
+                        help="""Comma separated right-mate fastqs in the same order.""")
+
+    args = parser.parse_args()
+
+    start = time.time()
+    try:
+        qc = FastqQC([p for p in args.left_reads.split(',') if p],
+                     [p for p in args.right_reads.split(',') if p],
+                     threads=args.p,chunk_size=args.chunk_mb * 1024 * 1024)
+        result = qc.run(mate_inner_dist=args.mate_inner_dist,mate_std_dev=args.mate_std_dev)
+    except (IOError,errors.BlacktieError) as exc:
+        sys.stderr.write("Error: %s\n" % (exc))
+        exit(1)
+    result['elapsed'] = round(time.time() - start,2)
+
+    mkdirp(args.out)
+    out_path = '%s/fastq_qc.json' % (args.out.rstrip('/'))
+    out_file = open(out_path,'w')
+    json.dump(result,out_file,indent=2,sort_keys=True)
+    out_file.close()
+
+    for side in ['left','right']:
+        if side in result:
+            s = result[side]
+            sys.stderr.write('[blacktie-fastq-qc] %s: %s reads, length %s-%s (mean %s), GC %s%%\n'
+                             % (side,s['reads'],s['length']['min'],s['length']['max'],s['length']['mean'],s['gc_percent']))
+    for warning in result['warnings']:
+        sys.stderr.write('Warning: %s\n' % (warning))
+    sys.stderr.write('[blacktie-fastq-qc] wrote %s in %.1fs\n' % (out_path,result['elapsed']))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#*****************************************************************************
+#  pack_outputs.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+pack_outputs.py
+######################
+Script to pack a call's output directory into a ``.tar.gz`` with parallel
+compression, storing files that are already compressed as they are.  Used
+by the qsub template in place of ``tar -zcvf``.
+"""
+import sys
+import argparse
+import time
+
+import blacktie
+from blacktie.utils.packing import ParallelPacker,BLOCK_SIZE
+
+
+def main():
+    """
+    The main loop.
+    """
+    desc = """Pack a directory into a .tar.gz (readable by tar -xzf) using several threads.  Text outputs are
+    compressed in parallel blocks; BAMs and other already-compressed files are stored without recompression."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('src_dir', type=str,
+                        help="""Directory to pack.""")
+    parser.add_argument('dest', type=str,
+                        help="""Path of the archive to write ('-' for stdout).""")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="""Number of blocks compressed at once. (default: the number of cpus)""")
+    parser.add_argument('--level', type=int, choices=range(1,10), default=6,
+                        help="""Compression level for text outputs. (default: %(default)s)""")
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE / (1024 * 1024),
+                        help="""MB of the archive compressed as one block. (default: %(default)s)""")
+
+    args = parser.parse_args()
+
+    start = time.time()
+    packer = ParallelPacker(threads=args.threads,level=args.level,block_size=args.block_size * 1024 * 1024)
+    stats = packer.pack(args.src_dir,args.dest)
+    sys.stderr.write('[blacktie-pack] %s files (%s bytes, %s stored as already compressed) packed into %s in %.1fs\n'
+                     % (stats['files'],stats['bytes'],stats['stored_bytes'],args.dest,time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#*****************************************************************************
+#  show_progress.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+show_progress.py
+######################
+Script to report percent-complete and ETA of the calls in a running (or finished) blacktie run.
+"""
+import os
+import sys
+import glob
+import argparse
+import time
+
+import blacktie
+from blacktie.utils.metrics import RunMetrics
+from blacktie.utils.readqc import load_fastq_qc
+from blacktie.utils.bamstats import load_bam_stats
+
+
+def format_seconds(seconds):
+    """
+    formats ``seconds`` as 'hh:mm:ss' or '-' if it is unknown.
+    """
+    if seconds is None:
+        return '-'
+    seconds = int(seconds)
+    return '%02d:%02d:%02d' % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+def print_report(run_metrics,out=sys.stdout):
+    """
+    writes a table of per-call progress followed by per-tool counts and overall progress.
+
+    :param run_metrics: ``RunMetrics`` object pointed at the run's metrics directory
+    :param out: file-like object to write the report to
+    """
+    snap = run_metrics.snapshot()
+    now = time.time()
+
+    out.write('%-50s %-8s %7s %9s %9s  %s\n' % ('call_id','state','percent','elapsed','eta','step'))
+    for rec in sorted(snap.records,key=lambda r: (r['start'] or now, r['call_id'])):
+        if rec['start']:
+            elapsed = (rec['end'] or now) - rec['start']
+        else:
+            elapsed = None
+        if rec.get('percent') is None:
+            percent = '-'
+        else:
+            percent = '%.1f%%' % (rec['percent'])
+        if rec['state'] == 'running':
+            eta = rec.get('eta')
+        else:
+            eta = None
+        out.write('%-50s %-8s %7s %9s %9s  %s\n' % (rec['call_id'],rec['state'],percent,
+                                                    format_seconds(elapsed),format_seconds(eta),
+                                                    rec.get('step') or ''))
+
+    out.write('\n')
+    for tool in sorted(snap.counts):
+        c = snap.counts[tool]
+        out.write('%-20s queued: %-5s running: %-5s done: %-5s failed: %-5s\n' % (tool,c['queued'],c['running'],c['done'],c['failed']))
+    out.write('\nRun progress: %.1f%%\n' % (snap.run_progress * 100))
+
+def print_fastq_qc(base_dir,out=sys.stdout):
+    """
+    writes one line per condition summarized by the fastq_qc stage in ``base_dir`` (nothing if there are none).
+    """
+    out_dirs = sorted(glob.glob('%s/blacktie-fastq-qc_*' % (base_dir.rstrip('/'))))
+    results = [(os.path.basename(d).replace('blacktie-fastq-qc_',''),load_fastq_qc(d)) for d in out_dirs]
+    results = [(name,qc) for name,qc in results if qc is not None]
+    if not results:
+        return
+    out.write('\n%-40s %12s %12s %9s %6s  %s\n' % ('condition','left_reads','right_reads','length','gc','warnings'))
+    for name,qc in results:
+        left = qc.get('left') or {}
+        right = qc.get('right') or {}
+        length = left.get('length',{}).get('mean','-')
+        out.write('%-40s %12s %12s %9s %6s  %s\n' % (name,left.get('reads','-'),right.get('reads','-'),length,
+                                                      left.get('gc_percent','-'),len(qc.get('warnings',[]))))
+
+def print_bam_stats(base_dir,out=sys.stdout):
+    """
+    writes one line per library summarized by the bam_stats stage in ``base_dir`` (nothing if there are none).
+    """
+    out_dirs = sorted(glob.glob('%s/blacktie-bam-stats_*' % (base_dir.rstrip('/'))) +
+                      glob.glob('%s/FAILED.blacktie-bam-stats_*' % (base_dir.rstrip('/'))))
+    results = [(os.path.basename(d).replace('blacktie-bam-stats_',''),load_bam_stats(d)) for d in out_dirs]
+    results = [(name,stats) for name,stats in results if stats is not None]
+    if not results:
+        return
+    out.write('\n%-40s %12s %8s %8s %8s  %s\n' % ('library','reads','mapped','spliced','paired','flagged'))
+    for name,stats in results:
+        rates = stats['rates']
+        paired = rates['properly_paired_percent']
+        out.write('%-40s %12s %7s%% %7s%% %8s  %s\n' % (name,stats['reads'],rates['mapped_percent'],rates['spliced_percent'],
+                                                       '-' if paired is None else '%s%%' % (paired),
+                                                       '; '.join(stats['flagged']) or '-'))
+
+
+def main():
+    """
+    The main loop.  Lets ROCK!
+    """
+
+    desc = """This script reads the call states recorded in a blacktie run's log directory and reports the percent-complete and ETA of each call along with overall run progress."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('run_logs', type=str,
+                        help="""Path to the run's log directory (<base_dir>/<run_id>.logs).""")
+    parser.add_argument('--watch', type=int, default=0,
+                        help="""Re-print the report every WATCH seconds until interrupted. (default: %(default)s)""")
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        exit(0)
+
+    args = parser.parse_args()
+
+    state_dir = '%s/metrics' % (args.run_logs.rstrip('/'))
+    if not os.path.isdir(state_dir):
+        sys.stderr.write('No call states found in %s. Was the run started with --mode analyze?\n' % (state_dir))
+        exit(1)
+
+    run_metrics = RunMetrics(state_dir)
+    print_report(run_metrics)
+    base_dir = os.path.dirname(os.path.abspath(args.run_logs.rstrip('/')))
+    print_fastq_qc(base_dir)
+    print_bam_stats(base_dir)
+    while args.watch:
+        time.sleep(args.watch)
+        print ''
+        print_report(run_metrics)
+
+
+if __name__ == "__main__":
+    main()
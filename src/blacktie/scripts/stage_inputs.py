@@ -0,0 +1,88 @@
+#*****************************************************************************
+#  stage_inputs.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+stage_inputs.py
+######################
+Script that copies a call's inputs to node-local scratch, runs the call's
+program on the copies and cleans up afterwards.  Used by qsub scripts when
+``qsub_options.staging`` is set.
+"""
+import sys
+import argparse
+import subprocess
+
+import blacktie
+from blacktie.utils.staging import InputStager,VERIFY_CHOICES
+from blacktie.utils import errors
+
+
+def main():
+    """
+    The main loop.
+    """
+    desc = """Copy a call's inputs to node-local scratch, run the program given after '--' with the
+    staged paths in place of the originals, then remove the copies.  Exits with the program's exit status."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('--scratch', type=str, required=True,
+                        help="""Node-local directory to stage into; environment variables are expanded.""")
+    parser.add_argument('--input', type=str, action='append', default=[],
+                        help="""A file only this call reads (reads, BAMs).  May be given more than once.""")
+    parser.add_argument('--reference', type=str, action='append', default=[],
+                        help="""A reference file other calls on the node may share (GTF, genome FASTA).
+                        May be given more than once.""")
+    parser.add_argument('--index', type=str, action='append', default=[],
+                        help="""A bowtie2 index prefix other calls on the node may share.  May be given more than once.""")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="""Number of files copied at once. (default: %(default)s)""")
+    parser.add_argument('--verify', type=str, choices=VERIFY_CHOICES, default='size',
+                        help="""How copies are checked against their sources. (default: %(default)s)""")
+    parser.add_argument('--keep-references', action='store_true', default=False,
+                        help="""Leave staged references on the node for later calls. (default: %(default)s)""")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="""The program and its arguments, after '--'.""")
+
+    args = parser.parse_args()
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+    if not command:
+        parser.error('no program given to run after --')
+
+    stager = InputStager(args.scratch,threads=args.threads,verify=args.verify,keep_references=args.keep_references)
+    try:
+        try:
+            stager.stage(call_inputs=args.input,references=args.reference,indexes=args.index)
+            command = stager.rewrite(command)
+        except (IOError,OSError,errors.BlacktieError) as exc:
+            # the shared filesystem still has everything; a slow call beats a failed one
+            sys.stderr.write("Warning: staging failed, reading inputs from where they are: %s\n" % (exc))
+            stager.cleanup()
+        sys.stderr.write("[blacktie-stage] %s\n" % (' '.join(command)))
+        sys.stderr.flush()
+        try:
+            returncode = subprocess.call(command)
+        except OSError as exc:
+            sys.stderr.write("Error: unable to run %s: %s\n" % (command[0],exc))
+            returncode = 127
+    finally:
+        stager.cleanup()
+    exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
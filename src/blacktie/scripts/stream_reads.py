@@ -0,0 +1,63 @@
+#*****************************************************************************
+#  stream_reads.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+stream_reads.py
+######################
+Script that runs a tophat call with its compressed read lists replaced by
+named pipes fed by parallel decompressors.  Used by tophat calls when
+``run_options.stream_reads`` is set.
+"""
+import sys
+import argparse
+
+import blacktie
+from blacktie.utils.streaming import ReadStreamer
+from blacktie.utils import errors
+
+
+def main():
+    """
+    The main loop.
+    """
+    desc = """Run the tophat call given after '--' with its left and right read lists (the last two arguments)
+    replaced by named pipes.  Each list is decompressed (pigz/gzip, pbzip2/bzip2) and concatenated on the fly by
+    its own processes; nothing is written to disk.  Exits with tophat's exit status."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('--fifo-dir', type=str, default=None,
+                        help="""Directory to make the named pipes in. (default: $TMPDIR or /tmp)""")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="""The tophat call, after '--'.""")
+
+    args = parser.parse_args()
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+    if len(command) < 4:
+        parser.error('expected "-- tophat [options] <bowtie2_index> <left_reads> <right_reads>"')
+
+    try:
+        streamer = ReadStreamer(command,[len(command) - 2,len(command) - 1],fifo_dir=args.fifo_dir)
+        returncode = streamer.run()
+    except (OSError,errors.BlacktieError) as exc:
+        sys.stderr.write("Error: %s\n" % (exc))
+        returncode = 1
+    exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
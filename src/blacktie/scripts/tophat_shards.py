@@ -0,0 +1,66 @@
+#*****************************************************************************
+#  tophat_shards.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+tophat_shards.py
+######################
+Script that runs one tophat call as several tophat processes over shards of
+its reads and merges the shard alignments into the call's
+``accepted_hits.bam``.  Used by tophat calls when
+``run_options.tophat_shards`` is more than 1.
+"""
+import sys
+import argparse
+
+import blacktie
+from blacktie.utils.sharding import ShardedTophat
+from blacktie.utils import errors
+
+
+def main():
+    """
+    The main loop.
+    """
+    desc = """Split the reads of the tophat call given after '--' into shards (keeping mates together), run tophat
+    on every shard at once and merge the shard BAMs into <out_dir>/accepted_hits.bam.  Exits with 0 only if every
+    shard aligned."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('--shards', type=int, required=True,
+                        help="""Number of shards (and tophat processes); the call's -p cores are divided between them.""")
+    parser.add_argument('--keep-shards', action='store_true', default=False,
+                        help="""Keep the shard fastqs and BAMs under <out_dir>/shards. (default: %(default)s)""")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="""The tophat call, after '--'.""")
+
+    args = parser.parse_args()
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+    if len(command) < 4:
+        parser.error('expected "-- tophat [options] <bowtie2_index> <left_reads> <right_reads>"')
+
+    try:
+        sharded = ShardedTophat(command[1:],args.shards,keep_shards=args.keep_shards,program=command[0])
+        returncode = sharded.run()
+    except errors.BlacktieError as exc:
+        sys.stderr.write("Error: %s\n" % (exc))
+        returncode = 1
+    exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
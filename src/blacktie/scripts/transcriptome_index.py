@@ -0,0 +1,89 @@
+#*****************************************************************************
+#  transcriptome_index.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+transcriptome_index.py
+######################
+Script that makes sure a shared tophat transcriptome index is built (building
+it, or waiting for the process that is) and then runs the tophat call given
+after ``--``.  Used by tophat calls when ``run_options.transcriptome_index``
+is set and the index is not built yet.
+"""
+import sys
+import argparse
+import subprocess
+
+import blacktie
+from blacktie.utils.references import build_transcriptome_index,use_gtf
+from blacktie.utils import errors
+
+
+def main():
+    """
+    The main loop.
+    """
+    desc = """Build the tophat transcriptome index PREFIX from a GTF and a bowtie2 index unless it is built already
+    (calls needing the same index wait for the first one to build it), then run the program given after '--', if
+    any, and exit with its status.  If the index cannot be built, the program is run with '-G <gtf>' in place of
+    '--transcriptome-index PREFIX'."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('--gtf', type=str, required=True,
+                        help="""The annotation the index is built from.""")
+    parser.add_argument('--bowtie-index', type=str, required=True,
+                        help="""The bowtie2 index prefix the index is built against.""")
+    parser.add_argument('--transcriptome-index', type=str, required=True,
+                        help="""Prefix of the transcriptome index to build.""")
+    parser.add_argument('-p', type=int, default=None,
+                        help="""Number of threads tophat may use to build the index.""")
+    parser.add_argument('--tophat', type=str, default='tophat',
+                        help="""The tophat program. (default: %(default)s)""")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="""The tophat call, after '--'.""")
+
+    args = parser.parse_args()
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+
+    try:
+        seconds = build_transcriptome_index(args.transcriptome_index,args.gtf,args.bowtie_index,
+                                            tophat=args.tophat,threads=args.p)
+        if seconds is None:
+            sys.stderr.write("[blacktie-transcriptome-index] using %s\n" % (args.transcriptome_index))
+        else:
+            sys.stderr.write("[blacktie-transcriptome-index] built %s in %.1fs\n" % (args.transcriptome_index,seconds))
+    except (IOError,OSError,errors.BlacktieError) as exc:
+        if not command:
+            sys.stderr.write("Error: %s\n" % (exc))
+            exit(1)
+        # tophat can still build its own copy from the GTF
+        sys.stderr.write("Warning: unable to build %s, passing -G %s instead: %s\n" % (args.transcriptome_index,args.gtf,exc))
+        command = use_gtf(command,args.transcriptome_index,args.gtf)
+    sys.stderr.flush()
+
+    if not command:
+        exit(0)
+    try:
+        returncode = subprocess.call(command)
+    except OSError as exc:
+        sys.stderr.write("Error: unable to run %s: %s\n" % (command[0],exc))
+        returncode = 127
+    exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#*****************************************************************************
+#  warm_index.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licenced under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+######################
+warm_index.py
+######################
+Script that pulls bowtie2 indexes into the page cache and then (optionally)
+runs the tophat call given after ``--``.  Used by cluster tophat jobs when
+``run_options.warm_indexes`` is set.
+"""
+import sys
+import argparse
+import subprocess
+
+import blacktie
+from blacktie.utils.warmup import IndexWarmer,METHODS,default_lock_dir,describe
+from blacktie.utils import errors
+
+
+def main():
+    """
+    The main loop.
+    """
+    desc = """Read each bowtie2 index (all of its <prefix>.* files) into the page cache, then run the program given
+    after '--', if any, and exit with its status.  Jobs warming the same index on one node take turns, so the
+    index is read from the shared filesystem once.  A failed warm-up is only a warning."""
+
+    parser = argparse.ArgumentParser(description=desc)
+
+    parser.add_argument('--version', action='version', version='%(prog)s ' + blacktie.__version__,
+                        help="""Print version number.""")
+    parser.add_argument('--index', type=str, action='append', default=[], required=True,
+                        help="""A bowtie2 index prefix.  May be given more than once.""")
+    parser.add_argument('--method', type=str, choices=METHODS, default='read',
+                        help="""'read' reads the files through; 'advise' asks the kernel to read them ahead and
+                        returns at once. (default: %(default)s)""")
+    parser.add_argument('-p', type=int, default=4,
+                        help="""Number of files read at once. (default: %(default)s)""")
+    parser.add_argument('--lock-dir', type=str, default=default_lock_dir(),
+                        help="""Node-local directory for the per-index locks. (default: %(default)s)""")
+    parser.add_argument('command', nargs=argparse.REMAINDER,
+                        help="""The program and its arguments, after '--'.""")
+
+    args = parser.parse_args()
+    command = args.command
+    if command and command[0] == '--':
+        command = command[1:]
+
+    try:
+        warmer = IndexWarmer(method=args.method,threads=args.p,lock_dir=args.lock_dir)
+        for result in warmer.warm(args.index):
+            sys.stderr.write("[blacktie-warm-index] %s\n" % (describe(result)))
+    except (IOError,OSError,errors.BlacktieError) as exc:
+        if not command:
+            sys.stderr.write("Error: %s\n" % (exc))
+            exit(1)
+        # the call still finds its index on the shared filesystem
+        sys.stderr.write("Warning: index warm-up failed: %s\n" % (exc))
+    sys.stderr.flush()
+
+    if not command:
+        exit(0)
+    try:
+        returncode = subprocess.call(command)
+    except OSError as exc:
+        sys.stderr.write("Error: unable to run %s: %s\n" % (command[0],exc))
+        returncode = 127
+    exit(returncode)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,359 @@
+#*****************************************************************************
+#  bamstats.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+bamstats.py
+####################
+Code to summarize tophat's alignments without samtools.
+
+``BgzfReader`` splits a BAM into its BGZF blocks (each names its own
+compressed size) and inflates batches of blocks from a pool of threads
+(zlib releases the GIL while it works), handing back the uncompressed
+stream in order.  ``BamStats`` walks the records of that stream and keeps
+flagstat-style counts, the fraction of reads tophat spliced (``N`` in the
+CIGAR) and the aligned bases and reads of every reference sequence.
+
+Tophat leaves the reads it could not align in ``unmapped.bam`` next to
+``accepted_hits.bam``; both are read so the mapping rate is real.
+"""
+import os
+import json
+import struct
+import zlib
+
+from blacktie.utils import errors
+
+
+BGZF_MAGIC = '\x1f\x8b\x08\x04'
+
+# flag bits
+PAIRED = 0x1
+PROPER_PAIR = 0x2
+UNMAPPED = 0x4
+MATE_UNMAPPED = 0x8
+READ1 = 0x40
+READ2 = 0x80
+SECONDARY = 0x100
+QC_FAIL = 0x200
+DUPLICATE = 0x400
+SUPPLEMENTARY = 0x800
+
+# CIGAR operations that consume the reference and are aligned bases (M, =, X) and the splice (N)
+_aligned_ops = (0,7,8)
+_splice_op = 3
+
+_record_head = struct.Struct('<iiiBBHHHiiii')
+
+COUNT_NAMES = ['total','qc_failed','secondary','supplementary','duplicates','mapped',
+               'primary','primary_mapped','paired','read1','read2','properly_paired',
+               'with_mate_mapped','singletons','mate_on_other_chr','mate_on_other_chr_mapq5',
+               'spliced','unmapped_file_reads']
+
+
+def inflate_block(block):
+    """
+    returns the uncompressed data of one BGZF ``block`` (a complete gzip member) and checks its CRC.
+    """
+    xlen = struct.unpack('<H',block[10:12])[0]
+    data = zlib.decompress(block[12 + xlen:-8],-15)
+    crc,size = struct.unpack('<Ii',block[-8:])
+    if len(data) != size or (zlib.crc32(data) & 0xffffffff) != crc:
+        raise errors.InvalidFileFormatError('BGZF block fails its CRC/size check.')
+    return data
+
+def _inflate_batch(blocks):
+    return ''.join([inflate_block(b) for b in blocks])
+
+
+class BgzfReader(object):
+    """
+    Reads the uncompressed stream of a BGZF file, inflating blocks in parallel.
+    """
+    def __init__(self,path,threads=4,batch=64):
+        """
+        initializes a ``BgzfReader`` object
+
+        :param path: path of the BGZF (e.g. BAM) file
+        :param threads: number of batches inflated at once
+        :param batch: number of blocks inflated per task
+
+        :returns: an initialized ``BgzfReader`` object
+        """
+        self.path = path
+        self.threads = threads
+        self.batch = batch
+
+    def read_blocks(self):
+        """
+        yields the raw BGZF blocks of the file in order.
+        """
+        in_file = open(self.path,'rb')
+        try:
+            while True:
+                header = in_file.read(12)
+                if not header:
+                    break
+                if len(header) < 12 or header[:4] != BGZF_MAGIC:
+                    raise errors.InvalidFileFormatError('%s is not a BGZF file (or is truncated).' % (self.path))
+                xlen = struct.unpack('<H',header[10:12])[0]
+                extra = in_file.read(xlen)
+                block_size = None
+                i = 0
+                while i + 4 <= len(extra):
+                    si1,si2,slen = struct.unpack('<BBH',extra[i:i + 4])
+                    if si1 == 66 and si2 == 67 and slen == 2:
+                        block_size = struct.unpack('<H',extra[i + 4:i + 6])[0] + 1
+                    i += 4 + slen
+                if block_size is None:
+                    raise errors.InvalidFileFormatError('%s: gzip member without a BGZF block size.' % (self.path))
+                rest = in_file.read(block_size - 12 - xlen)
+                if len(rest) != block_size - 12 - xlen:
+                    raise errors.InvalidFileFormatError('%s is truncated.' % (self.path))
+                yield header + extra + rest
+        finally:
+            in_file.close()
+
+    def _batches(self):
+        batch = []
+        for block in self.read_blocks():
+            batch.append(block)
+            if len(batch) >= self.batch:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def chunks(self):
+        """
+        yields the uncompressed stream in order, one inflated batch of blocks at a time.
+        """
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1,self.threads))
+        try:
+            # keep a few batches per thread in flight
+            window = deque()
+            for batch in self._batches():
+                window.append(pool.apply_async(_inflate_batch,(batch,)))
+                if len(window) >= self.threads * 2:
+                    yield window.popleft().get()
+            while window:
+                yield window.popleft().get()
+        finally:
+            pool.close()
+            pool.join()
+
+
+class BamStats(object):
+    """
+    Accumulates flagstat-style counts, splicing and per-reference totals of BAM files.
+    """
+    def __init__(self,threads=4):
+        """
+        initializes a ``BamStats`` object
+
+        :param threads: number of BGZF batches inflated at once
+
+        :returns: an initialized ``BamStats`` object
+        """
+        self.threads = threads
+        self.counts = dict([(name,0) for name in COUNT_NAMES])
+        self.references = []
+        self._reference_ids = {}
+        self.ref_lengths = []
+        self.ref_reads = []
+        self.ref_bases = []
+
+    def read_header(self,data,path):
+        """
+        parses the BAM header at the start of ``data``; returns the offset of the first record.
+        """
+        if data[:4] != 'BAM\x01':
+            raise errors.InvalidFileFormatError('%s is not a BAM file.' % (path))
+        l_text = struct.unpack('<i',data[4:8])[0]
+        offset = 8 + l_text
+        n_ref = struct.unpack('<i',data[offset:offset + 4])[0]
+        offset += 4
+        references = []
+        for i in range(n_ref):
+            l_name = struct.unpack('<i',data[offset:offset + 4])[0]
+            name = data[offset + 4:offset + 4 + l_name - 1]
+            l_ref = struct.unpack('<i',data[offset + 4 + l_name:offset + 8 + l_name])[0]
+            references.append((name,l_ref))
+            offset += 8 + l_name
+        return references,offset
+
+    def add_bam(self,path,unmapped_file=False):
+        """
+        adds the records of the BAM at ``path``.
+
+        :param unmapped_file: ``True`` for tophat's ``unmapped.bam`` (its reads only count as unmapped)
+        """
+        reader = BgzfReader(path,threads=self.threads)
+        data = ''
+        ref_index = None
+        offset = 0
+        for chunk in reader.chunks():
+            data = data[offset:] + chunk
+            offset = 0
+            if ref_index is None:
+                try:
+                    references,offset = self.read_header(data,path)
+                except struct.error:
+                    # the header spans more than one batch
+                    continue
+                if offset > len(data):
+                    offset = 0
+                    continue
+                ref_index = self._add_references(references)
+            offset = self._scan_records(data,offset,ref_index,unmapped_file)
+        if len(data) - offset:
+            raise errors.InvalidFileFormatError('%s ends in the middle of a record.' % (path))
+        if ref_index is None:
+            raise errors.InvalidFileFormatError('%s has no complete BAM header.' % (path))
+
+    def _add_references(self,references):
+        """
+        merges a file's reference list into ``self.references``; returns the mapping of its ids to ours.
+        """
+        ref_index = []
+        for name,length in references:
+            if name not in self._reference_ids:
+                self._reference_ids[name] = len(self.references)
+                self.references.append(name)
+                self.ref_lengths.append(length)
+                self.ref_reads.append(0)
+                self.ref_bases.append(0)
+            ref_index.append(self._reference_ids[name])
+        return ref_index
+
+    def _scan_records(self,data,offset,ref_index,unmapped_file):
+        """
+        counts every complete record in ``data`` from ``offset``; returns the offset of the first incomplete one.
+        """
+        counts = self.counts
+        ref_reads = self.ref_reads
+        ref_bases = self.ref_bases
+        unpack_head = _record_head.unpack_from
+        end = len(data)
+        while offset + 4 <= end:
+            block_size = struct.unpack_from('<i',data,offset)[0]
+            if offset + 4 + block_size > end:
+                break
+            (ref_id,pos,l_read_name,mapq,bin_,n_cigar,flag,l_seq,
+             next_ref_id,next_pos,tlen) = unpack_head(data,offset)[1:]
+            record_start = offset
+            offset += 4 + block_size
+
+            counts['total'] += 1
+            if flag & QC_FAIL:
+                counts['qc_failed'] += 1
+            if flag & DUPLICATE:
+                counts['duplicates'] += 1
+            if unmapped_file:
+                counts['unmapped_file_reads'] += 1
+            mapped = not (flag & UNMAPPED) and not unmapped_file
+            if mapped:
+                counts['mapped'] += 1
+            if flag & SECONDARY:
+                counts['secondary'] += 1
+                continue
+            if flag & SUPPLEMENTARY:
+                counts['supplementary'] += 1
+                continue
+
+            counts['primary'] += 1
+            if flag & PAIRED:
+                counts['paired'] += 1
+                if flag & READ1:
+                    counts['read1'] += 1
+                if flag & READ2:
+                    counts['read2'] += 1
+                if mapped and flag & PROPER_PAIR:
+                    counts['properly_paired'] += 1
+                if mapped and not flag & MATE_UNMAPPED:
+                    counts['with_mate_mapped'] += 1
+                    if next_ref_id != ref_id:
+                        counts['mate_on_other_chr'] += 1
+                        if mapq >= 5:
+                            counts['mate_on_other_chr_mapq5'] += 1
+                elif mapped:
+                    counts['singletons'] += 1
+            if not mapped:
+                continue
+
+            counts['primary_mapped'] += 1
+            cigar_at = record_start + 36 + l_read_name
+            cigar = struct.unpack_from('<%sI' % (n_cigar),data,cigar_at)
+            aligned = 0
+            spliced = False
+            for op in cigar:
+                code = op & 0xf
+                if code in _aligned_ops:
+                    aligned += op >> 4
+                elif code == _splice_op:
+                    spliced = True
+            if spliced:
+                counts['spliced'] += 1
+            if ref_id >= 0:
+                ref = ref_index[ref_id]
+                ref_reads[ref] += 1
+                ref_bases[ref] += aligned
+        return offset
+
+    def summary(self):
+        """
+        returns the counts, rates and per-reference totals as a ``dict`` ready for JSON.
+        """
+        c = self.counts
+        primary_unmapped = c['primary'] - c['primary_mapped']
+        reads = c['primary_mapped'] + primary_unmapped
+        rates = {'mapped_percent':round(100.0 * c['primary_mapped'] / max(reads,1),2),
+                 'spliced_percent':round(100.0 * c['spliced'] / max(c['primary_mapped'],1),2),
+                 'multi_mapped_alignments_per_read':round(float(c['secondary']) / max(c['primary_mapped'],1),4),
+                 'properly_paired_percent':round(100.0 * c['properly_paired'] / max(c['paired'],1),2) if c['paired'] else None}
+        references = []
+        for i,name in enumerate(self.references):
+            references.append({'name':name,
+                               'length':self.ref_lengths[i],
+                               'reads':self.ref_reads[i],
+                               'aligned_bases':self.ref_bases[i],
+                               'mean_depth':round(float(self.ref_bases[i]) / max(self.ref_lengths[i],1),4)})
+        return {'counts':dict(c),'reads':reads,'rates':rates,'references':references}
+
+
+def check_library(summary,min_mapped_percent=None,min_properly_paired_percent=None,min_reads=None):
+    """
+    returns the reasons a library fails the given thresholds (an empty list if it passes).
+    """
+    reasons = []
+    rates = summary['rates']
+    if min_reads is not None and summary['reads'] < min_reads:
+        reasons.append('%s reads is fewer than the minimum of %s.' % (summary['reads'],min_reads))
+    if min_mapped_percent is not None and rates['mapped_percent'] < min_mapped_percent:
+        reasons.append('%s%% of reads mapped; the minimum is %s%%.' % (rates['mapped_percent'],min_mapped_percent))
+    if (min_properly_paired_percent is not None and rates['properly_paired_percent'] is not None
+            and rates['properly_paired_percent'] < min_properly_paired_percent):
+        reasons.append('%s%% of paired reads properly paired; the minimum is %s%%.'
+                       % (rates['properly_paired_percent'],min_properly_paired_percent))
+    return reasons
+
+
+def load_bam_stats(out_dir):
+    """
+    returns the summary written by ``blacktie-bam-stats`` into ``out_dir`` or ``None`` if there is none.
+    """
+    path = '%s/bam_stats.json' % (out_dir.rstrip('/'))
+    if not os.path.exists(path):
+        return None
+    return json.load(open(path))
@@ -24,22 +24,105 @@ import re
 import time
 import socket
 import shutil
+import pipes
 from collections import defaultdict
 
-from mako.template import Template
-
 from blacktie.utils.misc import Bunch,bunchify
 from blacktie.utils.misc import email_notification
 from blacktie.utils.misc import get_time
 from blacktie.utils.misc import uniques
+from blacktie.utils.progress import get_progress_parser
+from blacktie.utils.progress import ProgressBarFilter
 from blacktie.utils.externals import runExternalApp,mkdirp
+from blacktie.utils.qsub import QsubScriptWriter,JOB_NICKNAMES
+from blacktie.utils.executors import default_executor
+from blacktie.utils.warmup import warm_method
+from blacktie.utils.references import ReferenceCache,transcriptome_index_ready
 from blacktie.utils import errors
 
 
+# ++++++++ resolving call ids and from_conditions values (shared with preflight.py) ++++++++
+def condition_id(condition):
+    """
+    returns the id of ``condition`` used in call ids.
+    """
+    return "%s_%s" % (condition['name'],condition['replicate_id'])
+
+def build_call_id(prog_name,conditions):
+    """
+    returns the call id of the ``prog_name`` call of ``conditions``.
+
+    :param conditions: a condition ``dict`` or the list of conditions of a group call
+    """
+    if isinstance(conditions,dict):
+        return "%s_%s" % (prog_name,condition_id(conditions))
+    return "%s_%s" % (prog_name,".".join([condition_id(c) for c in conditions]))
+
+def output_path(yargs,call_id,file_name=None):
+    """
+    returns the ``from_conditions`` out directory of the call ``call_id`` (or ``file_name`` in it).
+    """
+    path = "%s/%s" % (yargs.run_options.base_dir.rstrip('/'),call_id)
+    if file_name:
+        return "%s/%s" % (path,file_name)
+    return path
+
+def resolve_option(option,conditions,condition_key,option_name):
+    """
+    Handles an option set to ``from_conditions``.
+
+    :param option: the option's value in the yaml config file
+    :param conditions: a condition ``dict`` or the list of conditions of a group call (which must
+        all agree on the value)
+    :param condition_key: the key of the value in each condition
+    :param option_name: name of the option (for error messages)
+    :returns: ``option`` or, if it is ``from_conditions``, the conditions' value of ``condition_key``
+    """
+    if option != 'from_conditions':
+        return option
+    if isinstance(conditions,dict):
+        value = conditions.get(condition_key)
+        what = 'condition %s' % (condition_id(conditions))
+    else:
+        values = set([c.get(condition_key) for c in conditions])
+        what = 'experiment %s' % (conditions[0].get('experiment_id'))
+        if len(values) != 1:
+            raise errors.InvalidFileFormatError('CHECK YAML CONFIG FILE: Conditions in %s do not agree on which "%s" to use: %s.'
+                                                % (what,option_name,', '.join(sorted([str(v) for v in values]))))
+        value = values.pop()
+    if value in [None,'']:
+        raise errors.InvalidFileFormatError('CHECK YAML CONFIG FILE: %s has no "%s" for "%s".' % (what,condition_key,option_name))
+    return value
+
+def resolve_reads(option,condition,side):
+    """
+    Handles ``positional_args.left_reads``/``right_reads``.
+
+    :returns: ``list`` of the fastq files of ``side`` (empty if there are none)
+    """
+    if option == 'from_conditions':
+        return list(resolve_option(option,condition,side,side))
+    elif option:
+        return option.split(',')
+    return []
+
+def resolve_bowtie_index(yargs,option,condition):
+    """
+    Handles ``tophat_options.positional_args.bowtie2_index``.
+
+    :returns: the bowtie2 index prefix (a ``from_conditions`` name is looked up under ``run_options.bowtie_indexes_dir``)
+    """
+    if option == 'from_conditions':
+        name = resolve_option(option,condition,'bowtie2_index','bowtie2_index')
+        return "%s/%s" % (yargs.run_options.bowtie_indexes_dir.rstrip('/'),name)
+    return option
+
+
 class BaseCall(object):
     """
     Defines common methods for all program call types.
     """
+    prog_name = None # over-ride in child classes
     def __init__(self,yargs,email_info,run_id,run_logs,conditions,mode='analyze'):
         """
         initializes a ``BaseCall`` object
@@ -60,9 +143,17 @@ class BaseCall(object):
         self.run_id = run_id
         self.log_dir = run_logs
         self.prgbar_regex = yargs.prgbar_regex
+        self.run_metrics = yargs.get('run_metrics')
+        self.run_logger = yargs.get('run_logger')
+        self.notifier = yargs.get('notifier')
+        self.qsub_writer = yargs.get('qsub_writer')
+        self.progress = None
+        self.returncode = None
         self._conditions = conditions
         self.prog_yargs = None # over-ride in child __init__
+        self.arg_list = None # over-ride in child __init__
         self.arg_str = None # over-ride in child __init__
+        self.wrapper_argv = [] # program (and its args) that runs ``prog_name`` for us; set in child __init__
 
 
 
@@ -100,9 +191,7 @@ class BaseCall(object):
         :param condition_dict: a dictionary containing consition info like name, replicate_id, etc.
         :returns: an ID used to construct the call_id of a call.
         """
-        
-        condition_id = "%s_%s" % (condition_dict['name'],condition_dict['replicate_id'])
-        return condition_id
+        return condition_id(condition_dict)
 
     def set_call_id(self):
         """
@@ -113,35 +202,38 @@ class BaseCall(object):
             # this should mean that we are dealing with a "group" type call
             self.experiment_id = self._conditions
             self._conditions = self.yargs.groups[self.experiment_id]
-            condition_ids = [self.get_condition_id(x) for x in self._conditions]
-            call_id = "%s_%s" % (self.prog_name,".".join(condition_ids))
-            self.call_id = call_id
+            self.call_id = build_call_id(self.prog_name,self._conditions)
 
         elif isinstance(self._conditions,dict):
-            condition_id = self.get_condition_id(self._conditions)
-            call_id = "%s_%s" % (self.prog_name,condition_id)
-            self.call_id = call_id
+            self.call_id = build_call_id(self.prog_name,self._conditions)
         else:
             raise errors.SanityCheckError('type(self._conditions) should be either int, str, or dict. It is: %s' % (type(self._conditions)))
 
+    def send_notification(self,email_sub,email_body):
+        """
+        hands the email to the run's ``Notifier`` (which sends it in the background) or,
+        without one, sends it right away with ``email_notification``.
+        """
+        if self.notifier is not None:
+            self.notifier.notify(email_sub,email_body,stage=self.prog_name)
+        else:
+            e = self.email_info
+            server_info = self.yargs.run_options.custom_smtp
+            email_notification(e.email_from, e.email_to, email_sub, email_body, base64.b64decode(e.email_li), server_info)
+
     def notify_start_of_call(self):
         """
         sends notification email informing user that ``self.call_id`` has been initiated
         """
-        e = self.email_info
-        
         report_time = get_time()
         email_sub="[SITREP from %s] Run %s - Starting %s at %s" % (self._hostname,self.run_id,self.call_id,report_time)
         email_body="%s\n\n%s" % (email_sub,self.cmd_string)
-        server_info = self.yargs.run_options.custom_smtp
-        email_notification(e.email_from, e.email_to, email_sub, email_body, base64.b64decode(e.email_li), server_info)
+        self.send_notification(email_sub,email_body)
 
     def notify_end_of_call(self):
         """
         sends notification email informing user that ``self.call_id`` has exited
         """
-        e = self.email_info
-
         report_time = get_time()
         email_sub="[SITREP from %s] Run %s - Exited %s at %s" % (self._hostname,self.run_id,self.call_id,report_time)
 
@@ -149,8 +241,7 @@ class BaseCall(object):
         email_body=email_sub
         
         email_body += "\n\n ==> stderr <==\n\n%s" % (self.stderr_msg)
-        server_info = self.yargs.run_options.custom_smtp
-        email_notification(e.email_from, e.email_to, email_sub, email_body, base64.b64decode(e.email_li), server_info)
+        self.send_notification(email_sub,email_body)
 
     def build_out_dir_path(self):
         """
@@ -159,8 +250,7 @@ class BaseCall(object):
         :returns: ``out_dir``
         """
 
-        base_dir = self.yargs.run_options.base_dir.rstrip('/')
-        return "%s/%s" % (base_dir,self.call_id)
+        return output_path(self.yargs,self.call_id)
 
     def init_opt_dict(self):
         """
@@ -210,32 +300,85 @@ class BaseCall(object):
 
         self.options_list = options_list
 
+    def set_arg_list(self,arg_list):
+        """
+        stores the program's argv (minus the program itself) in ``self.arg_list`` and a
+        shell-quoted version of it in ``self.arg_str`` for display and qsub scripts.
+
+        :param arg_list: list of command line arguments for ``self.prog_name``
+        """
+        self.arg_list = [str(arg) for arg in arg_list]
+        self.arg_str = ' '.join([pipes.quote(arg) for arg in self.arg_list])
+
     def purge_progress_bars(self, stderr_str):
         """
-        removes the dynamic progress bars included in some output in case user did not turn them off
+        collapses the dynamic progress bars included in some output to their final state.
+
+        Output from ``execute()`` is already filtered as it streams; this is for text from elsewhere.
         """
-        lines = stderr_str.split('\n')
-        no_bar = []
-        for line in lines:
-            if self.prgbar_regex.search(line) != None: # prgbar regex compiled outside scope to avoid re-complilation overhead
-                pass
-            else:
-                no_bar.append(line)
-        return '\n'.join(no_bar)
+        bar_filter = ProgressBarFilter(bar_regex=self.prgbar_regex) # prgbar regex compiled outside scope to avoid re-complilation overhead
+        for start in xrange(0,len(stderr_str),65536):
+            bar_filter.feed(stderr_str[start:start + 65536])
+        bar_filter.close()
+        return bar_filter.getvalue()
+
+    def update_metrics(self,state,pid=None):
+        """
+        records ``state`` for this call in ``self.run_metrics`` if metrics export is turned on.
+
+        :param state: one of ``blacktie.utils.metrics.CALL_STATES``
+        :param pid: pid of the external process if it is running
+        """
+        if self.run_metrics is None:
+            return
+        try:
+            cores = self.opt_dict.get('p') or 1
+        except AttributeError:
+            cores = 1
+        self.run_metrics.update_call(self.call_id,self.prog_name,state,cores=cores,pid=pid)
+
+    def _on_process_start(self,process):
+        """
+        passed to ``runExternalApp`` so the metrics know which process belongs to this call.
+        """
+        self.update_metrics('running',pid=process.pid)
+
+    def _on_stderr_line(self,line):
+        """
+        passed to ``runExternalApp`` to turn each line of streaming stderr into progress events.
+        """
+        event = self.progress.feed(line)
+        if event is None:
+            return
+        self.log_event('progress',percent=event.percent,step=event.step,eta=event.eta)
+        if self.run_metrics is not None:
+            self.run_metrics.update_progress(self.call_id,event)
 
     def log_msg(self,log_msg=''):
         """
-        * opens ``self.log_file``
-        * writes ``log_msg``
-        * closes ``self.log_file``
+        * hands ``log_msg`` to the run's ``RunLogger`` to be appended to ``self.log_file``
+        * or, without a ``RunLogger``: opens ``self.log_file``, writes ``log_msg``, closes ``self.log_file``
         """
         if self.mode == 'analyze':
-            log = open(self.log_file,'a')
-            log.write('\n%s\n' % (log_msg))
-            log.close()
+            if self.run_logger is not None:
+                self.run_logger.log(self.log_file,'\n%s\n' % (log_msg))
+            else:
+                log = open(self.log_file,'a')
+                log.write('\n%s\n' % (log_msg))
+                log.close()
         else:
             pass
 
+    def log_event(self,event_type,**fields):
+        """
+        records a structured event for this call in the run's JSON-lines event log.
+
+        :param event_type: short name of the event (e.g. 'call_start', 'progress')
+        :param fields: json-serializable details of the event
+        """
+        if self.run_logger is not None:
+            self.run_logger.event(event_type,call_id=self.call_id,tool=self.prog_name,**fields)
+
     def log_start(self):
         """
         records start of call in ``self.log_file``
@@ -251,23 +394,65 @@ class BaseCall(object):
         records command string used, program output, and the end of call in ``self.log_file``
         """
         if self.mode == 'analyze':
-            self.stderr_msg = self.purge_progress_bars(self.stderr_msg)
             err_msg = "%s\n\n%s\n[end %s]" % (self.cmd_string,self.stderr_msg,self.call_id)
             self.log_msg(log_msg=err_msg)
+            if self.run_logger is not None:
+                self.run_logger.flush()
         else:
             pass
 
 
+    def get_upstream_call_ids(self):
+        """
+        returns the call ids of the calls whose output this call reads (over-ride in child classes).
+        """
+        return []
+
+    def get_stage_inputs(self):
+        """
+        returns the inputs ``blacktie-stage`` may copy to node-local scratch for this call as a ``Bunch``
+        with ``call_inputs`` (read only by this call), ``references`` and ``indexes`` (shared with other
+        calls); over-ride in child classes.
+        """
+        return Bunch({'call_inputs':[],'references':[],'indexes':[]})
+
+    def prepared_reference(self,path):
+        """
+        returns the copy of the reference ``path`` prepared under ``run_options.reference_dir``
+        (with its ``.fai`` already built) or ``path`` itself if it was not prepared.
+        """
+        return (self.yargs.get('prepared_references') or {}).get(path,path)
+
+    def option_paths(self,*option_names):
+        """
+        returns the values in ``self.opt_dict`` of ``option_names`` that are paths (not flags or ``False``).
+        """
+        return [self.opt_dict[o] for o in option_names if isinstance(self.opt_dict.get(o),basestring)]
+
+    def staged_cmd_str(self,staging,cmd_str):
+        """
+        wraps ``cmd_str`` in a ``blacktie-stage`` call that runs it on node-local copies of its inputs.
+
+        :param staging: the ``qsub_options.staging`` sub-tree of the yaml config file
+        """
+        inputs = self.get_stage_inputs()
+        argv = ['blacktie-stage','--scratch',staging.get('scratch_dir') or '/scratch/$USER',
+                '--threads',str(staging.get('threads') or 4),
+                '--verify',staging.get('verify') or 'size']
+        if staging.get('keep_references'):
+            argv.append('--keep-references')
+        for flag,paths in [('--input',inputs.call_inputs),('--reference',inputs.references),('--index',inputs.indexes)]:
+            for path in uniques(paths):
+                argv.extend([flag,path])
+        argv.append('--')
+        return '%s %s' % (' '.join([pipes.quote(arg) for arg in argv]),cmd_str)
+
     def build_qsub(self):
         """
-        Builds and writes this CallObject's qsub script to current working directory
-        using options provided under the "qsub_options" sub-tree in the yaml config file.
+        Builds this CallObject's qsub script using options provided under the "qsub_options"
+        sub-tree in the yaml config file and hands it to the run's ``QsubScriptWriter``
+        (without one, the script is written to the current working directory).
         """
-        nicknames = {'tophat':'th',
-                     'cufflinks':'cl',
-                     'cuffmerge':'cm',
-                     'cuffdiff':'cd',}
-        
         qsub_options = self.yargs.qsub_options
         
         # set keyword args for template
@@ -277,76 +462,181 @@ class BaseCall(object):
         kw.core_range = qsub_options.core_range
         kw.email_addy = self.email_info.email_to
         kw.call_id = self.call_id
-        job_name = "%s_%s" % (nicknames[self.prog_name], '_'.join(self.call_id.split('_')[1:]))
+        job_name = "%s_%s" % (JOB_NICKNAMES[self.prog_name], '_'.join(self.call_id.split('_')[1:]))
         kw.job_name = job_name
         kw.out_dir = self.out_dir
         kw.ld_library_path = qsub_options.ld_library_path
         
         # need to make sure we use the number of cores that the SGE gave us
         kw.cmd_str = self.cmd_string.replace('-p %s' % (self.opt_dict['p']),'-p $CORES')
+
+        # read inputs from node-local copies instead of the shared filesystem
+        staging = qsub_options.get('staging')
+        if staging:
+            kw.cmd_str = self.staged_cmd_str(staging,kw.cmd_str)
         
-        qsub_template = Template(filename=qsub_options.template)
-        out_file = open('%s.qsub.sh' % (self.call_id),'w')
-        qsub_string = qsub_template.render(**kw)
-        out_file.write(qsub_string)
-        out_file.close()
+        if self.qsub_writer is not None:
+            self.qsub_writer.add(self.call_id,kw,stage=self.prog_name,after=self.get_upstream_call_ids())
+        else:
+            qsub_writer = QsubScriptWriter(qsub_options.template,os.getcwd())
+            qsub_writer.add(self.call_id,kw)
+            qsub_writer.flush()
         
         
     def execute(self):
         """
-        calls correct program, records results, and manages errors
+        hands this call to the run's executor (``yargs.executor``), which runs it here, prints it,
+        writes its qsub script or submits it to a cluster (see ``blacktie.utils.executors``).
         """
         
-        self.cmd_string = "%s %s" % (self.prog_name,self.arg_str)
-        if self.mode == 'analyze':
-            try:
-                self.notify_start_of_call()
-                self.log_start()
-    
-                self.stdout_msg,self.stderr_msg = runExternalApp(progName=self.prog_name,argStr=self.arg_str)
-    
-                self.log_end()
-                self.notify_end_of_call()
-            except Exception as exc:
-                email_body = traceback.format_exc()
-                email_body = self.purge_progress_bars(email_body)
-                e = self.email_info
-                server_info = self.yargs.run_options.custom_smtp
-
-                self.stdout_msg = "\nError in call.  Check error log.\n"
-                self.stderr_msg = email_body
-    
-                self.log_end()
-    
-                self._flag_out_dir()
-    
-                if isinstance(exc,errors.SystemCallError):
-                    email_sub="[SITREP from %s] Run %s experienced SystemCallError in call %s. MOVING ON." % (self._hostname,self.run_id,self.call_id)
-                    email_notification(e.email_from, e.email_to, email_sub, email_body, base64.b64decode(e.email_li),server_info)                
-                elif isinstance(exc,KeyboardInterrupt):
-                    email_sub="[SITREP from %s] Run %s experienced KeyboardInterrupt in call %s. MOVING ON." % (self._hostname,self.run_id,self.call_id)
-                    email_notification(e.email_from, e.email_to, email_sub, email_body, base64.b64decode(e.email_li),server_info) 
-                else:
-                    email_sub="[SITREP from %s] Run %s experienced unhandled exception in call %s. EXITING." % (self._hostname,self.run_id,self.call_id)
-                    email_notification(e.email_from, e.email_to, email_sub, email_body, base64.b64decode(e.email_li),server_info)
-                    raise
-        
-        # DRY RUN
-        elif self.mode == 'dry_run':
-            print self.cmd_string + '\n'
-        
-        # QSUB SCRIPT
-        elif self.mode == 'qsub_script':
-            self.build_qsub()
+        wrapper = ''.join(['%s ' % (pipes.quote(arg)) for arg in self.wrapper_argv])
+        self.cmd_string = "%s%s %s" % (wrapper,self.prog_name,self.arg_str)
+        executor = self.yargs.get('executor')
+        if executor is None:
+            executor = default_executor(self.mode)
+        executor.execute(self)
+
+    def run(self):
+        """
+        runs the program on this machine, records results, and manages errors
+        """
+        try:
+            self.update_metrics('running')
+            self.log_event('call_start',argv=[self.prog_name] + self.arg_list,out_dir=self.out_dir)
+            start_time = time.time()
+            self.notify_start_of_call()
+            self.log_start()
+
+            self.progress = get_progress_parser(self.prog_name)
+            if self.progress is not None:
+                on_stderr_line = self._on_stderr_line
+            else:
+                on_stderr_line = None
+            stderr_filter = ProgressBarFilter(bar_regex=self.prgbar_regex,on_line=on_stderr_line)
+
+            argv = self.wrapper_argv + [self.prog_name] + self.arg_list
+            self.stdout_msg,self.stderr_msg = runExternalApp(progName=argv[0],argList=argv[1:],
+                                                             on_start=self._on_process_start,
+                                                             stderr_filter=stderr_filter)
+            self.returncode = 0
+
+            self.log_end()
+            self.update_metrics('done')
+            self.log_event('call_end',status='done',elapsed=time.time() - start_time)
+            self.notify_end_of_call()
+        except Exception as exc:
+            self.returncode = getattr(exc,'errno',None)
+            self.update_metrics('failed')
+            self.log_event('call_end',status='failed',error=exc.__class__.__name__,
+                           returncode=getattr(exc,'errno',None))
+            # stderr in the traceback was already filtered as it streamed
+            email_body = traceback.format_exc()
+
+            self.stdout_msg = "\nError in call.  Check error log.\n"
+            self.stderr_msg = email_body
+
+            self.log_end()
+
+            self._flag_out_dir()
+
+            if isinstance(exc,errors.SystemCallError):
+                email_sub="[SITREP from %s] Run %s experienced SystemCallError in call %s. MOVING ON." % (self._hostname,self.run_id,self.call_id)
+                self.send_notification(email_sub,email_body)
+            elif isinstance(exc,KeyboardInterrupt):
+                email_sub="[SITREP from %s] Run %s experienced KeyboardInterrupt in call %s. MOVING ON." % (self._hostname,self.run_id,self.call_id)
+                self.send_notification(email_sub,email_body)
+            else:
+                email_sub="[SITREP from %s] Run %s experienced unhandled exception in call %s. EXITING." % (self._hostname,self.run_id,self.call_id)
+                self.send_notification(email_sub,email_body)
+                raise
+
+
+
+class FastqQCCall(BaseCall):
+    """
+    Manage a single call to the blacktie-fastq-qc script and store associated run data.
+    """
+    prog_name = 'blacktie-fastq-qc'
+
+    def __init__(self,yargs,email_info,run_id,run_logs,conditions,mode):
+        """
+        initializes the ``FastqQCCall`` object
+
+        :param yargs: argument tree generated by parsing the yaml config file
+        :param email_info: Bunch() object containing keys: ``email_from``, ``email_to``, ``email_li``
+        :param run_id: id for the whole set of calls
+        :param run_logs: the directory where log file should be put
+        :param conditions: one or a list of condition-dictionaries from ``yargs.condition_queue``
+        :param mode: choices = ['analyze','dry_run','qsub_script']
+
+        :returns: an initialized ``FastqQCCall`` object
+        """
+
+        BaseCall.__init__(self,yargs,email_info,run_id,run_logs,conditions,mode)
+
+        self.prog_yargs = self.yargs.fastq_qc_options
+        self.set_call_id()
+        self.init_log_file()
+        self.out_dir = self.get_out_dir()
+
+        # set up options for program call
+        self.opt_dict = self.init_opt_dict()
+        self.opt_dict['out'] = self.out_dir
+        self.opt_dict['mate-inner-dist'] = self.get_tophat_number('r')
+        self.opt_dict['mate-std-dev'] = self.get_tophat_number('mate-std-dev')
+        self.construct_options_list()
+
+        # now the positional args
+        self.left_reads = self.get_reads('left_reads')
+        self.right_reads = self.get_reads('right_reads')
+
+        # combine and save arg_list
+        self.options_list.extend([self.left_reads,self.right_reads])
+        self.set_arg_list(self.options_list)
+
+    def get_stage_inputs(self):
+        """
+        returns the reads of this call for ``blacktie-stage``.
+        """
+        return Bunch({'call_inputs':[p for p in (self.left_reads + ',' + self.right_reads).split(',') if p],
+                      'references':[],
+                      'indexes':[]})
+
+    def get_out_dir(self):
+        """
+        Handles ``yaml_config.fastq_qc_options.out: from_conditions``.
+        """
+        option = self.prog_yargs.out
+        if option == 'from_conditions':
+            return self.build_out_dir_path()
         else:
-            raise errors.BlacktieError()
+            return option
+
+    def get_reads(self,side):
+        """
+        Handles ``yaml_config.fastq_qc_options.positional_args.<side>: from_conditions``.
+        """
+        return ','.join(resolve_reads(self.prog_yargs.positional_args[side],self._conditions,side))
 
+    def get_tophat_number(self,option_name):
+        """
+        returns the numeric value tophat will be given for ``option_name`` (from ``tophat_options``
+        or this condition) so the reads can be checked against it, or ``False``.
+        """
+        tophat_options = self.yargs.get('tophat_options') or {}
+        option = tophat_options.get(option_name)
+        if option == 'from_conditions':
+            option = self._conditions.get(option_name)
+        if isinstance(option,bool) or not isinstance(option,(int,long,float)):
+            return False
+        return option
 
 
 class TophatCall(BaseCall):
     """
     Manage a single call to tophat and store associated run data.
     """
+    prog_name = 'tophat'
 
     def __init__(self,yargs,email_info,run_id,run_logs,conditions,mode):
         """
@@ -362,8 +652,6 @@ class TophatCall(BaseCall):
         :returns: an initialized ``TophatCall`` object
         """
 
-        self.prog_name = 'tophat'
-
         BaseCall.__init__(self,yargs,email_info,run_id,run_logs,conditions,mode)
 
         self.prog_yargs = self.yargs.tophat_options
@@ -375,16 +663,51 @@ class TophatCall(BaseCall):
         self.opt_dict = self.init_opt_dict()
         self.opt_dict['o'] = self.out_dir
         self.opt_dict['G'] = self.get_gtf_anno()
+        self.bowtie_index = self.get_bt_idx()
+        self.gtf_annotation = self.opt_dict['G']
+        self.transcriptome_index = self.get_transcriptome_index()
+        if self.transcriptome_index:
+            # reuse the index built once for this GTF and bowtie2 index instead of rebuilding it from -G
+            self.opt_dict['G'] = False
+            self.opt_dict['transcriptome-index'] = self.transcriptome_index
         self.construct_options_list()
 
         # now the positional args
-        bowtie_index = self.get_bt_idx()
-        left_reads = self.get_lt_reads()
-        right_reads = self.get_rt_reads()
-
-        # combine and save arg_str
-        self.options_list.extend([bowtie_index,left_reads,right_reads])
-        self.arg_str = ' '.join(self.options_list)
+        self.left_reads = self.get_lt_reads()
+        self.right_reads = self.get_rt_reads()
+
+        # combine and save arg_list
+        self.options_list.extend([self.bowtie_index,self.left_reads,self.right_reads])
+        self.set_arg_list(self.options_list)
+
+        # split the reads and align the shards side by side; the merged BAM lands where a plain call puts it
+        shards = self.yargs.run_options.get('tophat_shards')
+        if shards and int(shards) > 1:
+            self.wrapper_argv = ['blacktie-tophat-shards','--shards',str(int(shards)),'--']
+        elif self.yargs.run_options.get('stream_reads'):
+            # (the shard splitter already streams its reads through pigz)
+            self.wrapper_argv = ['blacktie-stream-reads','--']
+
+        # cluster jobs warm the index on their own node; local runs warm it once before the tophat step
+        method = warm_method(self.yargs.run_options.get('warm_indexes'))
+        executor = self.yargs.get('executor')
+        if method and executor is not None and executor.name not in ['local','dry_run']:
+            self.wrapper_argv = ['blacktie-warm-index','--method',method,'--index',self.bowtie_index,'--'] + self.wrapper_argv
+
+        # the first call to find the transcriptome index missing builds it; the others wait for it
+        if self.transcriptome_index and not transcriptome_index_ready(self.transcriptome_index):
+            argv = ['blacktie-transcriptome-index','--gtf',self.gtf_annotation,'--bowtie-index',self.bowtie_index]
+            if self.opt_dict.get('p'):
+                argv.extend(['-p',str(self.opt_dict['p'])])
+            self.wrapper_argv = argv + ['--transcriptome-index',self.transcriptome_index,'--'] + self.wrapper_argv
+
+    def get_stage_inputs(self):
+        """
+        returns the reads, GTF and bowtie2 index of this call for ``blacktie-stage``.
+        """
+        return Bunch({'call_inputs':self.left_reads.split(',') + self.right_reads.split(','),
+                      'references':self.option_paths('G'),
+                      'indexes':[self.bowtie_index]})
 
     def get_out_dir(self):
         """
@@ -400,52 +723,138 @@ class TophatCall(BaseCall):
         """
         Handles ``yaml_config.tophat_options.G: from_conditions``.
         """
-        option = self.prog_yargs.G
-        if option == 'from_conditions':
-            gtf_path = self._conditions['gtf_annotation']
-            return gtf_path
-        else:
-            return option
+        return resolve_option(self.prog_yargs.G,self._conditions,'gtf_annotation','G')
+
+    def get_transcriptome_index(self):
+        """
+        Handles ``yaml_config.run_options.transcriptome_index``: returns the prefix of the shared
+        transcriptome index of this call's GTF and bowtie2 index under ``run_options.reference_dir``
+        (``None`` if it is off, there is no GTF or ``transcriptome-index`` is set in ``tophat_options``).
+        """
+        if not self.yargs.run_options.get('transcriptome_index') or self.mode == 'dry_run':
+            return None
+        if not self.gtf_annotation or self.opt_dict.get('transcriptome-index'):
+            return None
+        cache = ReferenceCache(self.yargs.run_options.reference_dir)
+        return cache.transcriptome_prefix(self.gtf_annotation,self.bowtie_index)
 
     def get_bt_idx(self):
         """
         Handles ``yaml_config.tophat_options.positional_args.bowtie2_index: from_conditions``.
         """
-        option = self.prog_yargs.positional_args.bowtie2_index
-        if option == 'from_conditions':
-            bt_idx_dir = self.yargs.run_options.bowtie_indexes_dir.rstrip('/')
-            bt_idx_name = self._conditions['bowtie2_index']
-            return "%s/%s" % (bt_idx_dir,bt_idx_name)
-        else:
-            return option
+        return resolve_bowtie_index(self.yargs,self.prog_yargs.positional_args.bowtie2_index,self._conditions)
 
     def get_lt_reads(self):
         """
         Handles ``yaml_config.tophat_options.positional_args.left_reads: from_conditions``.
         """
-        option = self.prog_yargs.positional_args.left_reads
+        return ','.join(resolve_reads(self.prog_yargs.positional_args.left_reads,self._conditions,'left_reads'))
+
+    def get_rt_reads(self):
+        """
+        Handles ``yaml_config.tophat_options.positional_args.right_reads: from_conditions``.
+        """
+        return ','.join(resolve_reads(self.prog_yargs.positional_args.right_reads,self._conditions,'right_reads'))
+
+
+class BamStatsCall(BaseCall):
+    """
+    Manage a single call to the blacktie-bam-stats script and store associated run data.
+    """
+    prog_name = 'blacktie-bam-stats'
+
+    def __init__(self,yargs,email_info,run_id,run_logs,conditions,mode):
+        """
+        initializes the ``BamStatsCall`` object
+
+        :param yargs: argument tree generated by parsing the yaml config file
+        :param email_info: Bunch() object containing keys: ``email_from``, ``email_to``, ``email_li``
+        :param run_id: id for the whole set of calls
+        :param run_logs: the directory where log file should be put
+        :param conditions: one or a list of condition-dictionaries from ``yargs.condition_queue``
+        :param mode: choices = ['analyze','dry_run','qsub_script']
+
+        :returns: an initialized ``BamStatsCall`` object
+        """
+
+        BaseCall.__init__(self,yargs,email_info,run_id,run_logs,conditions,mode)
+
+        self.prog_yargs = self.yargs.bam_stats_options
+        self.set_call_id()
+        self.init_log_file()
+        self.out_dir = self.get_out_dir()
+
+        # set up options for program call
+        self.opt_dict = self.init_opt_dict()
+        self.opt_dict['out'] = self.out_dir
+        self.construct_options_list()
+
+        # now the positional args
+        self.accepted_hits = self.get_accepted_hits()
+
+        # combine and save arg_list
+        self.options_list.extend([self.accepted_hits])
+        self.set_arg_list(self.options_list)
+
+    def get_stage_inputs(self):
+        """
+        returns the BAMs of this call for ``blacktie-stage``.
+        """
+        return Bunch({'call_inputs':[self.accepted_hits],
+                      'references':[],
+                      'indexes':[]})
+
+    def get_out_dir(self):
+        """
+        Handles ``yaml_config.bam_stats_options.out: from_conditions``.
+        """
+        option = self.prog_yargs.out
         if option == 'from_conditions':
-            lt_reads = self._conditions['left_reads']
-            return "%s" % (','.join(lt_reads))
+            return self.build_out_dir_path()
         else:
             return option
 
-    def get_rt_reads(self):
+    def get_accepted_hits(self):
         """
-        Handles ``yaml_config.tophat_options.positional_args.right_reads: from_conditions``.
+        Handles ``yaml_config.bam_stats_options.positional_args.accepted_hits: from_conditions``.
         """
-        option = self.prog_yargs.positional_args.right_reads
+        option = self.prog_yargs.positional_args.accepted_hits
         if option == 'from_conditions':
-            rt_reads = self._conditions['right_reads']
-            return "%s" % (','.join(rt_reads))
+            return self.get_bam_path()
         else:
             return option
 
+    def get_upstream_call_ids(self):
+        """
+        returns the call id of the tophat call that makes this call's ``accepted_hits.bam``.
+        """
+        return [build_call_id(TophatCall.prog_name,self._conditions)]
+
+    def get_bam_path(self):
+        """
+        Supports ``self.get_accepted_hits()``.
+        """
+        th_call_id = build_call_id(TophatCall.prog_name,self._conditions)
+        try:
+            th_call = self.yargs.call_records[th_call_id]
+            bam_path = "%s/accepted_hits.bam" % (th_call.out_dir.rstrip('/'))
+        except (KeyError,AttributeError) as exp:
+            msg = "WARNING: unable to find matching tophat call record in memory for condition: %s\nAttempting to find corresponding tophat outfile in your base_dir." \
+                % (self.get_condition_id(self._conditions))
+            self.log_msg(log_msg=msg)
+
+            bam_path = output_path(self.yargs,th_call_id,'accepted_hits.bam')
+            if not os.path.exists(bam_path) and self.mode == 'analyze':
+                raise errors.MissingArgumentError("I could not find an appropriate accepted_hits.bam file. Failed to find: %s" \
+                                                  % (bam_path))
+        return bam_path
+
 
 class CufflinksCall(BaseCall):
     """
     Manage a single call to cufflinks and store associated run data.
     """
+    prog_name = 'cufflinks'
 
     def __init__(self,yargs,email_info,run_id,run_logs,conditions,mode):
         """
@@ -463,8 +872,6 @@ class CufflinksCall(BaseCall):
         .. todo:: **DONE** add support for --GTF in addition to currently supported --GTF-guide
         """
 
-        self.prog_name = 'cufflinks'
-
         BaseCall.__init__(self,yargs,email_info,run_id,run_logs,conditions,mode)
 
         self.prog_yargs = self.yargs.cufflinks_options
@@ -486,9 +893,17 @@ class CufflinksCall(BaseCall):
         # now the positional args
         self.accepted_hits = self.get_accepted_hits() 
 
-        # combine and save arg_str
+        # combine and save arg_list
         self.options_list.extend([self.accepted_hits])
-        self.arg_str = ' '.join(self.options_list)
+        self.set_arg_list(self.options_list)
+
+    def get_stage_inputs(self):
+        """
+        returns the BAM, annotations, genome and mask file of this call for ``blacktie-stage``.
+        """
+        return Bunch({'call_inputs':[self.accepted_hits],
+                      'references':self.option_paths('GTF-guide','GTF','frag-bias-correct','mask-file'),
+                      'indexes':[]})
 
     def verify_options(self):
         """
@@ -529,35 +944,20 @@ class CufflinksCall(BaseCall):
         """
         Handles ``yaml_config.cufflinks_options.GTF-guide: from_conditions``.
         """
-        option = self.prog_yargs['GTF-guide']
-        if option == 'from_conditions':
-            gtf_path = self._conditions['gtf_annotation']
-            return gtf_path
-        else:
-            return option
+        return resolve_option(self.prog_yargs['GTF-guide'],self._conditions,'gtf_annotation','GTF-guide')
 
     def get_gtf_anno(self):
         """
         Handles ``yaml_config.cufflinks_options.GTF: from_conditions``.
         """
-        option = self.prog_yargs['GTF']
-        if option == 'from_conditions':
-            gtf_path = self._conditions['gtf_annotation']
-            return gtf_path
-        else:
-            return option
+        return resolve_option(self.prog_yargs['GTF'],self._conditions,'gtf_annotation','GTF')
 
 
     def get_genome(self):
         """
         Handles ``yaml_config.cufflinks_options.frag-bias-correct: from_conditions``.
         """
-        option = self.prog_yargs['frag-bias-correct']
-        if option == 'from_conditions':
-            genome_path = self._conditions['genome_seq']
-            return genome_path
-        else:
-            return option
+        return self.prepared_reference(resolve_option(self.prog_yargs['frag-bias-correct'],self._conditions,'genome_seq','frag-bias-correct'))
 
     def get_accepted_hits(self):
         """
@@ -570,11 +970,18 @@ class CufflinksCall(BaseCall):
         else:
             return option
 
+    def get_upstream_call_ids(self):
+        """
+        returns the call ids of the tophat call that makes this call's ``accepted_hits.bam`` and of the
+        bam_stats call that may flag it (ignored when that stage is not part of the run).
+        """
+        return [build_call_id(TophatCall.prog_name,self._conditions),build_call_id(BamStatsCall.prog_name,self._conditions)]
+
     def get_bam_path(self):
         """
         Supports ``self.get_accepted_hits()``.
         """
-        th_call_id = "tophat_%s" % (self.get_condition_id(self._conditions))
+        th_call_id = build_call_id(TophatCall.prog_name,self._conditions)
         try:
             th_call = self.yargs.call_records[th_call_id]
             th_out_dir = th_call.out_dir
@@ -585,8 +992,7 @@ class CufflinksCall(BaseCall):
             self.log_msg(log_msg=msg)
 
             # try to guess correct tophat out directory
-            base_dir = self.yargs.run_options.base_dir
-            bam_path = "%s/%s/accepted_hits.bam" % (base_dir.rstrip('/'),th_call_id)
+            bam_path = output_path(self.yargs,th_call_id,'accepted_hits.bam')
             if not os.path.exists(bam_path):
                 if self.mode == 'analyze':
                     #: ``.. todo:: build framework to handle this non-fatally``
@@ -602,20 +1008,13 @@ class CufflinksCall(BaseCall):
         """
         Handles ``yaml_config.cufflinks_options.mask-file: from_conditions``.
         """
-        try:
-            option = self.prog_yargs['mask-file']
-            if option == 'from_conditions':
-                mask_path = self._conditions['mask_file']
-                return mask_path
-            else:
-                return option
-        except KeyError:
-            return False
+        return resolve_option(self.prog_yargs.get('mask-file',False),self._conditions,'mask_file','mask-file')
         
 class CuffmergeCall(BaseCall):
     """
     Manage a single call to cuffmerge and store associated run data.
     """
+    prog_name = 'cuffmerge'
 
     def __init__(self,yargs,email_info,run_id,run_logs,conditions,mode):
         """
@@ -631,8 +1030,6 @@ class CuffmergeCall(BaseCall):
         :returns: an initialized ``CuffmergeCall`` object
         """
 
-        self.prog_name = 'cuffmerge'
-
         BaseCall.__init__(self,yargs,email_info,run_id,run_logs,conditions,mode)
 
         self.prog_yargs = self.yargs.cuffmerge_options
@@ -651,9 +1048,9 @@ class CuffmergeCall(BaseCall):
         # now the positional args
         assembly_list = self.get_cufflinks_gtfs()
 
-        # combine and save arg_str
+        # combine and save arg_list
         self.options_list.extend([assembly_list])
-        self.arg_str = ' '.join(self.options_list)
+        self.set_arg_list(self.options_list)
 
     def get_out_dir(self):
         """
@@ -669,35 +1066,13 @@ class CuffmergeCall(BaseCall):
         """
         Handles ``yaml_config.cuffmerge_options.ref-gtf: from_conditions``.
         """
-        option = self.prog_yargs['ref-gtf']
-        if option == 'from_conditions':
-            # Make sure all conditions agree on anno.gtf
-            gtf_path = set([c['gtf_annotation'] for c in self._conditions])
-            if len(gtf_path) == 1:
-                gtf_path = gtf_path.pop()
-            else:
-                raise errors.InvalidFileFormatError('CHECK YAML CONFIG FILE: Conditions in experiment %s do not agree on which "ref-gtf" to use: %s.' \
-                                                    % (self.experiment_id,gtf_path))
-            return gtf_path
-        else:
-            return option
+        return resolve_option(self.prog_yargs['ref-gtf'],self._conditions,'gtf_annotation','ref-gtf')
 
     def get_genome(self):
         """
         Handles ``yaml_config.cuffmerge_options.ref-sequence: from_conditions``.
         """
-        option = self.prog_yargs['ref-sequence']
-        if option == 'from_conditions':
-            # Make sure all conditions agree on their genome seq
-            genome_path = set([c['genome_seq'] for c in self._conditions])
-            if len(genome_path) == 1:
-                genome_path = genome_path.pop()
-            else:
-                raise errors.InvalidFileFormatError('CHECK YAML CONFIG FILE: Conditions in experiment %s do not agree on which "ref-sequence" to use: %s.' \
-                                                    % (self.experiment_id,genome_path))
-            return genome_path
-        else:
-            return option
+        return self.prepared_reference(resolve_option(self.prog_yargs['ref-sequence'],self._conditions,'genome_seq','ref-sequence'))
 
     def get_cufflinks_gtfs(self):
         """
@@ -723,11 +1098,25 @@ class CuffmergeCall(BaseCall):
         else:
             return option
 
+    def get_upstream_call_ids(self):
+        """
+        returns the call ids of the cufflinks calls whose ``transcripts.gtf`` files are merged.
+        """
+        return [build_call_id(CufflinksCall.prog_name,c) for c in self._conditions]
+
+    def get_stage_inputs(self):
+        """
+        returns the reference annotation and genome of this call for ``blacktie-stage``.
+        """
+        return Bunch({'call_inputs':[],
+                      'references':self.option_paths('ref-gtf','ref-sequence'),
+                      'indexes':[]})
+
     def get_cuffGTF_path(self,condition):
         """
         Supports ``self.get_cufflinks_gtfs()``.
         """
-        cl_call_id = "cufflinks_%s" % (self.get_condition_id(condition))
+        cl_call_id = build_call_id(CufflinksCall.prog_name,condition)
         try:
             cl_call = self.yargs.call_records[cl_call_id]
             cl_out_dir = cl_call.out_dir
@@ -738,8 +1127,7 @@ class CuffmergeCall(BaseCall):
             self.log_msg(log_msg=msg)
 
             # try to guess correct cufflinks out directory
-            base_dir = self.yargs.run_options.base_dir
-            gtf_path = "%s/%s/transcripts.gtf" % (base_dir.rstrip('/'),cl_call_id)
+            gtf_path = output_path(self.yargs,cl_call_id,'transcripts.gtf')
             if not os.path.exists(gtf_path):
                 if self.mode == 'analyze':
                     #: .. todo:: build framework to handle this non-fatally
@@ -756,6 +1144,7 @@ class CuffdiffCall(BaseCall):
     """
     Manage a single call to cuffdiff and store associated run data.
     """
+    prog_name = 'cuffdiff'
 
     def __init__(self,yargs,email_info,run_id,run_logs,conditions,mode):
         """
@@ -771,8 +1160,6 @@ class CuffdiffCall(BaseCall):
         :returns: an initialized ``CuffdiffCall`` object
         """
 
-        self.prog_name = 'cuffdiff'
-
         BaseCall.__init__(self,yargs,email_info,run_id,run_logs,conditions,mode)
 
         self.prog_yargs = self.yargs.cuffdiff_options
@@ -797,12 +1184,24 @@ class CuffdiffCall(BaseCall):
         self.construct_options_list()
 
         # now the positional args
-        transcripts_gtf = self.get_cuffmerge_gtf()  
-        sample_bams = self.get_sample_bams()
+        self.transcripts_gtf = self.get_cuffmerge_gtf()  
+        self.sample_bams = self.get_sample_bams()
+
+        # combine and save arg_list
+        self.options_list.append(self.transcripts_gtf)
+        self.options_list.extend(self.sample_bams)
+        self.set_arg_list(self.options_list)
 
-        # combine and save arg_str
-        self.options_list.extend([transcripts_gtf,sample_bams])
-        self.arg_str = ' '.join(self.options_list)
+    def get_stage_inputs(self):
+        """
+        returns the BAMs, merged annotation, genome and mask file of this call for ``blacktie-stage``.
+        """
+        bams = []
+        for arg in self.sample_bams:
+            bams.extend(arg.split(','))
+        return Bunch({'call_inputs':bams + [self.transcripts_gtf],
+                      'references':self.option_paths('frag-bias-correct','mask-file'),
+                      'indexes':[]})
 
     def get_out_dir(self):
         """
@@ -818,22 +1217,13 @@ class CuffdiffCall(BaseCall):
         """
         Handles ``yaml_config.cuffdiff_options.frag-bias-correct: from_conditions``.
         """
-        option = self.prog_yargs['frag-bias-correct']
-        if option == 'from_conditions':
-            # Make sure all conditions agree on their genome seq
-            genome_path = set([c['genome_seq'] for c in self._conditions])
-            if len(genome_path) == 1:
-                genome_path = genome_path.pop()
-            else:
-                raise errors.InvalidFileFormatError('CHECK YAML CONFIG FILE: Conditions in experiment %s do not agree on which "ref-sequence" to use: %s.' \
-                                                    % (self.experiment_id,genome_path))
-            return genome_path
-        else:
-            return option
+        return self.prepared_reference(resolve_option(self.prog_yargs['frag-bias-correct'],self._conditions,'genome_seq','frag-bias-correct'))
 
     def get_sample_bams(self):
         """
         Handles ``yaml_config.cuffdiff_options.positional_args.sample_bams: from_conditions``.
+
+        :returns: list with one argument per condition; bio-replicate bams are joined by commas
         """
         
         def join_replicate_paths(top_level_conditions,paths):
@@ -861,15 +1251,24 @@ class CuffdiffCall(BaseCall):
             top_level_conditions = ['_'.join(  path.split('/')[-2].split('_')[:-1]  ) for path in paths]
             top_level_conditions = uniques(top_level_conditions)
             joined_replicate_paths = join_replicate_paths(top_level_conditions,paths)
-            return ' '.join(joined_replicate_paths)
+            return joined_replicate_paths
         else:
-            return option
+            return option.split()
+
+    def get_upstream_call_ids(self):
+        """
+        returns the call ids of the cuffmerge call and the tophat calls this call reads from (and of the
+        bam_stats calls that may flag their BAMs).
+        """
+        return ([build_call_id(CuffmergeCall.prog_name,self._conditions)] +
+                [build_call_id(TophatCall.prog_name,c) for c in self._conditions] +
+                [build_call_id(BamStatsCall.prog_name,c) for c in self._conditions])
 
     def get_bam_path(self,condition):
         """
         Supports ``self.get_sample_bams()``.
         """
-        th_call_id = "tophat_%s" % (self.get_condition_id(condition))
+        th_call_id = build_call_id(TophatCall.prog_name,condition)
         try:
             th_call = self.yargs.call_records[th_call_id]
             th_out_dir = th_call.out_dir
@@ -880,8 +1279,7 @@ class CuffdiffCall(BaseCall):
             self.log_msg(log_msg=msg)
 
             # try to guess correct tophat out directory
-            base_dir = self.yargs.run_options.base_dir
-            bam_path = "%s/%s/accepted_hits.bam" % (base_dir.rstrip('/'),th_call_id)
+            bam_path = output_path(self.yargs,th_call_id,'accepted_hits.bam')
             if not os.path.exists(bam_path):
                 if self.mode == 'analyze':
                     #: .. todo:: build framework to handle this non-fatally
@@ -898,21 +1296,7 @@ class CuffdiffCall(BaseCall):
         """
         Handles ``yaml_config.cuffdiff_options.mask-file: from_conditions``.
         """
-        try:
-            option = self.prog_yargs['mask-file']
-            if option == 'from_conditions':
-                # Make sure all conditions agree on their mask-file
-                mask_path = set([c['mask_file'] for c in self._conditions])
-                if len(mask_path) == 1:
-                    mask_path = mask_path.pop()
-                else:
-                    raise errors.InvalidFileFormatError('CHECK YAML CONFIG FILE: Conditions in experiment %s do not agree on which "ref-sequence" to use: %s.' \
-                                                        % (self.experiment_id,mask_path))
-                return mask_path
-            else:
-                return option
-        except KeyError:
-            return False
+        return resolve_option(self.prog_yargs.get('mask-file',False),self._conditions,'mask_file','mask-file')
         
     def get_labels(self):
         """
@@ -932,7 +1316,7 @@ class CuffdiffCall(BaseCall):
         """
         Handles ``yaml_config.cuffdiff_options.positional_args.transcripts_gtf: from_conditions``.
         """
-        cm_call_id = self.call_id.replace('cuffdiff','cuffmerge')
+        cm_call_id = build_call_id(CuffmergeCall.prog_name,self._conditions)
         try:
             cm_call = self.yargs.call_records[cm_call_id]
             cm_out_dir = cm_call.out_dir
@@ -943,8 +1327,7 @@ class CuffdiffCall(BaseCall):
             self.log_msg(log_msg=msg)
 
             # try to guess correct cuffmerge out directory
-            base_dir = self.yargs.run_options.base_dir
-            gtf_path = "%s/%s/merged.gtf" % (base_dir.rstrip('/'),cm_call_id)
+            gtf_path = output_path(self.yargs,cm_call_id,'merged.gtf')
             if not os.path.exists(gtf_path):
                 if self.mode == 'analyze':
                     #: .. todo:: build framework to handle this non-fatally
@@ -961,6 +1344,7 @@ class CummerbundCall(BaseCall):
     """
     Manage a single call to blacktie-cummerbund script and store associated run data.
     """
+    prog_name = 'blacktie-cummerbund'
 
     def __init__(self,yargs,email_info,run_id,run_logs,conditions,mode):
         """
@@ -976,8 +1360,6 @@ class CummerbundCall(BaseCall):
         :returns: an initialized ``CummerbundCall`` object
         """
 
-        self.prog_name = 'blacktie-cummerbund'
-
         BaseCall.__init__(self,yargs,email_info,run_id,run_logs,conditions,mode)
 
         self.prog_yargs = self.yargs.cummerbund_options
@@ -1001,14 +1383,20 @@ class CummerbundCall(BaseCall):
         self.construct_options_list()
 
 
-        # combine and save arg_str
-        self.arg_str = ' '.join(self.options_list)
+        # combine and save arg_list
+        self.set_arg_list(self.options_list)
+
+    def get_upstream_call_ids(self):
+        """
+        returns the call ids of the cuffdiff and cuffmerge calls this call reads from.
+        """
+        return [build_call_id(CuffdiffCall.prog_name,self._conditions),build_call_id(CuffmergeCall.prog_name,self._conditions)]
 
     def get_cuffdiff_dir(self):
         """
         Handles ``yaml_config.cummerbund_options.cuffdiff-dir: from_conditions``.
         """
-        cd_call_id = self.call_id.replace('blacktie-cummerbund','cuffdiff')
+        cd_call_id = build_call_id(CuffdiffCall.prog_name,self._conditions)
         try:
             cd_call = self.yargs.call_records[cd_call_id]
             cd_out_dir = cd_call.out_dir
@@ -1019,8 +1407,7 @@ class CummerbundCall(BaseCall):
             self.log_msg(log_msg=msg)
 
             # try to guess correct cuffmerge out directory
-            base_dir = self.yargs.run_options.base_dir
-            cuffdiff_dir = "%s/%s" % (base_dir.rstrip('/'),cd_call_id)
+            cuffdiff_dir = output_path(self.yargs,cd_call_id)
             if not os.path.exists(cuffdiff_dir):
                 if self.mode == 'analyze':
                     #: .. todo:: build framework to handle this non-fatally
@@ -1046,7 +1433,7 @@ class CummerbundCall(BaseCall):
         """
         Handles ``yaml_config.cummerbund_options.gtf-path: from_conditions``.
         """
-        cm_call_id = self.call_id.replace('blacktie-cummerbund','cuffmerge')
+        cm_call_id = build_call_id(CuffmergeCall.prog_name,self._conditions)
         try:
             cm_call = self.yargs.call_records[cm_call_id]
             cm_out_dir = cm_call.out_dir
@@ -1057,8 +1444,7 @@ class CummerbundCall(BaseCall):
             self.log_msg(log_msg=msg)
 
             # try to guess correct cuffmerge out directory
-            base_dir = self.yargs.run_options.base_dir
-            gtf_path = "%s/%s/merged.gtf" % (base_dir.rstrip('/'),cm_call_id)
+            gtf_path = output_path(self.yargs,cm_call_id,'merged.gtf')
             if not os.path.exists(gtf_path):
                 if self.mode == 'analyze':
                     #: .. todo:: build framework to handle this non-fatally
@@ -0,0 +1,125 @@
+#*****************************************************************************
+#  channel.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+channel.py
+####################
+Code defining a pipe that many processes can send json messages to and one
+thread in the main process reads from.
+
+The pipe is created before any worker is forked.  Each message is cut into
+frames no larger than ``PIPE_BUF`` so that every frame reaches the pipe in a
+single atomic ``os.write()``: frames from different processes may alternate
+but never mix, and nothing is lost if a worker exits with ``os._exit()``.
+"""
+import os
+import json
+import select
+import struct
+import itertools
+
+
+_frame_header = struct.Struct('!IIIB') # pid, message number, payload length, last-frame flag
+_frame_size = getattr(select,'PIPE_BUF',512)
+_max_payload = _frame_size - _frame_header.size
+
+
+class MessagePipe(object):
+    """
+    Carries json-serializable messages from any process of a run to a reader in the process that created it.
+    """
+    def __init__(self):
+        """
+        initializes a ``MessagePipe`` object
+
+        :returns: an initialized ``MessagePipe`` object
+        """
+        self._owner_pid = os.getpid()
+        self._msg_numbers = itertools.count()
+        self._read_fd,self._write_fd = os.pipe()
+        self._partial = {}
+
+    def __getstate__(self):
+        """
+        keeps only the sending end so objects holding this pipe can be pickled by ``pprocess``.
+        """
+        return {'_owner_pid':self._owner_pid,
+                '_write_fd':self._write_fd}
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._msg_numbers = itertools.count()
+
+    def is_owner(self):
+        """
+        returns ``True`` in the process that created the pipe (the only one that may read it).
+        """
+        return os.getpid() == self._owner_pid
+
+    # ++++++++ sending (any process) ++++++++
+    def send(self,message):
+        """
+        frames ``message`` and writes it to the pipe one atomic frame at a time.
+        """
+        try:
+            payload = json.dumps(message)
+        except UnicodeDecodeError:
+            # tool output is not always valid utf-8
+            payload = json.dumps(message,encoding='latin-1')
+        if isinstance(payload,unicode):
+            payload = payload.encode('utf-8')
+        pid = os.getpid()
+        msg_number = self._msg_numbers.next() & 0xffffffff
+        offset = 0
+        while True:
+            chunk = payload[offset:offset + _max_payload]
+            offset += len(chunk)
+            last = int(offset >= len(payload))
+            os.write(self._write_fd,_frame_header.pack(pid,msg_number,len(chunk),last) + chunk)
+            if last:
+                break
+
+    # ++++++++ receiving (owner process only) ++++++++
+    def _read_exactly(self,size):
+        data = []
+        while size:
+            chunk = os.read(self._read_fd,size)
+            if not chunk:
+                raise EOFError('message pipe closed')
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def receive(self,timeout=None):
+        """
+        waits up to ``timeout`` seconds for the next complete message.
+
+        :returns: the decoded message or ``None`` if none was completed before ``timeout``
+        """
+        while True:
+            ready = select.select([self._read_fd],[],[],timeout)[0]
+            if not ready:
+                return None
+            pid,msg_number,length,last = _frame_header.unpack(self._read_exactly(_frame_header.size))
+            chunk = self._read_exactly(length)
+            key = (pid,msg_number)
+            if last:
+                return json.loads(''.join(self._partial.pop(key,[]) + [chunk]))
+            self._partial.setdefault(key,[]).append(chunk)
+
+    def close(self):
+        """
+        closes both ends of the pipe (owner process only).
+        """
+        os.close(self._write_fd)
+        os.close(self._read_fd)
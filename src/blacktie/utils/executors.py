@@ -0,0 +1,393 @@
+#*****************************************************************************
+#  executors.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+executors.py
+####################
+Code defining where the calls of a run are carried out.
+
+``BaseCall.execute()`` hands every call to the run's executor:
+
+* ``LocalExecutor`` runs the program on this machine (``--mode analyze``),
+* ``DryRunExecutor`` prints its command line (``--mode dry_run``),
+* ``ScriptExecutor`` writes its qsub script (``--mode qsub_script``), and
+* ``ClusterExecutor`` writes its script and, once every stage has been
+  written, submits the whole call graph to SGE or SLURM with dependencies
+  and follows the jobs until they finish (``--mode analyze --executor sge``
+  or ``--executor slurm``).
+
+The ``ClusterExecutor`` learns a call's state from the ``<call_id>.start``
+and ``<call_id>.exit`` files the scripts write under ``<run_logs>/status``
+and from the scheduler's queue listing, and records it the same way a local
+call does: in the run metrics, the event log, the call's log file and the
+notification emails.  When a call fails, the calls the scheduler holds on
+it are cancelled and recorded as failed (on SGE the failed job itself waits
+in its error state, so it is removed from the queue as well).
+"""
+import os
+import sys
+import time
+import getpass
+
+from blacktie.utils.externals import mkdirp,runExternalApp
+from blacktie.utils.qsub import QsubScriptWriter,SCHEDULERS,template_cache_dir,array_job_stages,cancel_args
+from blacktie.utils import errors
+
+
+EXECUTORS = ['local','sge','slurm']
+
+# polls in a row without a queue listing or a finished call before the rest of the calls are given up on
+MAX_BLIND_POLLS = 30
+
+
+class BaseExecutor(object):
+    """
+    Defines the methods every executor provides.
+    """
+    name = None
+
+    def execute(self,call):
+        """
+        carries out ``call`` (a ``BaseCall`` whose ``cmd_string`` is set).
+        """
+        raise NotImplementedError()
+
+    def end_stage(self,prog_name):
+        """
+        told when every call of ``prog_name`` has been handed over.
+        """
+        pass
+
+    def close(self):
+        """
+        finishes anything still outstanding; returns once the run's calls are done with.
+        """
+        pass
+
+
+class LocalExecutor(BaseExecutor):
+    """
+    Runs each call's program on this machine and waits for it.
+    """
+    name = 'local'
+
+    def execute(self,call):
+        call.run()
+
+
+class DryRunExecutor(BaseExecutor):
+    """
+    Prints each call's command line without running it.
+    """
+    name = 'dry_run'
+
+    def execute(self,call):
+        print call.cmd_string + '\n'
+
+
+class ScriptExecutor(BaseExecutor):
+    """
+    Writes each call's qsub script through a ``QsubScriptWriter``.
+    """
+    name = 'qsub_script'
+
+    def __init__(self,writer=None,submit=False):
+        """
+        initializes a ``ScriptExecutor`` object
+
+        :param writer: the run's ``QsubScriptWriter`` (``None`` writes each script to the current directory)
+        :param submit: submit the scripts with their dependencies once they are all written
+
+        :returns: an initialized ``ScriptExecutor`` object
+        """
+        self.writer = writer
+        self.submit = submit
+
+    def execute(self,call):
+        call.build_qsub()
+
+    def end_stage(self,prog_name):
+        if self.writer is not None:
+            self.writer.end_stage(prog_name)
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        if self.submit:
+            self.writer.submit()
+
+
+class ClusterExecutor(ScriptExecutor):
+    """
+    Submits the run's calls to SGE or SLURM and follows them until they finish.
+    """
+    def __init__(self,writer,scheduler,poll_interval=60,status_command=None,cancel_command=None):
+        """
+        initializes a ``ClusterExecutor`` object
+
+        :param writer: the run's ``QsubScriptWriter``; it must have a ``status_dir``
+        :param scheduler: 'sge' or 'slurm'
+        :param poll_interval: seconds between looks at the queue
+        :param status_command: program listing the queued jobs (default ``qstat`` or ``squeue``)
+        :param cancel_command: program removing a job from the queue (default ``qdel`` or ``scancel``)
+
+        :returns: an initialized ``ClusterExecutor`` object
+        """
+        ScriptExecutor.__init__(self,writer,submit=True)
+        self.name = scheduler
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.status_command = status_command or SCHEDULERS[scheduler]['status_command']
+        self.cancel_command = cancel_command or SCHEDULERS[scheduler]['cancel_command']
+        self.status_dir = writer.status_dir
+        self.calls = {}
+        mkdirp(self.status_dir)
+
+    def execute(self,call):
+        call.build_qsub()
+        self.calls[call.call_id] = call
+        call.update_metrics('queued')
+
+    def close(self):
+        """
+        submits every written script and waits for all of the calls to finish.
+        """
+        self.writer.close()
+        if not self.writer.jobs:
+            return
+        jobs = self.writer.submit()
+        for job in jobs:
+            for call_id in job.call_ids:
+                self.calls[call_id].log_event('call_submitted',job_id=job.job_id,scheduler=self.scheduler)
+        self.wait(jobs)
+
+    def queued_job_ids(self):
+        """
+        returns the ids of this user's jobs the scheduler still lists, or ``None`` if it could not be asked.
+        """
+        if self.scheduler == 'slurm':
+            arg_list = ['-h','-o','%F','-u',getpass.getuser()]
+        else:
+            arg_list = []
+        try:
+            stdout,stderr = runExternalApp(progName=self.status_command,argList=arg_list)
+        except errors.SystemCallError as exc:
+            sys.stderr.write("Warning: unable to list queued jobs with %s: %s\n" % (self.status_command,exc))
+            return None
+
+        job_ids = set()
+        for line in stdout.split('\n'):
+            fields = line.split()
+            if fields and fields[0].split('_')[0].isdigit():
+                job_ids.add(fields[0].split('_')[0])
+        return job_ids
+
+    def read_exit_status(self,call_id):
+        """
+        returns the exit status the script recorded for ``call_id`` or ``None`` if it has not finished.
+        """
+        try:
+            return int(open('%s/%s.exit' % (self.status_dir,call_id)).read().strip())
+        except (IOError,ValueError):
+            return None
+
+    def wait(self,jobs):
+        """
+        polls the status files and the queue until every call of ``jobs`` has finished or left the queue.
+
+        If the queue cannot be listed for ``MAX_BLIND_POLLS`` polls in a row while no call finishes, the
+        calls still pending are marked failed (a job that died without writing its exit file would
+        otherwise be waited for forever).
+        """
+        pending = {}
+        for job in jobs:
+            for call_id in job.call_ids:
+                pending[call_id] = job
+        started = set()
+        blind_polls = 0
+
+        while pending:
+            # ask the queue first so a job leaving it after we look still has its exit file read below
+            in_queue = self.queued_job_ids()
+            still_pending = len(pending)
+            for call_id,job in sorted(pending.items()):
+                call = self.calls[call_id]
+                returncode = self.read_exit_status(call_id)
+                if call_id not in started and (returncode is not None or os.path.exists('%s/%s.start' % (self.status_dir,call_id))):
+                    started.add(call_id)
+                    self.on_call_start(call,job)
+                if returncode is not None:
+                    self.on_call_end(call,job,returncode)
+                    del pending[call_id]
+                    if returncode != 0 and SCHEDULERS[self.scheduler]['failed_status'] is not None:
+                        # the failed job waits in its error state, holding the jobs that depend on it
+                        self.cancel(call_id,in_queue)
+
+            for call_id,(job,upstream_call_id) in sorted(self.blocked_calls(pending).items()):
+                self.cancel(call_id,in_queue)
+                self.on_call_end(self.calls[call_id],job,None,
+                                 reason="%s job %s was cancelled: %s, which it depends on, failed."
+                                 % (self.scheduler,job.job_id,upstream_call_id))
+                del pending[call_id]
+
+            for call_id,job in sorted(pending.items()):
+                call = self.calls[call_id]
+                if in_queue is not None and job.job_id not in in_queue:
+                    # the job ended without the program returning (killed, failed dependency, node lost)
+                    self.on_call_end(call,job,None)
+                    del pending[call_id]
+
+            if in_queue is None and len(pending) == still_pending:
+                blind_polls += 1
+            else:
+                blind_polls = 0
+            if pending and blind_polls >= MAX_BLIND_POLLS:
+                sys.stderr.write("Warning: %s could not list the queue %s times in a row; giving up on %s unfinished calls.\n"
+                                 % (self.status_command,blind_polls,len(pending)))
+                for call_id,job in sorted(pending.items()):
+                    self.on_call_end(self.calls[call_id],job,None,
+                                     reason="gave up following %s job %s: %s could not list the queue; the job may still be running."
+                                     % (self.scheduler,job.job_id,self.status_command))
+                pending = {}
+            if pending:
+                time.sleep(self.poll_interval)
+
+        failed = [c for c in self.calls.values() if c.returncode != 0]
+        sys.stdout.write('[Note] %s of %s cluster calls finished successfully.\n\n' % (len(self.calls) - len(failed),len(self.calls)))
+
+    def blocked_calls(self,pending):
+        """
+        returns the calls in ``pending`` that can not run any more because a job the scheduler
+        holds them on failed, as ``{call_id: (job, id of the failed upstream call)}``.
+        """
+        failed = set([c.call_id for c in self.calls.values() if c.call_id not in pending and c.returncode != 0])
+        blocked = {}
+        changed = True
+        while changed:
+            changed = False
+            for call_id,job in pending.items():
+                if call_id in blocked:
+                    continue
+                job,task = self.writer.job_of_call(call_id)
+                after,after_tasks = self.writer.upstream_jobs(job)
+                upstream = [c for j in after for c in j.call_ids] + [j.call_ids[task] for j in after_tasks]
+                failed_upstream = [c for c in upstream if c in failed]
+                if failed_upstream:
+                    blocked[call_id] = (job,failed_upstream[0])
+                    failed.add(call_id)
+                    changed = True
+        return blocked
+
+    def cancel(self,call_id,in_queue):
+        """
+        removes the job (or the array job task) running ``call_id`` from the queue if it is still listed.
+        """
+        job,task = self.writer.job_of_call(call_id)
+        if in_queue is not None and job.job_id not in in_queue:
+            return
+        try:
+            runExternalApp(progName=self.cancel_command,argList=cancel_args(self.scheduler,job.job_id,task + 1 if job.array else None))
+        except errors.SystemCallError as exc:
+            sys.stderr.write("Warning: unable to cancel %s job %s with %s: %s\n" % (self.scheduler,job.job_id,self.cancel_command,exc))
+
+    def on_call_start(self,call,job):
+        """
+        records that ``call`` started running as part of ``job``.
+        """
+        call.update_metrics('running')
+        call.log_event('call_start',argv=[call.prog_name] + call.arg_list,out_dir=call.out_dir,job_id=job.job_id)
+        call.log_start()
+        call.notify_start_of_call()
+
+    def on_call_end(self,call,job,returncode,reason=None):
+        """
+        records how ``call`` ended: ``returncode`` is the program's exit status, or ``None`` if the
+        job left the queue without the program returning (or was given up on, as ``reason`` says).
+        """
+        call.returncode = returncode
+        call.stdout_msg = ''
+        if reason is not None:
+            call.stderr_msg = reason
+        elif returncode is None:
+            call.stderr_msg = "%s job %s left the queue before %s returned; see the job's stderr file." \
+                % (self.scheduler,job.job_id,call.call_id)
+        else:
+            call.stderr_msg = "%s job %s: %s exited with status %s; see the job's stderr file." \
+                % (self.scheduler,job.job_id,call.prog_name,returncode)
+        call.log_end()
+        if returncode == 0:
+            call.update_metrics('done')
+            call.log_event('call_end',status='done',job_id=job.job_id)
+        else:
+            call.update_metrics('failed')
+            call.log_event('call_end',status='failed',returncode=returncode,job_id=job.job_id)
+        call.notify_end_of_call()
+
+
+_default_executors = {'analyze':LocalExecutor(),
+                      'dry_run':DryRunExecutor(),
+                      'qsub_script':ScriptExecutor()}
+
+def default_executor(mode):
+    """
+    returns the executor used for calls made outside of ``run_pipeline()`` in ``mode``.
+    """
+    try:
+        return _default_executors[mode]
+    except KeyError:
+        raise errors.InvalidOptionError(mode,'mode',sorted(_default_executors.keys()))
+
+
+def build_executor(yargs,mode,executor,run_id,run_logs,submit=False):
+    """
+    builds the executor for a run.
+
+    :param yargs: argument tree generated by parsing the yaml config file
+    :param mode: the ``--mode`` choice
+    :param executor: the ``--executor`` choice; 'sge' or 'slurm' only change 'analyze' and 'qsub_script' runs
+    :param run_id: id for the whole set of calls
+    :param run_logs: the directory where log files for this run are put
+    :param submit: in 'qsub_script' mode, submit the scripts once they are written
+    """
+    if executor not in EXECUTORS:
+        raise errors.InvalidOptionError(executor,'executor',EXECUTORS)
+    if mode == 'dry_run' or (mode == 'analyze' and executor == 'local'):
+        return default_executor(mode)
+    if mode not in ['analyze','qsub_script']:
+        raise errors.InvalidOptionError(mode,'mode',sorted(_default_executors.keys()))
+
+    qsub_options = yargs.qsub_options
+    if executor == 'local':
+        scheduler = qsub_options.get('scheduler') or 'sge'
+    else:
+        scheduler = executor
+
+    # compile the qsub template once and write the scripts together under run_logs
+    if mode == 'analyze':
+        status_dir = '%s/status' % (run_logs)
+    else:
+        status_dir = None
+    writer = QsubScriptWriter(qsub_options.template,'%s/qsub' % (run_logs),
+                              module_directory=template_cache_dir(),
+                              array_stages=array_job_stages(qsub_options.get('array_jobs')),
+                              run_id=run_id,
+                              scheduler=scheduler,
+                              submit_command=qsub_options.get('submit_command') or None,
+                              status_dir=status_dir)
+    if mode == 'analyze':
+        return ClusterExecutor(writer,scheduler,
+                               poll_interval=qsub_options.get('poll_interval') or 60,
+                               status_command=qsub_options.get('status_command') or None,
+                               cancel_command=qsub_options.get('cancel_command') or None)
+    return ScriptExecutor(writer,submit=submit)
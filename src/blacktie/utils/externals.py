@@ -19,8 +19,10 @@ Code facilitating the execution of external system calls.
 
 
 import subprocess
+import threading
 import os
 import sys
+import re
 
 from blacktie.utils.errors import *
 
@@ -34,6 +36,67 @@ def whereis(program):
             return os.path.join(path, program)
     return None
 
+_resolved_tools = {}
+
+def resolve_tool(program):
+    """
+    returns the path of ``program`` like ``whereis()`` but only scans ``$PATH`` the first time a program is asked for.
+    """
+    try:
+        return _resolved_tools[program]
+    except KeyError:
+        path = whereis(program)
+        if path:
+            _resolved_tools[program] = path
+        return path
+
+# arguments that make each program print its version without doing any work
+tool_version_args = {'tophat':['--version'],
+                     'bowtie2':['--version'],
+                     'cufflinks':[],
+                     'cuffmerge':['--version'],
+                     'cuffdiff':[],
+                     'samtools':[],
+                     'blacktie-cummerbund':['--version']}
+
+_version_regex = re.compile(r'v?\d+\.\d+(\.\d+)*')
+
+def get_tool_version(program):
+    """
+    runs ``program`` with the arguments in ``tool_version_args`` and returns the first
+    line of its output that looks like a version or ``None`` if that fails.
+    """
+    path = resolve_tool(program)
+    if not path:
+        return None
+    try:
+        process = subprocess.Popen([path] + tool_version_args.get(program,['--version']),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout,stderr = process.communicate()
+    except OSError:
+        return None
+    for line in (stdout + '\n' + stderr).split('\n'):
+        if _version_regex.search(line):
+            return line.strip()
+    return None
+
+def resolve_tools(programs):
+    """
+    resolves and caches the path and version of each program in ``programs``.
+
+    :param programs: iterable of program names
+    :returns: dict of program name -> ``(path, version)`` (``(None, None)`` if not found)
+    """
+    tools = {}
+    for program in programs:
+        path = resolve_tool(program)
+        if path:
+            tools[program] = (path,get_tool_version(program))
+        else:
+            tools[program] = (None,None)
+    return tools
+
 def mkdirp(path):
     """
     Create new dir while creating any parent dirs in the path as needed.
@@ -50,31 +113,73 @@ def mkdirp(path):
             
 # +++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-def runExternalApp(progName,argStr):
+def _drain(stream,chunks):
+    """
+    reads ``stream`` to EOF into the list ``chunks`` (run in a thread so neither pipe fills up).
+    """
+    while True:
+        chunk = os.read(stream.fileno(),65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+
+def runExternalApp(progName,argStr=None,on_start=None,argList=None,stderr_filter=None):
     """
     Convenience func to handle calling and monitoring output of external programs.
+
+    Give ``argList`` to have the program exec'd directly; ``argStr`` is still accepted
+    and is run through ``/bin/sh`` as before.
     
     :param progName: name of system program command
     :param argStr: string containing command line options for ``progName``
+    :param argList: list of command line arguments for ``progName``
+    :param on_start: optional callable given the ``subprocess.Popen`` object once the program has started
+    :param stderr_filter: optional object with ``feed(chunk)``, ``close()`` and ``getvalue()``
+        (e.g. ``progress.ProgressBarFilter``) that stderr is streamed through as it is written;
+        the returned stderr is ``stderr_filter.getvalue()``
     
-    :returns: subprocess.communicate object
+    :returns: (stdout, stderr) strings as from ``subprocess.communicate``
     """
     
     # Ensure program is callable.
-    progPath = whereis(progName)
+    progPath = resolve_tool(progName)
     if not progPath:
         raise SystemCallError(None,'"%s" command not found in your PATH environmental variable.' % (progName))
     
-    # Construct shell command
-    cmdStr = "%s %s" % (progPath,argStr)
+    # Construct command
+    if argList is not None:
+        cmd = [progPath] + list(argList)
+        use_shell = False
+    else:
+        cmd = "%s %s" % (progPath,argStr)
+        use_shell = True
     
     # Set up process obj
-    process = subprocess.Popen(cmdStr,
-                               shell=True,
+    process = subprocess.Popen(cmd,
+                               shell=use_shell,
+                               close_fds=True,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
+    if on_start is not None:
+        on_start(process)
+
     # Get results
-    result  = process.communicate()
+    if stderr_filter is None:
+        result = process.communicate()
+    else:
+        stdout_chunks = []
+        stdout_reader = threading.Thread(target=_drain,args=(process.stdout,stdout_chunks))
+        stdout_reader.daemon = True
+        stdout_reader.start()
+        while True:
+            chunk = os.read(process.stderr.fileno(),65536)
+            if not chunk:
+                break
+            stderr_filter.feed(chunk)
+        stderr_filter.close()
+        stdout_reader.join()
+        process.wait()
+        result = (''.join(stdout_chunks),stderr_filter.getvalue())
     
     # Check returncode for success/failure
     if process.returncode != 0:
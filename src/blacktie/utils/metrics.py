@@ -0,0 +1,452 @@
+#*****************************************************************************
+#  metrics.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+metrics.py
+####################
+Code to export live run metrics in the Prometheus text format.
+
+Every call records its state in a small json file under ``<run_logs>/metrics``.
+Because the state lives on disk, calls running inside ``pprocess`` workers
+report through the same channel as calls run by the main process.  The
+aggregated metrics are written to a node_exporter "textfile" and/or served
+over a local HTTP endpoint.
+"""
+import os
+import sys
+import atexit
+import json
+import time
+import threading
+
+from blacktie.utils.misc import Bunch
+from blacktie.utils.externals import mkdirp
+
+
+CALL_STATES = ['queued','running','done','failed']
+
+
+def _escape_label(value):
+    """
+    escapes ``value`` for use inside a Prometheus label string.
+    """
+    return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
+
+def _read_meminfo_total():
+    """
+    returns total system memory in bytes or ``None`` if ``/proc/meminfo`` can not be read.
+    """
+    try:
+        for line in open('/proc/meminfo'):
+            if line.startswith('MemTotal:'):
+                return int(line.split()[1]) * 1024
+    except (IOError,ValueError):
+        pass
+    return None
+
+def _cpu_count():
+    """
+    returns the number of cpus on this host (1 if it can not be determined).
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError,NotImplementedError):
+        return 1
+
+def process_tree_rss(pids):
+    """
+    sums the resident memory (in bytes) of each pid in ``pids`` and all of its descendants.
+
+    :param pids: iterable of process ids
+    :returns: resident set size in bytes (0 where ``/proc`` is unavailable)
+    """
+    pids = set([int(p) for p in pids if p])
+    if not pids or not os.path.isdir('/proc'):
+        return 0
+
+    children = {}
+    rss = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            status = open('/proc/%s/status' % (entry)).read()
+        except IOError:
+            continue
+        ppid = 0
+        vm_rss = 0
+        for line in status.split('\n'):
+            if line.startswith('PPid:'):
+                ppid = int(line.split()[1])
+            elif line.startswith('VmRSS:'):
+                vm_rss = int(line.split()[1]) * 1024
+        children.setdefault(ppid,[]).append(int(entry))
+        rss[int(entry)] = vm_rss
+
+    total = 0
+    seen = set()
+    stack = list(pids)
+    while stack:
+        pid = stack.pop()
+        if pid in seen:
+            continue
+        seen.add(pid)
+        total += rss.get(pid,0)
+        stack.extend(children.get(pid,[]))
+    return total
+
+
+class RunMetrics(object):
+    """
+    Tracks call states for a run and renders them as Prometheus metrics.
+    """
+    def __init__(self,state_dir,textfile=None,http_port=None,refresh=15,cores=None,memory_gb=None):
+        """
+        initializes a ``RunMetrics`` object
+
+        :param state_dir: directory where per-call state files are kept
+        :param textfile: path of the node_exporter textfile to keep updated (``None`` to skip)
+        :param http_port: port for a local HTTP endpoint serving the metrics (``None`` to skip)
+        :param refresh: seconds between background re-writes of ``textfile``
+        :param cores: core budget for the run (defaults to the cpu count of this host)
+        :param memory_gb: memory budget for the run in GB (defaults to the total memory of this host)
+
+        :returns: an initialized ``RunMetrics`` object
+        """
+        self.state_dir = state_dir
+        self.textfile = textfile
+        self.http_port = http_port
+        self.refresh = refresh
+        self.cores_budget = cores or _cpu_count()
+        if memory_gb:
+            self.memory_budget = int(float(memory_gb) * 1024**3)
+        else:
+            self.memory_budget = _read_meminfo_total()
+        self._stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._threads = []
+        self._server = None
+        self._last_progress = {}
+        mkdirp(self.state_dir)
+
+    def __getstate__(self):
+        """
+        leaves out the thread machinery so calls holding this object can be pickled by ``pprocess``.
+        """
+        state = self.__dict__.copy()
+        for key in ['_stop','_write_lock','_threads','_server']:
+            del state[key]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._stop = threading.Event()
+        self._write_lock = threading.Lock()
+        self._threads = []
+        self._server = None
+        self._last_progress = {}
+
+    @classmethod
+    def from_yargs(cls,yargs,run_logs):
+        """
+        builds a ``RunMetrics`` object using the options in ``yargs.run_options.metrics``.
+
+        Call states are always recorded so ``blacktie-progress`` can report on the run;
+        the textfile and HTTP endpoint are only used when configured.
+
+        :param yargs: argument tree generated by parsing the yaml config file
+        :param run_logs: the directory where log files for this run are put
+        """
+        opts = yargs.run_options.get('metrics') or {}
+        return cls(state_dir='%s/metrics' % (run_logs.rstrip('/')),
+                   textfile=opts.get('textfile') or None,
+                   http_port=opts.get('http_port') or None,
+                   refresh=opts.get('refresh') or 15,
+                   cores=opts.get('cores') or None,
+                   memory_gb=opts.get('memory_gb') or None)
+
+    # ++++++++ recording state ++++++++
+    def _write_json(self,path,data):
+        """
+        atomically replaces ``path`` with ``data`` encoded as json.
+        """
+        tmp_path = '%s.%s.tmp' % (path,os.getpid())
+        tmp_file = open(tmp_path,'w')
+        json.dump(data,tmp_file)
+        tmp_file.close()
+        os.rename(tmp_path,path)
+
+    def plan(self,tool,count):
+        """
+        records that ``count`` calls of ``tool`` are scheduled for this run.
+        """
+        self._write_json('%s/_planned.%s.json' % (self.state_dir,tool),{'tool':tool,'count':count})
+        self.write_textfile()
+
+    def update_call(self,call_id,tool,state,cores=1,pid=None):
+        """
+        records the current ``state`` of a call; the textfile picks it up on its next refresh.
+
+        :param call_id: the call's ``call_id``
+        :param tool: name of the program being called
+        :param state: one of ``CALL_STATES``
+        :param cores: number of cores the call was told it may use
+        :param pid: pid of the external process if it is running
+        """
+        if state not in CALL_STATES:
+            raise ValueError('state must be one of %s, not %s' % (CALL_STATES,state))
+        path = '%s/%s.json' % (self.state_dir,call_id)
+        try:
+            record = json.load(open(path))
+        except (IOError,ValueError):
+            record = {'call_id':call_id,'tool':tool,'start':None,'end':None}
+
+        now = time.time()
+        if state == 'running' and not record['start']:
+            record['start'] = now
+        elif state in ['done','failed']:
+            record['end'] = now
+        record['state'] = state
+        record['cores'] = cores
+        record['pid'] = pid
+        if state == 'done':
+            record['percent'] = 100.0
+            record['eta'] = 0
+        self._write_json(path,record)
+
+    def update_progress(self,call_id,event,min_interval=1.0):
+        """
+        records a progress event for a running call.
+
+        Events arrive once per line of stderr, so the state file is only re-written
+        when the step changes or at most once every ``min_interval`` seconds.
+
+        :param call_id: the call's ``call_id``
+        :param event: a ``Bunch`` with ``percent``, ``step`` and ``eta`` from ``blacktie.utils.progress``
+        :param min_interval: minimum seconds between writes for the same step
+        """
+        now = time.time()
+        last = self._last_progress.get(call_id)
+        if last is not None and last[1] == event.step and (now - last[0]) < min_interval:
+            return
+        self._last_progress[call_id] = (now,event.step)
+
+        path = '%s/%s.json' % (self.state_dir,call_id)
+        try:
+            record = json.load(open(path))
+        except (IOError,ValueError):
+            return
+        record['percent'] = event.percent
+        record['step'] = event.step
+        record['eta'] = event.eta
+        self._write_json(path,record)
+
+    def _load_records(self):
+        """
+        returns (planned counts by tool, list of call records) read from ``self.state_dir``.
+        """
+        planned = {}
+        records = []
+        for name in os.listdir(self.state_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                data = json.load(open(os.path.join(self.state_dir,name)))
+            except (IOError,ValueError):
+                # file vanished or is mid-replace; the next refresh will see it
+                continue
+            if name.startswith('_planned.'):
+                planned[data['tool']] = data['count']
+            else:
+                records.append(data)
+        return planned,records
+
+    # ++++++++ rendering ++++++++
+    def snapshot(self):
+        """
+        aggregates the current state of the run.
+
+        :returns: ``Bunch`` with ``counts`` (state counts by tool), ``records`` (call records),
+                  ``cores_in_use``, ``memory_in_use`` and ``run_progress`` (0-1 over all planned calls)
+        """
+        planned,records = self._load_records()
+
+        counts = {}
+        for tool in planned:
+            counts[tool] = dict([(s,0) for s in CALL_STATES])
+        for rec in records:
+            tool_counts = counts.setdefault(rec['tool'],dict([(s,0) for s in CALL_STATES]))
+            tool_counts[rec['state']] += 1
+        for tool,tool_counts in counts.iteritems():
+            seen = sum(tool_counts.values())
+            tool_counts['queued'] += max(planned.get(tool,0) - seen, 0)
+
+        running = [r for r in records if r['state'] == 'running']
+        total = sum([sum(c.values()) for c in counts.values()])
+        finished = sum([c['done'] + c['failed'] for c in counts.values()])
+        partial = sum([(r.get('percent') or 0) / 100.0 for r in running])
+        if total:
+            run_progress = (finished + partial) / float(total)
+        else:
+            run_progress = 0.0
+
+        return Bunch({'counts':counts,
+                      'records':records,
+                      'cores_in_use':sum([int(r.get('cores') or 1) for r in running]),
+                      'memory_in_use':process_tree_rss([r.get('pid') for r in running]),
+                      'run_progress':run_progress})
+
+    def render(self):
+        """
+        returns the current metrics as a Prometheus text-format string.
+        """
+        snap = self.snapshot()
+        counts = snap.counts
+        records = snap.records
+        cores_in_use = snap.cores_in_use
+        memory_in_use = snap.memory_in_use
+        now = time.time()
+
+        lines = []
+        lines.append('# HELP blacktie_calls Number of calls per tool in each state.')
+        lines.append('# TYPE blacktie_calls gauge')
+        for tool in sorted(counts):
+            for state in CALL_STATES:
+                lines.append('blacktie_calls{tool="%s",state="%s"} %s' % (_escape_label(tool),state,counts[tool][state]))
+
+        lines.append('# HELP blacktie_cores_in_use Cores requested by running calls.')
+        lines.append('# TYPE blacktie_cores_in_use gauge')
+        lines.append('blacktie_cores_in_use %s' % (cores_in_use))
+        lines.append('# HELP blacktie_cores_budget Cores available to the run.')
+        lines.append('# TYPE blacktie_cores_budget gauge')
+        lines.append('blacktie_cores_budget %s' % (self.cores_budget))
+        lines.append('# HELP blacktie_memory_in_use_bytes Resident memory of running calls and their children.')
+        lines.append('# TYPE blacktie_memory_in_use_bytes gauge')
+        lines.append('blacktie_memory_in_use_bytes %s' % (memory_in_use))
+        if self.memory_budget:
+            lines.append('# HELP blacktie_memory_budget_bytes Memory available to the run.')
+            lines.append('# TYPE blacktie_memory_budget_bytes gauge')
+            lines.append('blacktie_memory_budget_bytes %s' % (self.memory_budget))
+
+        lines.append('# HELP blacktie_call_elapsed_seconds Wall time of each started call.')
+        lines.append('# TYPE blacktie_call_elapsed_seconds gauge')
+        for rec in sorted(records,key=lambda r: r['call_id']):
+            if not rec['start']:
+                continue
+            elapsed = (rec['end'] or now) - rec['start']
+            lines.append('blacktie_call_elapsed_seconds{call_id="%s",tool="%s",state="%s"} %.3f' \
+                         % (_escape_label(rec['call_id']),_escape_label(rec['tool']),rec['state'],elapsed))
+
+        lines.append('# HELP blacktie_call_progress_ratio Fraction complete of each started call (current step for cufflinks/cuffdiff).')
+        lines.append('# TYPE blacktie_call_progress_ratio gauge')
+        for rec in sorted(records,key=lambda r: r['call_id']):
+            if rec.get('percent') is None:
+                continue
+            lines.append('blacktie_call_progress_ratio{call_id="%s",tool="%s"} %.4f' \
+                         % (_escape_label(rec['call_id']),_escape_label(rec['tool']),rec['percent'] / 100.0))
+
+        lines.append('# HELP blacktie_call_eta_seconds Estimated seconds until each running call finishes.')
+        lines.append('# TYPE blacktie_call_eta_seconds gauge')
+        for rec in sorted(records,key=lambda r: r['call_id']):
+            if rec['state'] != 'running' or rec.get('eta') is None:
+                continue
+            lines.append('blacktie_call_eta_seconds{call_id="%s",tool="%s"} %.1f' \
+                         % (_escape_label(rec['call_id']),_escape_label(rec['tool']),rec['eta']))
+
+        lines.append('# HELP blacktie_run_progress_ratio Fraction complete of all planned calls.')
+        lines.append('# TYPE blacktie_run_progress_ratio gauge')
+        lines.append('blacktie_run_progress_ratio %.4f' % (snap.run_progress))
+
+        lines.append('# HELP blacktie_last_update_timestamp_seconds When these metrics were rendered.')
+        lines.append('# TYPE blacktie_last_update_timestamp_seconds gauge')
+        lines.append('blacktie_last_update_timestamp_seconds %.3f' % (now))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self):
+        """
+        atomically re-writes ``self.textfile`` so node_exporter never reads a partial file.
+        """
+        if not self.textfile:
+            return
+        tmp_path = '%s.%s.tmp' % (self.textfile,os.getpid())
+        # the refresh thread and the main thread share tmp_path
+        with self._write_lock:
+            try:
+                tmp_file = open(tmp_path,'w')
+                tmp_file.write(self.render())
+                tmp_file.close()
+                os.rename(tmp_path,self.textfile)
+            except (IOError,OSError) as exc:
+                sys.stderr.write("Warning: unable to write metrics textfile %s: %s\n" % (self.textfile,exc))
+
+    # ++++++++ background services ++++++++
+    def _refresh_loop(self):
+        """
+        re-writes the textfile every ``self.refresh`` seconds with the current call states,
+        elapsed times and memory use.
+        """
+        while not self._stop.wait(self.refresh):
+            self.write_textfile()
+
+    def _make_handler(self):
+        """
+        returns a ``BaseHTTPRequestHandler`` class bound to this ``RunMetrics`` object.
+        """
+        import BaseHTTPServer
+        run_metrics = self
+
+        class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = run_metrics.render()
+                self.send_response(200)
+                self.send_header('Content-Type','text/plain; version=0.0.4')
+                self.send_header('Content-Length',str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,format,*args):
+                pass
+
+        return MetricsHandler
+
+    def start(self):
+        """
+        starts the background textfile refresher and the HTTP endpoint if configured.
+        """
+        self.write_textfile()
+        atexit.register(self.stop)
+        if self.textfile:
+            refresher = threading.Thread(target=self._refresh_loop,name='blacktie-metrics-refresh')
+            refresher.daemon = True
+            refresher.start()
+            self._threads.append(refresher)
+        if self.http_port:
+            import BaseHTTPServer
+            self._server = BaseHTTPServer.HTTPServer(('127.0.0.1',int(self.http_port)),self._make_handler())
+            server = threading.Thread(target=self._server.serve_forever,name='blacktie-metrics-http')
+            server.daemon = True
+            server.start()
+            self._threads.append(server)
+
+    def stop(self):
+        """
+        stops background services and writes a final textfile.
+        """
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+        self.write_textfile()
@@ -19,12 +19,11 @@ Code facilitating random aspects of this package.
 import os
 import sys
 import inspect
-import smtplib
 import base64
 import time
 import re
-from email.MIMEMultipart import MIMEMultipart
-from email.MIMEText import MIMEText
+import hashlib
+import cPickle
 
 from collections import defaultdict
 
@@ -59,11 +58,69 @@ class Bunch(dict):
 def bunchify(dict_tree):
     """
     Traverses a dictionary tree and converts all sub-dictionaries to Bunch() objects.
+
+    Walks the tree with an explicit stack so deep or very large configs cost no recursion.
+    """
+    root = Bunch(dict_tree)
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for k,v in node.iteritems():
+            if type(v) == type({}):
+                node[k] = Bunch(v)
+                stack.append(node[k])
+    return root
+
+
+def config_cache_dir():
     """
-    for k,v in dict_tree.iteritems():
-        if type(v) == type({}):
-            dict_tree[k] = bunchify(dict_tree[k])
-    return Bunch(dict_tree)
+    Returns the directory holding compiled config files (``$XDG_CACHE_HOME/blacktie/configs``).
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return '%s/blacktie/configs' % (base.rstrip('/'))
+
+
+def load_config(config_file,cache_dir=None):
+    """
+    Reads a yaml config file into a ``Bunch`` tree, reusing a compiled copy when the file has not changed.
+
+    The parsed tree is pickled to ``cache_dir`` under the SHA1 of the file's contents, so
+    re-running the same config (e.g. ``--prog cuffdiff`` after ``--prog tophat``) skips
+    the yaml parse.
+
+    :param config_file: path to the yaml config file
+    :param cache_dir: directory for compiled configs (``None`` to always parse the yaml)
+    :returns: ``bunchify``-ed config tree
+    """
+    text = open(config_file,'rb').read()
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = '%s/%s.pickle' % (cache_dir.rstrip('/'),hashlib.sha1(text).hexdigest())
+        try:
+            cache = open(cache_path,'rb')
+            try:
+                return bunchify(cPickle.load(cache))
+            finally:
+                cache.close()
+        except (IOError,EOFError,cPickle.UnpicklingError,ValueError,AttributeError,ImportError):
+            pass
+
+    import yaml
+    # use LibYAML's C parser when PyYAML was built with it
+    dict_tree = yaml.load(text,Loader=getattr(yaml,'CLoader',yaml.Loader))
+
+    if cache_path is not None:
+        tmp_path = '%s.%s.tmp' % (cache_path,os.getpid())
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            cache = open(tmp_path,'wb')
+            cPickle.dump(dict_tree,cache,cPickle.HIGHEST_PROTOCOL)
+            cache.close()
+            os.rename(tmp_path,cache_path)
+        except (IOError,OSError,cPickle.PicklingError) as exc:
+            sys.stderr.write("Warning: unable to cache compiled config in %s: %s\n" % (cache_dir,exc))
+    return bunchify(dict_tree)
 
 
 def whoami():
@@ -82,13 +139,18 @@ def email_notification(sender,to,subject,txt,pw,server_info):
     :param subject: subject text
     :param txt: body text
     :param pw: password of ``sender``
-    :param server_info: dictionary = {'host':``str``,'port':``int``}
+    :param server_info: dictionary = {'host':``str``,'port':``int``} plus optional ``starttls``
+        and ``login`` booleans (both default to ``True``)
 
     :returns: None
     
     .. todo:: **DONE** make ``email_notification()`` adjustable for other email servers
     """
     if sender:
+        import smtplib
+        from email.MIMEMultipart import MIMEMultipart
+        from email.MIMEText import MIMEText
+
         msg = MIMEMultipart()
         msg['From'] = sender
         msg['To'] = to
@@ -101,9 +163,11 @@ def email_notification(sender,to,subject,txt,pw,server_info):
         
         try:
             server.ehlo()
-            server.starttls()
-            server.ehlo()
-            server.login(sender,pw)
+            if server_info.get('starttls',True):
+                server.starttls()
+                server.ehlo()
+            if server_info.get('login',True):
+                server.login(sender,pw)
             server.sendmail(sender,to,msg.as_string())
             server.close()
         except (smtplib.SMTPAuthenticationError,
@@ -0,0 +1,294 @@
+#*****************************************************************************
+#  notify.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+notify.py
+####################
+Code defining a background email notifier for a run.
+
+Calls hand their notifications to a ``Notifier`` and carry on.  In the main
+process one thread moves them from the pipe into an in-memory queue as soon
+as they arrive and another sends them over one reused, authenticated SMTP
+connection.  Sending to the pipe only waits for the first thread, never for
+the SMTP server, so a slow server makes the queue grow (limited only by
+memory) instead of holding up calls or dropping notifications.
+Notifications can also be coalesced into one digest email per pipeline stage
+or per time period.
+"""
+import sys
+import time
+import atexit
+import socket
+import smtplib
+import threading
+from collections import deque
+from email.MIMEMultipart import MIMEMultipart
+from email.MIMEText import MIMEText
+
+from blacktie.utils.channel import MessagePipe
+
+
+DIGEST_CHOICES = [None,'stage','periodic']
+
+# bodies are cut to their last MAX_BODY bytes (the end of a tool's stderr says the most)
+MAX_BODY = 32 * 1024
+SMTP_TIMEOUT = 60
+CLOSE_TIMEOUT = 300
+
+smtp_errors = (smtplib.SMTPException,socket.error)
+
+
+class SMTPSender(object):
+    """
+    Sends email over a single SMTP connection that is opened on first use and re-opened if the server drops it.
+    """
+    def __init__(self,sender,pw,server_info):
+        """
+        initializes an ``SMTPSender`` object
+
+        :param sender: email address of sender
+        :param pw: password of ``sender``
+        :param server_info: dictionary = {'host':``str``,'port':``int``} plus optional
+            ``starttls`` and ``login`` booleans (both default to ``True``; turn them off
+            to talk to a local SMTP stand-in) and ``timeout`` (seconds, default ``SMTP_TIMEOUT``)
+
+        :returns: an initialized ``SMTPSender`` object
+        """
+        self.sender = sender
+        self.pw = pw
+        self.host = server_info['host']
+        self.port = server_info['port']
+        self.starttls = server_info.get('starttls',True)
+        self.login = server_info.get('login',True)
+        self.timeout = server_info.get('timeout') or SMTP_TIMEOUT
+        self._server = None
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host,self.port,timeout=self.timeout)
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.login:
+            server.login(self.sender,self.pw)
+        self._server = server
+
+    def send(self,to,subject,txt):
+        """
+        sends one email, reconnecting once if the kept connection has gone stale.
+        """
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = to
+        msg['Subject'] = subject
+        if isinstance(txt,unicode):
+            msg.attach(MIMEText(txt.encode('utf-8'),'plain','utf-8'))
+        else:
+            msg.attach(MIMEText(txt))
+
+        for attempt in [1,2]:
+            try:
+                if self._server is None:
+                    self._connect()
+                self._server.sendmail(self.sender,to,msg.as_string())
+                return
+            except (smtplib.SMTPServerDisconnected,socket.error) as e:
+                self._server = None
+                if attempt == 2:
+                    sys.stderr.write("Warning: %s was caught while trying to send your mail.\nSubject:%s\n" % (e.__class__.__name__,subject))
+            except smtplib.SMTPException as e:
+                sys.stderr.write("Warning: %s was caught while trying to send your mail.\nSubject:%s\n" % (e.__class__.__name__,subject))
+                if self._server is not None:
+                    try:
+                        self._server.rset()
+                    except smtp_errors:
+                        self._server = None
+                return
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtp_errors:
+                pass
+            self._server = None
+
+
+class Notifier(object):
+    """
+    Queues notifications from any process of a run and sends them from a background thread.
+    """
+    def __init__(self,email_from,email_to,pw,server_info,digest=None,digest_interval=3600,digest_title=''):
+        """
+        initializes a ``Notifier`` object and starts its receiver and sender threads
+
+        :param email_from: email address of sender
+        :param email_to: email address of recipient
+        :param pw: password of ``email_from``
+        :param server_info: ``run_options.custom_smtp`` (see ``SMTPSender``)
+        :param digest: ``None`` to send each notification, 'stage' for one email per pipeline stage,
+            'periodic' for one email every ``digest_interval`` seconds
+        :param digest_interval: seconds between 'periodic' digests
+        :param digest_title: text put at the front of digest subjects (e.g. '[SITREP from host] Run X')
+
+        :returns: an initialized ``Notifier`` object
+        """
+        if digest not in DIGEST_CHOICES:
+            raise ValueError('digest must be one of %s, not %s' % (DIGEST_CHOICES,digest))
+        self.email_to = email_to
+        self.digest = digest
+        self.digest_interval = digest_interval
+        self.digest_title = digest_title
+        self._smtp = SMTPSender(email_from,pw,server_info)
+        # the pipe is drained into self._queue at once, so a send never waits for the SMTP server
+        self._pipe = MessagePipe()
+        self._queue = deque()
+        self._queue_ready = threading.Condition()
+        self._pending = {}
+        self._closed = False
+
+        self._receiver = threading.Thread(target=self._receive_loop,name='blacktie-notifier-receiver')
+        self._thread = threading.Thread(target=self._send_loop,name='blacktie-notifier')
+        for thread in [self._receiver,self._thread]:
+            thread.daemon = True
+            thread.start()
+        atexit.register(self.close)
+
+    def __getstate__(self):
+        """
+        keeps only what a sender needs so calls holding this object can be pickled by ``pprocess``.
+        """
+        return {'email_to':self.email_to,
+                'digest':self.digest,
+                '_pipe':self._pipe,
+                '_closed':self._closed}
+
+    # ++++++++ queueing (any process) ++++++++
+    def notify(self,subject,body,stage=None):
+        """
+        queues a notification and returns immediately.
+
+        :param subject: subject text
+        :param body: body text
+        :param stage: pipeline stage the notification belongs to (used by 'stage' digests)
+        """
+        if self._closed:
+            return
+        if len(body) > MAX_BODY:
+            body = '[... %s characters cut ...]\n%s' % (len(body) - MAX_BODY,body[-MAX_BODY:])
+        self._pipe.send({'kind':'notify','subject':subject,'body':body,'stage':stage,'time':time.time()})
+
+    def end_stage(self,stage):
+        """
+        sends the digest collected for ``stage`` (only does anything for 'stage' digests).
+        """
+        if not self._closed:
+            self._pipe.send({'kind':'end_stage','stage':stage})
+
+    # ++++++++ sending (owner process only) ++++++++
+    def _receive_loop(self):
+        """
+        moves each message from the pipe into ``self._queue`` as soon as it arrives.
+        """
+        while True:
+            try:
+                message = self._pipe.receive()
+            except EOFError:
+                message = {'kind':'stop'}
+            if message is None:
+                continue
+            with self._queue_ready:
+                self._queue.append(message)
+                self._queue_ready.notify()
+            if message['kind'] == 'stop':
+                break
+
+    def _next_message(self,timeout):
+        """
+        returns the next queued message, or ``None`` if there is none after ``timeout`` seconds.
+        """
+        with self._queue_ready:
+            if not self._queue:
+                self._queue_ready.wait(timeout)
+            if self._queue:
+                return self._queue.popleft()
+            return None
+
+    def _send_loop(self):
+        last_digest = time.time()
+        while True:
+            if self.digest == 'periodic':
+                timeout = max(0,self.digest_interval - (time.time() - last_digest))
+            else:
+                timeout = None
+            message = self._next_message(timeout)
+
+            if message is None:
+                pass
+            elif message['kind'] == 'stop':
+                break
+            elif message['kind'] == 'end_stage':
+                self._send_digest(message['stage'])
+            elif self.digest is None:
+                self._smtp.send(self.email_to,message['subject'],message['body'])
+            else:
+                key = message['stage'] if self.digest == 'stage' else None
+                self._pending.setdefault(key,[]).append(message)
+
+            if self.digest == 'periodic' and (time.time() - last_digest) >= self.digest_interval:
+                self._send_digest(None)
+                last_digest = time.time()
+
+        for key in self._pending.keys():
+            self._send_digest(key)
+        self._smtp.close()
+
+    def _send_digest(self,key):
+        """
+        sends everything pending under ``key`` as one email.
+        """
+        messages = self._pending.pop(key,[])
+        if not messages:
+            return
+        if len(messages) == 1:
+            self._smtp.send(self.email_to,messages[0]['subject'],messages[0]['body'])
+            return
+
+        if key is None:
+            what = 'since %s' % (time.strftime('%Y.%m.%d-%H:%M:%S',time.localtime(messages[0]['time'])))
+        else:
+            what = 'for %s' % (key)
+        subject = "%s notifications %s" % (len(messages),what)
+        if self.digest_title:
+            subject = "%s - %s" % (self.digest_title,subject)
+        body = [subject,'']
+        body.extend([m['subject'] for m in messages])
+        for m in messages:
+            body.append('\n%s\n%s' % ('=' * 70,m['body']))
+        self._smtp.send(self.email_to,subject,'\n'.join(body))
+
+    def close(self):
+        """
+        sends anything still queued and stops the receiver and sender threads (owner process only).
+        """
+        if self._closed or not self._pipe.is_owner():
+            return
+        self._closed = True
+        self._pipe.send({'kind':'stop'})
+        deadline = time.time() + CLOSE_TIMEOUT
+        for thread in [self._receiver,self._thread]:
+            thread.join(max(0,deadline - time.time()))
+        if self._receiver.is_alive() or self._thread.is_alive():
+            sys.stderr.write("Warning: gave up waiting for the SMTP server; unsent notifications were dropped.\n")
+            return
+        self._pipe.close()
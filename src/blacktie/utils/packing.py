@@ -0,0 +1,207 @@
+#*****************************************************************************
+#  packing.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+packing.py
+####################
+Code to pack a call's output directory into a ``.tar.gz`` using every core.
+
+The tar stream is cut into blocks that are deflated by a pool of threads
+(zlib releases the GIL while it compresses) and written in order as
+separate gzip members, which ``gzip`` and ``tar -z`` read as one stream.
+Blocks holding files that are already compressed (BAMs are BGZF, ``.gz``,
+``.bz2``, images, PDFs) are stored at level 0, so they cost a CRC instead
+of a second round of compression.  Only a few blocks per thread are held
+in memory and the archive is written straight to its destination.
+"""
+import os
+import sys
+import zlib
+import tarfile
+from collections import deque
+
+from blacktie.utils.externals import mkdirp
+
+
+# extensions of files that deflate can not make meaningfully smaller
+COMPRESSED_EXTENSIONS = set(['.bam','.cram','.gz','.bgz','.bz2','.xz','.zip','.png','.jpg','.jpeg','.pdf'])
+
+_compressed_magic = ['\x1f\x8b','BZh','\xfd7zXZ','PK\x03\x04','\x89PNG','%PDF']
+
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def is_compressed(path):
+    """
+    returns ``True`` if the file at ``path`` is already compressed (by extension or leading bytes).
+    """
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return True
+    try:
+        head = open(path,'rb').read(8)
+    except IOError:
+        return False
+    return any([head.startswith(magic) for magic in _compressed_magic])
+
+def compress_block(block):
+    """
+    returns ``block`` (a ``(data, level)`` pair) as one complete gzip member.
+    """
+    data,level = block
+    compressor = zlib.compressobj(level,zlib.DEFLATED,16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _NullFile(object):
+    """
+    a write-only sink for the ``TarFile`` used only to build headers.
+    """
+    def write(self,data):
+        pass
+
+    def tell(self):
+        return 0
+
+
+class ParallelPacker(object):
+    """
+    Packs one directory into a ``.tar.gz`` with parallel block compression.
+    """
+    def __init__(self,threads=None,level=6,block_size=BLOCK_SIZE):
+        """
+        initializes a ``ParallelPacker`` object
+
+        :param threads: number of blocks compressed at once (default: the number of cpus)
+        :param level: zlib level for blocks of compressible files
+        :param block_size: bytes of tar stream per gzip member
+
+        :returns: an initialized ``ParallelPacker`` object
+        """
+        if not threads:
+            try:
+                import multiprocessing
+                threads = multiprocessing.cpu_count()
+            except (ImportError,NotImplementedError):
+                threads = 1
+        self.threads = threads
+        self.level = level
+        self.block_size = block_size
+        self.stats = {'files':0,'bytes':0,'stored_bytes':0}
+
+    def tar_stream(self,src_dir,arc_root):
+        """
+        yields the tar stream of ``src_dir`` as ``(data, compress)`` pieces, with the archive
+        paths under ``arc_root`` (the way ``tar`` names the members of the directory it is given).
+        """
+        headers = tarfile.open(fileobj=_NullFile(),mode='w',format=tarfile.GNU_FORMAT)
+        for dir_path,dir_names,file_names in os.walk(src_dir):
+            dir_names.sort()
+            rel_dir = os.path.relpath(dir_path,src_dir)
+            arc_dir = arc_root if rel_dir == '.' else '%s/%s' % (arc_root,rel_dir)
+            paths = [(dir_path,arc_dir)]
+            paths.extend([(os.path.join(dir_path,name),'%s/%s' % (arc_dir,name)) for name in sorted(file_names)])
+            # os.walk lists symlinks to directories as directories but does not follow them
+            paths.extend([(os.path.join(dir_path,name),'%s/%s' % (arc_dir,name)) for name in dir_names
+                          if os.path.islink(os.path.join(dir_path,name))])
+
+            for path,arc_name in paths:
+                tarinfo = headers.gettarinfo(path,arc_name)
+                if tarinfo is None:
+                    continue
+                yield tarinfo.tobuf(headers.format,headers.encoding,headers.errors),True
+                if not tarinfo.isreg():
+                    continue
+
+                compress = not is_compressed(path)
+                self.stats['files'] += 1
+                self.stats['bytes'] += tarinfo.size
+                if not compress:
+                    self.stats['stored_bytes'] += tarinfo.size
+                in_file = open(path,'rb')
+                try:
+                    remaining = tarinfo.size
+                    while remaining > 0:
+                        data = in_file.read(min(self.block_size,remaining))
+                        if not data:
+                            raise IOError('%s shrank while it was being packed' % (path))
+                        remaining -= len(data)
+                        yield data,compress
+                finally:
+                    in_file.close()
+                padding = -tarinfo.size % tarfile.BLOCKSIZE
+                if padding:
+                    yield tarfile.NUL * padding,compress
+        # end-of-archive marker
+        yield tarfile.NUL * (tarfile.BLOCKSIZE * 2),True
+
+    def blocks(self,src_dir,arc_root):
+        """
+        regroups ``tar_stream()`` into ``(data, level)`` blocks of about ``self.block_size`` bytes
+        that never mix compressible and already-compressed bytes.
+        """
+        pieces = []
+        size = 0
+        current = None
+        for data,compress in self.tar_stream(src_dir,arc_root):
+            if pieces and (compress != current or size >= self.block_size):
+                yield ''.join(pieces),self.level if current else 0
+                pieces = []
+                size = 0
+            current = compress
+            pieces.append(data)
+            size += len(data)
+        if pieces:
+            yield ''.join(pieces),self.level if current else 0
+
+    def pack(self,src_dir,dest):
+        """
+        writes ``src_dir`` as a ``.tar.gz`` to ``dest`` ('-' for stdout).
+
+        The archive is written under a temporary name and renamed when complete.
+        """
+        src_dir = src_dir.rstrip('/') or '/'
+        arc_root = os.path.normpath(src_dir).lstrip('/') or '.'
+
+        if dest == '-':
+            out_file = sys.stdout
+            tmp_path = None
+        else:
+            mkdirp(os.path.dirname(os.path.abspath(dest)))
+            tmp_path = '%s.%s.tmp' % (dest,os.getpid())
+            out_file = open(tmp_path,'wb')
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(self.threads)
+        try:
+            # keep a few blocks per thread in flight and write them in order
+            window = deque()
+            for block in self.blocks(src_dir,arc_root):
+                window.append(pool.apply_async(compress_block,(block,)))
+                if len(window) >= self.threads * 2:
+                    out_file.write(window.popleft().get())
+            while window:
+                out_file.write(window.popleft().get())
+            out_file.flush()
+        except:
+            if tmp_path is not None:
+                out_file.close()
+                os.remove(tmp_path)
+            raise
+        finally:
+            pool.close()
+            pool.join()
+
+        if tmp_path is not None:
+            out_file.close()
+            os.rename(tmp_path,dest)
+        return self.stats
@@ -0,0 +1,301 @@
+#*****************************************************************************
+#  preflight.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+preflight.py
+####################
+Code to check every input of a run before any program is started.
+
+``PreflightCheck`` resolves the ``from_conditions`` values and call ids of
+every call the run will make with the same helpers the call objects in
+``calls.py`` use, then checks all of the resulting paths at once from a pool
+of threads.  Outputs of stages that run earlier in the same invocation are
+not required to exist yet.  Every problem found is reported together.
+"""
+import os
+import gzip
+import zlib
+from collections import OrderedDict
+
+from blacktie.utils.misc import Bunch
+from blacktie.utils.calls import FastqQCCall,TophatCall,BamStatsCall,CufflinksCall,CuffmergeCall,CuffdiffCall,CummerbundCall
+from blacktie.utils.calls import build_call_id,output_path,resolve_option,resolve_reads,resolve_bowtie_index
+from blacktie.utils import errors
+
+
+STAGES = ['fastq_qc','tophat','bam_stats','cufflinks','cuffmerge','cuffdiff','cummerbund']
+
+GZIP_CHECKS = ['quick','full','off']
+
+
+class PreflightCheck(object):
+    """
+    Collects and checks the input files of every call in a run.
+    """
+    def __init__(self,yargs,prog,gzip_check='quick',threads=16):
+        """
+        initializes a ``PreflightCheck`` object
+
+        :param yargs: argument tree generated by parsing the yaml config file (with ``groups`` set)
+        :param prog: the ``--prog`` choice
+        :param gzip_check: 'quick' to decompress the start of each gzipped fastq, 'full' to
+            decompress all of it and verify its CRC, 'off' to only stat it
+        :param threads: number of files checked at once
+
+        :returns: an initialized ``PreflightCheck`` object
+        """
+        self.yargs = yargs
+        self.stages = [s for s in STAGES if prog in [s,'all']]
+        self.gzip_check = gzip_check
+        self.threads = threads
+        self.requirements = OrderedDict()
+        self.problems = []
+
+    # ++++++++ collecting ++++++++
+    def require(self,path,kind,needed_by):
+        """
+        records that ``needed_by`` needs ``path``.
+
+        :param kind: 'file', 'dir', 'fastq' or 'bt2_index'
+        """
+        entry = self.requirements.setdefault(path,Bunch({'kind':kind,'needed_by':[]}))
+        entry.needed_by.append(needed_by)
+
+    def require_output(self,stage,call_id,file_name,needed_by):
+        """
+        requires an output of an earlier stage unless that stage runs in this invocation.
+        """
+        if stage in self.stages:
+            return
+        if file_name:
+            self.require(output_path(self.yargs,call_id,file_name),'file',needed_by)
+        else:
+            self.require(output_path(self.yargs,call_id),'dir',needed_by)
+
+    def resolve(self,needed_by,resolver,*args):
+        """
+        runs one of the ``from_conditions`` resolvers of ``calls.py`` or records the problem it raises.
+
+        :returns: the resolved value or ``None``
+        """
+        try:
+            return resolver(*args)
+        except errors.BlacktieError as exc:
+            self.problems.append('%s: %s' % (needed_by,exc))
+            return None
+
+    def require_option(self,prog_yargs,option_name,condition_key,conditions,kind,needed_by):
+        """
+        resolves one option that may be ``from_conditions`` and requires the file it names.
+
+        :param conditions: a single condition ``dict`` or the list of conditions of a group call
+        """
+        option = self.resolve(needed_by,resolve_option,prog_yargs.get(option_name),conditions,condition_key,option_name)
+        if option:
+            self.require(str(option),kind,needed_by)
+
+    def require_reads(self,prog_yargs,condition,needed_by):
+        """
+        requires the fastq files of a call's ``left_reads`` and ``right_reads``.
+
+        :returns: (left reads, right reads)
+        """
+        reads = []
+        for side in ['left_reads','right_reads']:
+            paths = self.resolve(needed_by,resolve_reads,prog_yargs.positional_args[side],condition,side) or []
+            for path in paths:
+                self.require(path,'fastq',needed_by)
+            reads.append(paths)
+        return reads
+
+    def collect(self):
+        """
+        resolves the inputs of every call of every stage in ``self.stages``.
+        """
+        yargs = self.yargs
+
+        if 'fastq_qc' in self.stages and yargs.get('fastq_qc_options'):
+            for condition in yargs.condition_queue:
+                self.require_reads(yargs.fastq_qc_options,condition,build_call_id(FastqQCCall.prog_name,condition))
+
+        if 'tophat' in self.stages:
+            opts = yargs.tophat_options
+            for condition in yargs.condition_queue:
+                call_id = build_call_id(TophatCall.prog_name,condition)
+                self.require_option(opts,'G','gtf_annotation',condition,'file',call_id)
+
+                bt_idx = self.resolve(call_id,resolve_bowtie_index,yargs,opts.positional_args.bowtie2_index,condition)
+                if bt_idx:
+                    self.require(bt_idx,'bt2_index',call_id)
+
+                left_reads,right_reads = self.require_reads(opts,condition,call_id)
+                if len(left_reads) != len(right_reads) and right_reads:
+                    self.problems.append('%s: %s left_reads but %s right_reads.' % (call_id,len(left_reads),len(right_reads)))
+
+        if 'bam_stats' in self.stages and yargs.get('bam_stats_options'):
+            for condition in yargs.condition_queue:
+                call_id = build_call_id(BamStatsCall.prog_name,condition)
+                option = yargs.bam_stats_options.positional_args.accepted_hits
+                if option == 'from_conditions':
+                    self.require_output('tophat',build_call_id(TophatCall.prog_name,condition),'accepted_hits.bam',call_id)
+                elif option:
+                    self.require(option,'file',call_id)
+
+        if 'cufflinks' in self.stages:
+            opts = yargs.cufflinks_options
+            if opts.get('GTF') and opts.get('GTF-guide'):
+                self.problems.append('cufflinks_options: "GTF" and "GTF-guide" option were non-False.  Please only set one or the other.')
+            for condition in yargs.condition_queue:
+                call_id = build_call_id(CufflinksCall.prog_name,condition)
+                self.require_option(opts,'GTF-guide','gtf_annotation',condition,'file',call_id)
+                self.require_option(opts,'GTF','gtf_annotation',condition,'file',call_id)
+                self.require_option(opts,'frag-bias-correct','genome_seq',condition,'file',call_id)
+                self.require_option(opts,'mask-file','mask_file',condition,'file',call_id)
+
+                option = opts.positional_args.accepted_hits
+                if option == 'from_conditions':
+                    self.require_output('tophat',build_call_id(TophatCall.prog_name,condition),'accepted_hits.bam',call_id)
+                elif option:
+                    self.require(option,'file',call_id)
+
+        for exp_id,conditions in yargs.groups.iteritems():
+            if 'cuffmerge' in self.stages:
+                opts = yargs.cuffmerge_options
+                call_id = build_call_id(CuffmergeCall.prog_name,conditions)
+                self.require_option(opts,'ref-gtf','gtf_annotation',conditions,'file',call_id)
+                self.require_option(opts,'ref-sequence','genome_seq',conditions,'file',call_id)
+
+                option = opts.positional_args.assembly_list
+                if option == 'from_conditions':
+                    for condition in conditions:
+                        self.require_output('cufflinks',build_call_id(CufflinksCall.prog_name,condition),'transcripts.gtf',call_id)
+                elif option:
+                    self.require(option,'file',call_id)
+
+            if 'cuffdiff' in self.stages:
+                opts = yargs.cuffdiff_options
+                call_id = build_call_id(CuffdiffCall.prog_name,conditions)
+                self.require_option(opts,'frag-bias-correct','genome_seq',conditions,'file',call_id)
+                self.require_option(opts,'mask-file','mask_file',conditions,'file',call_id)
+
+                option = opts.positional_args.transcripts_gtf
+                if option == 'from_conditions':
+                    self.require_output('cuffmerge',build_call_id(CuffmergeCall.prog_name,conditions),'merged.gtf',call_id)
+                elif option:
+                    self.require(option,'file',call_id)
+
+                option = opts.positional_args.sample_bams
+                if option == 'from_conditions':
+                    for condition in conditions:
+                        self.require_output('tophat',build_call_id(TophatCall.prog_name,condition),'accepted_hits.bam',call_id)
+                elif option:
+                    for path in option.replace(',',' ').split():
+                        self.require(path,'file',call_id)
+
+            if 'cummerbund' in self.stages:
+                opts = yargs.cummerbund_options
+                call_id = build_call_id(CummerbundCall.prog_name,conditions)
+                if opts.get('cuffdiff-dir') == 'from_conditions':
+                    self.require_output('cuffdiff',build_call_id(CuffdiffCall.prog_name,conditions),None,call_id)
+                if opts.get('gtf-path') == 'from_conditions':
+                    self.require_output('cuffmerge',build_call_id(CuffmergeCall.prog_name,conditions),'merged.gtf',call_id)
+
+    # ++++++++ checking ++++++++
+    def check_path(self,item):
+        """
+        checks one required path.
+
+        :param item: (path, requirement ``Bunch``)
+        :returns: problem text or ``None``
+        """
+        path,entry = item
+        kind = entry.kind
+        try:
+            if kind == 'bt2_index':
+                if not [s for s in ['.1.bt2','.1.bt2l'] if os.path.isfile(path + s)]:
+                    return 'bowtie2 index not found: %s (no %s.1.bt2 or %s.1.bt2l)' % (path,path,path)
+                return None
+            if kind == 'dir':
+                if not os.path.isdir(path):
+                    return 'directory not found: %s' % (path)
+                return None
+
+            if not os.path.isfile(path):
+                return 'file not found: %s' % (path)
+            if not os.access(path,os.R_OK):
+                return 'file not readable: %s' % (path)
+            if kind == 'fastq':
+                return self.check_fastq(path)
+        except (IOError,OSError) as exc:
+            return '%s: %s' % (path,exc)
+        return None
+
+    def check_fastq(self,path):
+        """
+        checks that a fastq file is not empty, starts like a fastq file and, if gzipped, decompresses.
+        """
+        if os.path.getsize(path) == 0:
+            return 'fastq file is empty: %s' % (path)
+        if path.endswith('.gz') and self.gzip_check != 'off':
+            try:
+                fastq = gzip.open(path,'rb')
+                try:
+                    head = fastq.read(64 * 1024)
+                    if self.gzip_check == 'full':
+                        while fastq.read(1024 * 1024):
+                            pass
+                finally:
+                    fastq.close()
+            except (IOError,EOFError,zlib.error) as exc:
+                return 'gzip file is corrupt or truncated: %s (%s)' % (path,exc)
+        else:
+            fastq = open(path,'rb')
+            head = fastq.read(1)
+            fastq.close()
+        if not head.startswith('@'):
+            return 'does not look like a fastq file: %s' % (path)
+        return None
+
+    def check(self):
+        """
+        collects every input and checks them all from ``self.threads`` threads.
+
+        :returns: ``list`` of problem texts (empty if everything is in place)
+        """
+        from multiprocessing.pool import ThreadPool
+        self.collect()
+        items = self.requirements.items()
+        pool = ThreadPool(max(1,min(self.threads,len(items) or 1)))
+        try:
+            results = pool.map(self.check_path,items)
+        finally:
+            pool.close()
+            pool.join()
+
+        for (path,entry),problem in zip(items,results):
+            if problem is not None:
+                needed_by = entry.needed_by
+                if len(needed_by) > 3:
+                    needed_by = needed_by[:3] + ['%s more' % (len(needed_by) - 3)]
+                self.problems.append('%s (needed by %s)' % (problem,', '.join(needed_by)))
+        return self.problems
+
+    def report(self):
+        """
+        returns a text report of ``self.problems``.
+        """
+        lines = ['[preflight] checked %s inputs of %s: %s problem(s) found.'
+                 % (len(self.requirements),', '.join(self.stages),len(self.problems))]
+        lines.extend(['  - %s' % (p) for p in self.problems])
+        return '\n'.join(lines)
+
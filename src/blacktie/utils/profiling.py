@@ -0,0 +1,85 @@
+#*****************************************************************************
+#  profiling.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+profiling.py
+####################
+Code to profile blacktie's own python work (config loading, call construction,
+script writing, etc).
+
+Only the main python process is profiled.  External programs run in their own
+processes and are not slowed down; time spent waiting on them shows up under
+``externals.runExternalApp``.
+"""
+import os
+import sys
+import cProfile
+import pstats
+
+from blacktie.utils.externals import mkdirp
+
+
+class OrchestratorProfiler(object):
+    """
+    Wraps ``cProfile`` and writes a pstats file plus a top-N text summary for a run.
+    """
+    def __init__(self,top=30):
+        """
+        initializes an ``OrchestratorProfiler`` object
+
+        :param top: number of functions to list in each section of the text summary
+
+        :returns: an initialized ``OrchestratorProfiler`` object
+        """
+        self.top = top
+        self.out_dir = os.getcwd()
+        self.run_id = 'blacktie'
+        self._profile = cProfile.Profile()
+
+    def set_destination(self,out_dir,run_id):
+        """
+        sets where ``dump()`` writes its files once the run's log directory is known.
+        """
+        self.out_dir = out_dir
+        self.run_id = run_id
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    def dump(self):
+        """
+        writes ``<run_id>.pstats`` and ``<run_id>.profile.txt`` to ``self.out_dir``.
+
+        :returns: (pstats path, summary path)
+        """
+        out_dir = self.out_dir.rstrip('/')
+        mkdirp(out_dir)
+        pstats_path = '%s/%s.pstats' % (out_dir,self.run_id)
+        summary_path = '%s/%s.profile.txt' % (out_dir,self.run_id)
+
+        self._profile.dump_stats(pstats_path)
+
+        summary = open(summary_path,'w')
+        stats = pstats.Stats(pstats_path,stream=summary)
+        stats.strip_dirs()
+        summary.write('==> top %s by cumulative time <==\n' % (self.top))
+        stats.sort_stats('cumulative').print_stats(self.top)
+        summary.write('==> top %s by internal time <==\n' % (self.top))
+        stats.sort_stats('time').print_stats(self.top)
+        summary.close()
+
+        sys.stderr.write('[Note] Profile written to %s (summary: %s)\n' % (pstats_path,summary_path))
+        return pstats_path,summary_path
@@ -0,0 +1,254 @@
+#*****************************************************************************
+#  progress.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+progress.py
+####################
+Code to turn the stderr chatter of tophat/cufflinks into progress events.
+
+Parsers are fed one line at a time as stderr streams out of the running
+program (see ``externals.runExternalApp``) and return a ``Bunch`` with
+``percent``, ``step`` and ``eta`` whenever the picture changes.
+
+``ProgressBarFilter`` sits on the same stream and keeps only what is worth
+logging: each progress bar collapses to its final state and memory use is
+bounded no matter how much the program writes.
+"""
+import re
+import time
+from collections import deque
+
+from blacktie.utils.misc import Bunch
+
+
+class ProgressParser(object):
+    """
+    Defines common methods for all progress parsers.  Children over-ride ``parse_line()``.
+    """
+    def __init__(self):
+        """
+        initializes a ``ProgressParser`` object
+        """
+        self.start_time = time.time()
+        self.step_start_time = self.start_time
+        self.percent = 0.0
+        self.step = None
+
+    def eta(self,since=None):
+        """
+        estimates seconds remaining by extrapolating the elapsed time over ``self.percent``.
+
+        :param since: time the current percentage is measured from (defaults to the start of the call)
+        :returns: seconds remaining or ``None`` if no progress has been made yet
+        """
+        if since is None:
+            since = self.start_time
+        if self.percent <= 0:
+            return None
+        elapsed = time.time() - since
+        return elapsed * (100.0 - self.percent) / self.percent
+
+    def event(self):
+        """
+        returns a ``Bunch`` describing the current state of progress.
+        """
+        return Bunch({'percent':self.percent,
+                      'step':self.step,
+                      'eta':self.eta()})
+
+    def parse_line(self,line):
+        """
+        updates state from one line of stderr.
+
+        :returns: ``True`` if the state changed
+        """
+        return False
+
+    def feed(self,line):
+        """
+        parses one line of stderr.
+
+        :param line: a single line of stderr (``\\n`` or ``\\r`` terminated)
+        :returns: a progress event ``Bunch`` if the line changed the progress state, ``None`` otherwise
+        """
+        if self.parse_line(line):
+            return self.event()
+        return None
+
+
+class TophatProgress(ProgressParser):
+    """
+    Estimates tophat progress from the time-stamped step markers it writes to stderr.
+
+    Tophat does not report a percentage, so each marker is assigned the rough fraction
+    of a typical paired-end run that is complete by the time it is printed.
+    """
+    milestones = [(re.compile(r'Beginning TopHat run'), 0),
+                  (re.compile(r'Preparing reads'), 5),
+                  (re.compile(r'Creating transcriptome data files|Building Bowtie index'), 8),
+                  (re.compile(r'Mapping .+ to transcriptome'), 10),
+                  (re.compile(r'Resuming TopHat pipeline with unmapped reads'), 30),
+                  (re.compile(r'Mapping .+ to genome(?! segment_juncs)'), 35),
+                  (re.compile(r'Searching for junctions via segment mapping'), 60),
+                  (re.compile(r'Retrieving sequences for splices'), 65),
+                  (re.compile(r'Mapping .+ to genome segment_juncs'), 70),
+                  (re.compile(r'Joining segment hits'), 85),
+                  (re.compile(r'Reporting output tracks'), 90),
+                  (re.compile(r'Run complete'), 100)]
+    marker_regex = re.compile(r'^\[[^\]]+\]\s+(.+?)\s*$')
+
+    def parse_line(self,line):
+        match = self.marker_regex.search(line)
+        if match is None:
+            return False
+        message = match.group(1)
+        for regex,percent in self.milestones:
+            if regex.search(message):
+                # tophat revisits some steps (e.g. once per read segment) so never go backwards
+                self.percent = max(self.percent,float(percent))
+                self.step = message
+                return True
+        return False
+
+
+class CufflinksProgress(ProgressParser):
+    """
+    Reads the "> Processing Locus ... [****   ]  50%" bars written by cufflinks and cuffdiff.
+
+    Each "> " header line starts a new step with its own 0-100% bar; ``percent`` and
+    ``eta`` describe the step currently running.
+    """
+    bar_regex = re.compile(r'>.+Processing.+\[.+\]\s*(\d+(?:\.\d+)?)%')
+    step_regex = re.compile(r'^>\s*(.+?)\s*$')
+
+    def parse_line(self,line):
+        match = self.bar_regex.search(line)
+        if match is not None:
+            percent = float(match.group(1))
+            if percent == self.percent:
+                return False
+            self.percent = percent
+            return True
+
+        match = self.step_regex.search(line)
+        if match is not None:
+            self.step = match.group(1)
+            self.step_start_time = time.time()
+            self.percent = 0.0
+            return True
+        return False
+
+    def eta(self,since=None):
+        return ProgressParser.eta(self,since=self.step_start_time)
+
+
+_line_end_regex = re.compile(r'(\r\n|\r|\n)')
+
+class ProgressBarFilter(object):
+    """
+    Incrementally filters program output, collapsing progress bar redraws to their final state.
+
+    Bars redrawn in place with ``\\r`` keep only the text shown when the line is finished,
+    and consecutive finished lines matching ``bar_regex`` (bars redrawn on new lines) keep
+    only the last one.  At most ``max_bytes`` of filtered text is kept; older lines are
+    dropped and counted.
+    """
+    def __init__(self,bar_regex=None,on_line=None,max_bytes=1024*1024,max_line=64*1024):
+        """
+        initializes a ``ProgressBarFilter`` object
+
+        :param bar_regex: compiled regex matching a progress bar line (e.g. ``yargs.prgbar_regex``)
+        :param on_line: optional callable given every line and redraw as it arrives
+        :param max_bytes: most filtered text to keep
+        :param max_line: longest single line to keep; longer lines are truncated
+
+        :returns: an initialized ``ProgressBarFilter`` object
+        """
+        self.bar_regex = bar_regex
+        self.on_line = on_line
+        self.max_bytes = max_bytes
+        self.max_line = max_line
+        self._lines = deque()
+        self._size = 0
+        self._omitted = 0
+        self._last_is_bar = False
+        self._partial = ''
+        self._redraw = ''
+
+    def feed(self,chunk):
+        """
+        filters the next ``chunk`` of output.
+        """
+        pieces = _line_end_regex.split(self._partial + chunk)
+        self._partial = pieces.pop()[:self.max_line]
+        for i in xrange(0,len(pieces),2):
+            self._add(pieces[i][:self.max_line],pieces[i + 1])
+
+    def close(self):
+        """
+        finishes any unterminated last line.
+        """
+        if self._partial or self._redraw:
+            self._add(self._partial,'\n')
+            self._partial = ''
+
+    def _add(self,line,terminator):
+        if line and self.on_line is not None:
+            self.on_line(line)
+
+        if terminator == '\r':
+            # the line will be drawn over; remember it in case nothing replaces it
+            if line:
+                self._redraw = line
+            return
+
+        if not line:
+            line = self._redraw
+        self._redraw = ''
+
+        is_bar = bool(self.bar_regex is not None and line and self.bar_regex.search(line))
+        if is_bar and self._last_is_bar and self._lines:
+            self._size -= len(self._lines.pop()) + 1
+        self._lines.append(line)
+        self._size += len(line) + 1
+        self._last_is_bar = is_bar
+
+        while self._size > self.max_bytes and len(self._lines) > 1:
+            self._size -= len(self._lines.popleft()) + 1
+            self._omitted += 1
+
+    def getvalue(self):
+        """
+        returns the filtered text kept so far.
+        """
+        if not self._lines:
+            return ''
+        text = '\n'.join(self._lines) + '\n'
+        if self._omitted:
+            text = '[... %s earlier lines of output omitted ...]\n%s' % (self._omitted,text)
+        return text
+
+
+PROGRESS_PARSERS = {'tophat':TophatProgress,
+                    'cufflinks':CufflinksProgress,
+                    'cuffdiff':CufflinksProgress}
+
+
+def get_progress_parser(prog_name):
+    """
+    returns a fresh progress parser for ``prog_name`` or ``None`` if it does not report progress.
+    """
+    try:
+        return PROGRESS_PARSERS[prog_name]()
+    except KeyError:
+        return None
@@ -0,0 +1,494 @@
+#*****************************************************************************
+#  qsub.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+qsub.py
+####################
+Code to write the cluster scripts of ``--mode qsub_script``.
+
+The qsub template is compiled once per process (Mako also keeps the
+compiled module on disk, so later runs skip the compile as well) and the
+rendered scripts are buffered and written together into one directory per
+run.
+
+Stages named in ``qsub_options.array_jobs`` get one SGE array job instead
+of one script per call: the template is rendered once with shell variables
+in place of the per-call values, and a task table maps ``$SGE_TASK_ID`` to
+each call's id, output directory and command line.
+
+Each script (or array job) is recorded as a ``QsubJob`` along with the
+calls it waits for, so the whole run can be submitted at once with
+scheduler dependencies that mirror the call graph: ``submit_all.sh`` is
+written next to the scripts and ``QsubScriptWriter.submit()`` (``--submit``)
+runs the same submissions from python.
+
+Every script ends with its program's exit status, whatever the template
+runs after the program (packing, clean-up), so dependent jobs are not
+started after a failure: SLURM's ``afterok`` sees the status as it is, and
+on SGE a failure becomes exit status 100, which leaves the job in its error
+state and keeps the jobs held on it from starting.
+
+With a ``status_dir`` each script also drops ``<call_id>.start`` when it
+starts and ``<call_id>.exit`` (holding the program's exit status) when the
+job ends, so the run that submitted it can follow the calls (see
+``blacktie.utils.executors.ClusterExecutor``).
+"""
+import os
+import re
+import sys
+import pipes
+
+from blacktie.utils.misc import uniques
+from blacktie.utils.externals import mkdirp,runExternalApp
+from blacktie.utils import errors
+
+
+def template_cache_dir():
+    """
+    Returns the directory Mako keeps compiled templates in (``$XDG_CACHE_HOME/blacktie/mako``).
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return '%s/blacktie/mako' % (base.rstrip('/'))
+
+
+# short job name prefixes (SGE truncates long job names)
+JOB_NICKNAMES = {'blacktie-fastq-qc':'qc',
+                 'tophat':'th',
+                 'blacktie-bam-stats':'bs',
+                 'cufflinks':'cl',
+                 'cuffmerge':'cm',
+                 'cuffdiff':'cd',
+                 'blacktie-cummerbund':'cb',}
+
+# stages with one call per condition; ``array_jobs: True`` means these
+PER_CONDITION_STAGES = ['blacktie-fastq-qc','tophat','blacktie-bam-stats','cufflinks']
+
+# submission command and where array jobs find their task id for each ``qsub_options.scheduler``;
+# ``failed_status`` is what a failed job exits with (``None``: the program's own status)
+SCHEDULERS = {'sge':{'command':'qsub','job_id_args':['-terse'],'task_id':'SGE_TASK_ID','status_command':'qstat',
+                     'cancel_command':'qdel','failed_status':100},
+              'slurm':{'command':'sbatch','job_id_args':['--parsable'],'task_id':'SLURM_ARRAY_TASK_ID','status_command':'squeue',
+                       'cancel_command':'scancel','failed_status':None}}
+
+_call_id_token = '@@BLACKTIE_CALL_ID@@'
+
+_job_variable_regex = re.compile(r'\$JOB_\d+')
+
+def _shell_arg(arg):
+    """
+    quotes ``arg`` for ``submit_all.sh``, leaving the job id variables in it expandable.
+    """
+    if _job_variable_regex.search(arg):
+        return '"%s"' % (arg)
+    return pipes.quote(arg)
+
+_job_name_regex = re.compile(r'[^\w.-]')
+
+
+def array_job_stages(option):
+    """
+    returns the stages that should be written as array jobs for a ``qsub_options.array_jobs`` value.
+
+    :param option: ``False``, ``True`` (the per-condition stages) or a list of stage names
+    """
+    if option is True:
+        return list(PER_CONDITION_STAGES)
+    if not option:
+        return []
+    if isinstance(option,basestring):
+        return [option]
+    return list(option)
+
+
+def _insert_after_directives(lines,new_lines):
+    """
+    inserts ``new_lines`` into the script ``lines`` right after its last ``#$``/``#SBATCH`` directive.
+    """
+    directives = [i for i,line in enumerate(lines) if line.startswith('#$') or line.startswith('#SBATCH')]
+    insert_at = directives[-1] + 1 if directives else 1
+    lines[insert_at:insert_at] = new_lines
+
+
+def dependency_options(scheduler,after,after_tasks):
+    """
+    returns the submission options that hold a job until others finish.
+
+    :param scheduler: 'sge' or 'slurm'
+    :param after: ids of jobs that must all finish successfully first
+    :param after_tasks: ids of array jobs whose task ``i`` must finish before this array job's task ``i``
+    """
+    if scheduler == 'sge':
+        options = []
+        if after:
+            options.extend(['-hold_jid',','.join(after)])
+        if after_tasks:
+            options.extend(['-hold_jid_ad',','.join(after_tasks)])
+        return options
+
+    dependencies = []
+    if after:
+        dependencies.append('afterok:%s' % (':'.join(after)))
+    if after_tasks:
+        dependencies.append('aftercorr:%s' % (':'.join(after_tasks)))
+    if dependencies:
+        # a job whose dependency failed would otherwise stay pending forever
+        return ['--dependency=%s' % (','.join(dependencies)),'--kill-on-invalid-dep=yes']
+    return []
+
+
+def cancel_args(scheduler,job_id,task=None):
+    """
+    returns the arguments of ``qdel``/``scancel`` that remove job ``job_id`` (or only its array task ``task``).
+    """
+    if task is None:
+        return [job_id]
+    if scheduler == 'sge':
+        return [job_id,'-t',str(task)]
+    return ['%s_%s' % (job_id,task)]
+
+
+def parse_job_id(output):
+    """
+    returns the job id from the output of ``qsub -terse`` (``123`` or ``123.1-4:1``)
+    or ``sbatch --parsable`` (``123`` or ``123;cluster``).
+    """
+    output = output.strip()
+    if not output:
+        raise errors.UnexpectedValueError('the scheduler did not report a job id')
+    return re.split(r'[.;\s]',output.split('\n')[-1])[0]
+
+
+class QsubJob(object):
+    """
+    One submission: the script of a single call, or an array job with one task per call.
+    """
+    def __init__(self,name,path,stage,call_ids,after,array=False):
+        """
+        initializes a ``QsubJob`` object
+
+        :param name: name of the job (the call id, or the stage for array jobs)
+        :param path: path of the script to submit
+        :param stage: the stage (program) the calls belong to
+        :param call_ids: ids of the calls this job runs, in task order for array jobs
+        :param after: one list of upstream call ids per call in ``call_ids``
+        :param array: ``True`` if this is an array job
+
+        :returns: an initialized ``QsubJob`` object
+        """
+        self.name = name
+        self.path = path
+        self.stage = stage
+        self.call_ids = call_ids
+        self.after = after
+        self.array = array
+        self.job_id = None
+
+
+_compiled_templates = {}
+
+def get_template(template_path,module_directory=None):
+    """
+    returns the compiled Mako template for ``template_path``, compiling it only the first time.
+
+    :param template_path: path to the Mako template
+    :param module_directory: where Mako caches the compiled template module (``None`` for memory only)
+    """
+    key = (os.path.abspath(template_path),module_directory)
+    if key not in _compiled_templates:
+        # Mako is only needed for qsub scripts and cluster runs
+        from mako.template import Template
+        _compiled_templates[key] = Template(filename=key[0],module_directory=module_directory)
+    return _compiled_templates[key]
+
+
+class QsubScriptWriter(object):
+    """
+    Renders qsub scripts from one compiled template and writes them in batches.
+    """
+    def __init__(self,template_path,out_dir,module_directory=None,buffer_size=1000,array_stages=None,run_id='',
+                 scheduler='sge',submit_command=None,status_dir=None):
+        """
+        initializes a ``QsubScriptWriter`` object
+
+        :param template_path: path to the Mako qsub template (``qsub_options.template``)
+        :param out_dir: directory the scripts are written to
+        :param module_directory: where Mako caches the compiled template module
+        :param buffer_size: number of rendered scripts kept before they are written
+        :param array_stages: stages written as one array job each (see ``array_job_stages()``)
+        :param run_id: id of the run, used to name array jobs
+        :param scheduler: 'sge' or 'slurm' (``qsub_options.scheduler``)
+        :param submit_command: program that submits a script (default ``qsub`` or ``sbatch``)
+        :param status_dir: directory the scripts record each call's start and exit status in (``None`` to skip)
+
+        :returns: an initialized ``QsubScriptWriter`` object
+        """
+        if scheduler not in SCHEDULERS:
+            raise errors.InvalidOptionError(scheduler,'qsub_options.scheduler',sorted(SCHEDULERS.keys()))
+        self.template_path = template_path
+        self.out_dir = out_dir.rstrip('/')
+        self.module_directory = module_directory
+        self.buffer_size = buffer_size
+        self.array_stages = array_stages or []
+        self.run_id = run_id
+        self.scheduler = scheduler
+        self.submit_command = submit_command or SCHEDULERS[scheduler]['command']
+        self.status_dir = status_dir
+        self.written = 0
+        self.jobs = []
+        self._buffer = []
+        self._tasks = {}
+        self._job_of_call = {}
+
+    def add(self,call_id,kw,stage=None,after=None):
+        """
+        renders the script for ``call_id`` with the template keywords ``kw``, or adds the call
+        to its stage's array job if ``stage`` is one of ``self.array_stages``.
+
+        :param after: ids of the calls whose output this call reads; the ones written by
+            this writer become scheduler dependencies
+
+        :returns: path the script will be written to
+        """
+        after = list(after or [])
+        if stage in self.array_stages:
+            self._tasks.setdefault(stage,[]).append((call_id,kw,after))
+            return self.array_script_path(stage)
+
+        template = get_template(self.template_path,self.module_directory)
+        path = '%s/%s.qsub.sh' % (self.out_dir,call_id)
+        kw = dict(kw,cmd_str='blacktie_run %s' % (kw['cmd_str']))
+        lines = template.render(**kw).split('\n')
+        _insert_after_directives(lines,['','CALL_ID=%s' % (pipes.quote(call_id))] + self.exit_lines() + self.status_lines())
+        text = '\n'.join(lines)
+        self._buffer.append((path,text))
+        self._add_job(QsubJob(call_id,path,stage,[call_id],[after]))
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+        return path
+
+    def job_of_call(self,call_id):
+        """
+        returns the ``QsubJob`` running ``call_id`` and the call's task index (0-based) in it.
+        """
+        return self._job_of_call[call_id]
+
+    def _add_job(self,job):
+        self.jobs.append(job)
+        for task,call_id in enumerate(job.call_ids):
+            self._job_of_call[call_id] = (job,task)
+
+    def exit_lines(self):
+        """
+        returns the script lines that make the job end with the exit status of the program run by
+        ``blacktie_run`` (and record it in ``self.status_dir``, if there is one).
+        """
+        lines = ['',
+                 '# end the job with the exit status of the program once the rest of the script (packing,',
+                 '# clean-up) has run, so the jobs that depend on this one do not start after a failure',
+                 'blacktie_run() { "$@"; BLACKTIE_STATUS=$?; return $BLACKTIE_STATUS; }',
+                 'blacktie_exit() {',
+                 '    local status=${BLACKTIE_STATUS:-$?}']
+        if self.status_dir:
+            lines.append('    if [ -n "$CALL_ID" ]; then echo $status > "$STATUS_DIR/$CALL_ID.exit"; fi')
+        failed_status = SCHEDULERS[self.scheduler]['failed_status']
+        if failed_status is not None:
+            lines.append('    if [ $status -ne 0 ]; then status=%s; fi' % (failed_status))
+        lines.extend(['    exit $status',
+                      '}',
+                      'trap blacktie_exit EXIT'])
+        return lines
+
+    def status_lines(self):
+        """
+        returns the script lines that record ``$CALL_ID``'s start in ``self.status_dir`` (none without one).
+        """
+        if not self.status_dir:
+            return []
+        return ['',
+                '# tell the blacktie run that submitted this job when the call starts and how it exits',
+                'STATUS_DIR=%s' % (pipes.quote(os.path.abspath(self.status_dir))),
+                'touch "$STATUS_DIR/$CALL_ID.start"']
+
+    def array_script_path(self,stage):
+        return '%s/%s.array.qsub.sh' % (self.out_dir,stage)
+
+    def add_array_job(self,stage,tasks):
+        """
+        renders one SGE array job running every call in ``tasks`` and writes its task table.
+
+        :param stage: the stage (program) the calls belong to
+        :param tasks: list of (call_id, template keywords, upstream call ids) in task order
+        """
+        mkdirp(self.out_dir)
+        table_path = '%s/%s.tasks.tsv' % (self.out_dir,stage)
+        table = open(table_path,'w')
+        for task_id,(call_id,kw,after) in enumerate(tasks,1):
+            table.write('%s\t%s\t%s\t%s\n' % (task_id,call_id,kw.out_dir,kw.cmd_str))
+        table.close()
+
+        array_kw = dict(tasks[0][1])
+        array_kw.update({'call_id':_call_id_token,
+                         'out_dir':'${OUT_DIR}',
+                         'cmd_str':'blacktie_run eval "$CMD"',
+                         'job_name':_job_name_regex.sub('_','%s_%s' % (JOB_NICKNAMES.get(stage,stage),self.run_id))})
+        lines = get_template(self.template_path,self.module_directory).render(**array_kw).split('\n')
+
+        # schedulers expand their own task placeholders (not shell variables) in directives,
+        # so each task gets its own -o/-e files
+        for i,line in enumerate(lines):
+            if line.startswith('#$'):
+                lines[i] = line.replace(_call_id_token,'%s.$TASK_ID' % (stage))
+            elif line.startswith('#SBATCH'):
+                lines[i] = line.replace(_call_id_token,'%s.%%a' % (stage))
+            else:
+                lines[i] = line.replace(_call_id_token,'${CALL_ID}')
+
+        if self.scheduler == 'slurm':
+            array_directive = '#SBATCH --array=1-%s' % (len(tasks))
+        else:
+            array_directive = '#$ -t 1-%s' % (len(tasks))
+        task_id = SCHEDULERS[self.scheduler]['task_id']
+
+        lookup = [array_directive] + self.exit_lines()
+        lookup.extend(['',
+                       '# look up the call this task runs (columns: task, call_id, out_dir, command)',
+                       'TASK_TABLE="%s"' % (os.path.abspath(table_path)),
+                       'IFS=$\'\\t\' read -r TASK CALL_ID OUT_DIR CMD <<< "$(awk -F\'\\t\' -v id="$%s" \'$1 == id {print; exit}\' "$TASK_TABLE")"' % (task_id),
+                       'if [ -z "$CALL_ID" ]; then echo "task $%s not found in $TASK_TABLE" >&2; exit 1; fi' % (task_id),
+                       'echo "task $%s: $CALL_ID"' % (task_id)])
+        lookup.extend(self.status_lines())
+        _insert_after_directives(lines,lookup)
+        path = self.array_script_path(stage)
+        self._buffer.append((path,'\n'.join(lines)))
+        self._add_job(QsubJob(stage,path,stage,[t[0] for t in tasks],[t[2] for t in tasks],array=True))
+
+    def end_stage(self,stage):
+        """
+        writes the array job of ``stage`` (if it has one) and every buffered script.
+        """
+        tasks = self._tasks.pop(stage,None)
+        if tasks:
+            self.add_array_job(stage,tasks)
+        self.flush()
+
+    def flush(self):
+        """
+        writes every buffered script.
+        """
+        if not self._buffer:
+            return
+        mkdirp(self.out_dir)
+        buffer,self._buffer = self._buffer,[]
+        for path,text in buffer:
+            out_file = open(path,'w')
+            out_file.write(text)
+            out_file.close()
+        self.written += len(buffer)
+
+    def upstream_jobs(self,job):
+        """
+        returns the jobs ``job`` has to wait for as two lists: jobs that must finish completely and
+        array jobs whose task ``i`` only has to finish before task ``i`` of ``job``.
+
+        Calls that were not written by this writer (e.g. from an earlier ``--prog``) are not waited for.
+        """
+        task_deps = []
+        for call_ids in job.after:
+            task_deps.append([self._job_of_call[c] for c in call_ids if c in self._job_of_call])
+
+        after = []
+        after_tasks = []
+        for upstream in uniques([u for deps in task_deps for u,task in deps]):
+            aligned = (job.array and upstream.array and len(upstream.call_ids) == len(job.call_ids))
+            if aligned:
+                for task,deps in enumerate(task_deps):
+                    if [d for d in deps if d[0] is upstream] != [(upstream,task)]:
+                        aligned = False
+                        break
+            if aligned:
+                after_tasks.append(upstream)
+            else:
+                after.append(upstream)
+        return after,after_tasks
+
+    def submit_args(self,job,job_id_of):
+        """
+        returns the argv that submits ``job`` once its upstream jobs have been submitted.
+
+        :param job_id_of: callable returning the job id (or a shell variable holding it) of a submitted ``QsubJob``
+        """
+        after,after_tasks = self.upstream_jobs(job)
+        return ([self.submit_command] + SCHEDULERS[self.scheduler]['job_id_args'] +
+                dependency_options(self.scheduler,[job_id_of(j) for j in after],[job_id_of(j) for j in after_tasks]) +
+                [os.path.abspath(job.path)])
+
+    def write_submit_script(self):
+        """
+        writes ``submit_all.sh``, which submits every job in order with its dependencies and
+        prints one "<job name> <job id>" line per job.
+
+        :returns: path of the script
+        """
+        variables = {}
+        def job_id_of(job):
+            return '$%s' % (variables[job])
+
+        lines = ['#!/bin/bash',
+                 '# submits the %s scripts of run %s; each job waits for the jobs whose output it reads' % (self.scheduler,self.run_id),
+                 'set -e',
+                 '']
+        for number,job in enumerate(self.jobs,1):
+            variables[job] = 'JOB_%s' % (number)
+            lines.append('%s=$(%s)' % (variables[job],' '.join([_shell_arg(arg) for arg in self.submit_args(job,job_id_of)])))
+            lines.append('%s=${%s%%%%[.;]*}' % (variables[job],variables[job]))
+            lines.append('echo "%s $%s"' % (job.name,variables[job]))
+
+        path = '%s/submit_all.sh' % (self.out_dir)
+        mkdirp(self.out_dir)
+        out_file = open(path,'w')
+        out_file.write('\n'.join(lines) + '\n')
+        out_file.close()
+        os.chmod(path,0755)
+        return path
+
+    def submit(self):
+        """
+        submits every job in order with its dependencies and records the job ids in ``jobs.tsv``.
+
+        :returns: list of the submitted ``QsubJob`` objects
+        """
+        jobs_path = '%s/jobs.tsv' % (self.out_dir)
+        mkdirp(self.out_dir)
+        jobs_file = open(jobs_path,'w')
+        try:
+            for job in self.jobs:
+                stdout,stderr = runExternalApp(progName=self.submit_command,argList=self.submit_args(job,lambda j: j.job_id)[1:])
+                job.job_id = parse_job_id(stdout)
+                jobs_file.write('%s\t%s\t%s\t%s\n' % (job.job_id,job.name,job.stage,','.join(job.call_ids)))
+                jobs_file.flush()
+        finally:
+            jobs_file.close()
+        sys.stdout.write('[Note] %s jobs submitted with %s; job ids are in %s\n\n' % (len(self.jobs),self.submit_command,jobs_path))
+        return self.jobs
+
+    def close(self):
+        """
+        writes anything still buffered plus ``submit_all.sh`` and reports where the scripts went.
+        """
+        for stage in self._tasks.keys():
+            self.end_stage(stage)
+        self.flush()
+        if self.jobs:
+            self.write_submit_script()
+        if self.written:
+            sys.stdout.write('[Note] %s qsub scripts written to %s (submit them all with submit_all.sh)\n\n' % (self.written,self.out_dir))
@@ -0,0 +1,317 @@
+#*****************************************************************************
+#  readqc.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+readqc.py
+####################
+Code to summarize a condition's fastqs before they are aligned.
+
+Each file is read in large chunks (gzipped files through ``pigz``/``gzip``)
+and every chunk is cut at a record boundary and scanned as one NumPy byte
+array: newlines are found once and give the start and kind of every line,
+from which read lengths, base composition and per-position quality sums
+fall out of a handful of vectorized passes.  Files are scanned at the same
+time from a pool of threads (NumPy and the decompressors do their work
+outside the GIL).
+
+``FastqQC`` combines the files of both mates into a per-condition summary
+with read counts, length distribution, per-position mean quality, GC
+content, left/right agreement and a sanity check of tophat's ``-r`` and
+``--mate-std-dev`` against the read lengths actually seen.
+"""
+import os
+import json
+
+from blacktie.utils.sharding import open_fastq,finish_fastq
+from blacktie.utils import errors
+
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# set by load_numpy(): the QC stage is the only part of blacktie that needs it
+np = None
+
+
+def load_numpy():
+    """
+    imports NumPy the first time it is called.
+    """
+    global np
+    if np is None:
+        try:
+            import numpy
+        except ImportError:
+            raise errors.BlacktieError('Unable to import required module: "numpy".  Try installing it with "[sudo] pip install numpy".')
+        np = numpy
+    return np
+
+def _add_counts(totals,counts):
+    """
+    returns the element-wise sum of two count arrays of possibly different lengths.
+    """
+    if len(totals) < len(counts):
+        totals,counts = counts,totals
+    totals = totals.copy()
+    totals[:len(counts)] += counts
+    return totals
+
+
+class FastqStats(object):
+    """
+    Accumulates the statistics of one or more fastq files.
+    """
+    def __init__(self):
+        """
+        initializes an empty ``FastqStats`` object
+        """
+        load_numpy()
+        self.paths = []
+        self.reads = 0
+        self.bases = 0
+        self.gc = 0
+        self.n = 0
+        self.min_qual = 255
+        self.max_qual = 0
+        self.lengths = np.zeros(1,dtype=np.int64)
+        self.qual_sums = np.zeros(0,dtype=np.float64)
+        self.qual_counts = np.zeros(0,dtype=np.int64)
+
+    def scan_chunk(self,data,path=''):
+        """
+        adds the records in ``data`` (a string of complete fastq records) to the totals.
+        """
+        a = np.frombuffer(data,dtype=np.uint8)
+        is_nl = (a == 10)
+        nl = np.flatnonzero(is_nl)
+        if len(nl) % 4:
+            raise errors.InvalidFileFormatError('%s: chunk does not end on a record boundary.' % (path))
+        if not len(nl):
+            return
+        starts = np.empty(len(nl),dtype=np.int64)
+        starts[0] = 0
+        starts[1:] = nl[:-1] + 1
+        if (a[starts[0::4]] != ord('@')).any() or (a[starts[2::4]] != ord('+')).any():
+            raise errors.InvalidFileFormatError('%s: malformed fastq record (header not starting with "@" or separator with "+").' % (path))
+        seq_lengths = nl[1::4] - starts[1::4]
+        if (seq_lengths != nl[3::4] - starts[3::4]).any():
+            raise errors.InvalidFileFormatError('%s: a read whose sequence and quality lengths differ.' % (path))
+
+        # line number of every byte; the newline ends (and belongs to) its line
+        line_no = np.cumsum(is_nl) - is_nl
+        kind = line_no & 3
+
+        bases = a[(kind == 1) & ~is_nl] | 32  # lower case
+        self.gc += int(np.count_nonzero((bases == ord('g')) | (bases == ord('c'))))
+        self.n += int(np.count_nonzero(bases == ord('n')))
+
+        qual_index = np.flatnonzero((kind == 3) & ~is_nl)
+        if len(qual_index):
+            quals = a[qual_index]
+            positions = qual_index - starts[line_no[qual_index]]
+            self.qual_sums = _add_counts(self.qual_sums,np.bincount(positions,weights=quals))
+            self.qual_counts = _add_counts(self.qual_counts,np.bincount(positions))
+            self.min_qual = min(self.min_qual,int(quals.min()))
+            self.max_qual = max(self.max_qual,int(quals.max()))
+
+        self.lengths = _add_counts(self.lengths,np.bincount(seq_lengths))
+        self.reads += len(seq_lengths)
+        self.bases += int(seq_lengths.sum())
+
+    def scan(self,path,chunk_size=CHUNK_SIZE):
+        """
+        scans the fastq at ``path`` ``chunk_size`` bytes at a time.
+        """
+        self.paths.append(path)
+        in_file = open_fastq(path)
+        try:
+            rest = ''
+            while True:
+                block = in_file.read(chunk_size)
+                data = rest + block
+                if not block:
+                    break
+                # cut after the last complete record; the rest waits for the next block
+                nl = np.flatnonzero(np.frombuffer(data,dtype=np.uint8) == 10)
+                complete = len(nl) - len(nl) % 4
+                if not complete:
+                    rest = data
+                    continue
+                cut = int(nl[complete - 1]) + 1
+                self.scan_chunk(data[:cut],path)
+                rest = data[cut:]
+            finish_fastq(in_file)
+        finally:
+            in_file.close()
+        if data.strip():
+            if not data.endswith('\n'):
+                data += '\n'
+            if data.count('\n') % 4:
+                raise errors.InvalidFileFormatError('%s: truncated fastq record at the end of the file.' % (path))
+            self.scan_chunk(data,path)
+        return self
+
+    def merge(self,other):
+        """
+        adds the totals of ``other`` to this object.
+        """
+        self.paths.extend(other.paths)
+        self.reads += other.reads
+        self.bases += other.bases
+        self.gc += other.gc
+        self.n += other.n
+        self.min_qual = min(self.min_qual,other.min_qual)
+        self.max_qual = max(self.max_qual,other.max_qual)
+        self.lengths = _add_counts(self.lengths,other.lengths)
+        self.qual_sums = _add_counts(self.qual_sums,other.qual_sums)
+        self.qual_counts = _add_counts(self.qual_counts,other.qual_counts)
+        return self
+
+    def quality_offset(self):
+        """
+        returns the phred offset of the qualities seen (33 unless every quality is 59 (';') or more).
+        """
+        if self.reads and self.min_qual >= 59:
+            return 64
+        return 33
+
+    def summary(self):
+        """
+        returns the totals as a ``dict`` ready for JSON.
+        """
+        observed = np.flatnonzero(self.lengths)
+        if self.reads:
+            mean_length = float(self.bases) / self.reads
+        else:
+            mean_length = 0.0
+        offset = self.quality_offset()
+        counts = np.maximum(self.qual_counts,1)
+        return {'files':list(self.paths),
+                'reads':self.reads,
+                'bases':self.bases,
+                'length':{'min':int(observed[0]) if len(observed) else 0,
+                          'max':int(observed[-1]) if len(observed) else 0,
+                          'mean':round(mean_length,2),
+                          'histogram':dict([(str(int(l)),int(self.lengths[l])) for l in observed])},
+                'gc_percent':round(100.0 * self.gc / max(self.bases - self.n,1),2),
+                'n_percent':round(100.0 * self.n / max(self.bases,1),4),
+                'quality_offset':offset,
+                'mean_quality_by_position':[round(q,2) for q in (self.qual_sums / counts - offset).tolist()]}
+
+
+def _scan_task(task):
+    path,chunk_size = task
+    return FastqStats().scan(path,chunk_size)
+
+
+def check_mate_distance(mate_inner_dist,mate_std_dev,mean_length,max_length):
+    """
+    returns warnings about tophat's ``-r`` and ``--mate-std-dev`` given the read lengths seen.
+
+    ``-r`` is the distance between the mates' inner ends, so the fragment it implies is
+    ``r + 2 * read length``.
+    """
+    warnings = []
+    if mate_inner_dist is not None:
+        fragment = mate_inner_dist + 2 * mean_length
+        if fragment < max_length:
+            warnings.append('r=%s implies fragments of %.0f bp, shorter than the longest read (%s bp); '
+                            'r is the inner distance between mates (fragment length minus both reads).'
+                            % (mate_inner_dist,fragment,max_length))
+        elif mate_inner_dist < -mean_length:
+            warnings.append('r=%s means mates overlap by more than a whole read (mean length %.1f bp).'
+                            % (mate_inner_dist,mean_length))
+        if mate_std_dev is not None and mate_std_dev > fragment > 0:
+            warnings.append('mate-std-dev=%s is larger than the %.0f bp fragments implied by r=%s.'
+                            % (mate_std_dev,fragment,mate_inner_dist))
+    if mate_std_dev is not None and mate_std_dev <= 0:
+        warnings.append('mate-std-dev=%s should be positive.' % (mate_std_dev))
+    return warnings
+
+
+class FastqQC(object):
+    """
+    Summarizes the left and right fastqs of one condition.
+    """
+    def __init__(self,left_reads,right_reads=(),threads=4,chunk_size=CHUNK_SIZE):
+        """
+        initializes a ``FastqQC`` object
+
+        :param left_reads: list of left-mate (or single-end) fastq files
+        :param right_reads: list of right-mate fastq files in the same order (empty for single-end reads)
+        :param threads: number of files scanned at once
+        :param chunk_size: bytes read and scanned at a time per file
+
+        :returns: an initialized ``FastqQC`` object
+        """
+        load_numpy()
+        self.left_reads = list(left_reads)
+        self.right_reads = list(right_reads)
+        self.threads = threads
+        self.chunk_size = chunk_size
+
+    def run(self,mate_inner_dist=None,mate_std_dev=None):
+        """
+        scans every file and returns the condition's summary as a ``dict``.
+
+        :param mate_inner_dist: tophat's ``-r`` for this condition, to be checked (``None`` to skip)
+        :param mate_std_dev: tophat's ``--mate-std-dev`` for this condition, to be checked (``None`` to skip)
+        """
+        paths = self.left_reads + self.right_reads
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1,min(self.threads,len(paths))))
+        try:
+            stats = pool.map(_scan_task,[(p,self.chunk_size) for p in paths])
+        finally:
+            pool.close()
+            pool.join()
+        left_stats = stats[:len(self.left_reads)]
+        right_stats = stats[len(self.left_reads):]
+
+        warnings = []
+        result = {'paired':bool(right_stats),'warnings':warnings}
+        for side,side_stats in [('left',left_stats),('right',right_stats)]:
+            if not side_stats:
+                continue
+            total = FastqStats()
+            for file_stats in side_stats:
+                total.merge(file_stats)
+            result[side] = total.summary()
+            result[side]['reads_by_file'] = [s.reads for s in side_stats]
+            if not total.reads:
+                warnings.append('%s reads: no reads in %s.' % (side,','.join(total.paths)))
+
+        if right_stats:
+            mismatched = ['%s (%s) vs %s (%s)' % (l.paths[0],l.reads,r.paths[0],r.reads)
+                          for l,r in zip(left_stats,right_stats) if l.reads != r.reads]
+            result['pairs_agree'] = (len(left_stats) == len(right_stats) and not mismatched)
+            if len(left_stats) != len(right_stats):
+                warnings.append('%s left read files but %s right read files.' % (len(left_stats),len(right_stats)))
+            for pair in mismatched:
+                warnings.append('left and right read counts differ: %s.' % (pair))
+            lengths = [result[s]['length'] for s in ['left','right']]
+            mean_length = (lengths[0]['mean'] + lengths[1]['mean']) / 2.0
+            warnings.extend(check_mate_distance(mate_inner_dist,mate_std_dev,mean_length,
+                                                max([l['max'] for l in lengths])))
+        elif mate_inner_dist is not None:
+            warnings.append('r=%s is ignored for single-end reads.' % (mate_inner_dist))
+        return result
+
+
+def load_fastq_qc(out_dir):
+    """
+    returns the summary written by ``blacktie-fastq-qc`` into ``out_dir`` or ``None`` if there is none.
+    """
+    path = '%s/fastq_qc.json' % (out_dir.rstrip('/'))
+    if not os.path.exists(path):
+        return None
+    return json.load(open(path))
@@ -0,0 +1,454 @@
+#*****************************************************************************
+#  references.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+references.py
+####################
+Code to prepare a run's genomes and annotations once, before the calls that read them.
+
+Cufflinks (``frag-bias-correct``), cuffmerge (``ref-sequence``) and cuffdiff
+(``frag-bias-correct``) all read ``genome_seq`` and build its ``.fai`` when
+there is none; run side by side they race to write it.  ``ReferenceCache``
+keeps one entry per distinct file *content* under ``run_options.reference_dir``:
+
+    - genomes: a link to the FASTA with a ``.fai`` beside it, built natively
+      (the FASTA is ``mmap``-ed and scanned a line-width-aligned chunk at a time).
+    - GTFs: a JSON summary (features by type, genes, transcripts and the
+      span of every seqname) used to check the GTF against its genome.
+    - transcriptomes: the tophat ``--transcriptome-index`` of a GTF and a
+      bowtie2 index, built once (calls that need it at the same time wait
+      for the first) instead of by every tophat call from its ``-G``.
+
+Entries are keyed by the SHA1 of the file, which is remembered per path,
+size, mtime and inode, so an unchanged reference is hashed once and a
+re-run, or another run of the same genome, finds its entry ready.
+"""
+import os
+import re
+import glob
+import json
+import mmap
+import time
+import fcntl
+import hashlib
+import shutil
+from collections import defaultdict
+
+from blacktie.utils.externals import mkdirp,runExternalApp
+from blacktie.utils.warmup import index_files
+from blacktie.utils import errors
+
+
+FAI_CHUNK = 64 * 1024 * 1024
+HASH_BLOCK = 8 * 1024 * 1024
+
+GENOME_OPTIONS = [('cufflinks','frag-bias-correct'),('cuffmerge','ref-sequence'),('cuffdiff','frag-bias-correct')]
+GTF_OPTIONS = [('tophat','G'),('cufflinks','GTF-guide'),('cufflinks','GTF'),('cuffmerge','ref-gtf')]
+
+GTF_ID = re.compile(r'(gene_id|transcript_id) "([^"]*)"')
+
+
+def file_sha1(path):
+    """
+    returns the SHA1 hex digest of the content of ``path``.
+    """
+    digest = hashlib.sha1()
+    in_file = open(path,'rb')
+    try:
+        while True:
+            block = in_file.read(HASH_BLOCK)
+            if not block:
+                break
+            digest.update(block)
+    finally:
+        in_file.close()
+    return digest.hexdigest()
+
+def write_atomic(path,text):
+    """
+    writes ``text`` to ``path`` through a temporary file so readers never see a partial file.
+    """
+    tmp_path = '%s.%s.tmp' % (path,os.getpid())
+    out_file = open(tmp_path,'w')
+    try:
+        out_file.write(text)
+    finally:
+        out_file.close()
+    os.rename(tmp_path,path)
+
+
+# ++++++++ FASTA index ++++++++
+
+def _sequence_entry(m,path,name,start,end):
+    """
+    returns the ``.fai`` fields of the sequence stored in ``m[start:end]``.
+    """
+    if start >= end:
+        return (name,0,start,0,0)
+    first_nl = m.find('\n',start,end)
+    if first_nl < 0:
+        # a single line at the end of the file without a newline
+        line_bases = len(m[start:end].rstrip('\r'))
+        return (name,line_bases,start,line_bases,line_bases + 1)
+    line_width = first_nl - start + 1
+    line_bases = line_width - 1
+    if first_nl > start and m[first_nl - 1] == '\r':
+        line_bases -= 1
+
+    newlines = 0
+    returns = 0
+    chunk_size = line_width * max(1,FAI_CHUNK // line_width)
+    offset = start
+    while offset < end:
+        chunk = m[offset:min(offset + chunk_size,end)]
+        offset += len(chunk)
+        full = len(chunk) // line_width
+        lines = chunk[:full * line_width]
+        tail = chunk[full * line_width:]
+        # every full line ends exactly one line width after the one before it and
+        # only the last line of the sequence (or blank lines after it) may be shorter
+        if (lines[line_width - 1::line_width].count('\n') != full or lines.count('\n') != full
+            or (tail and (offset < end or '\n' in tail.rstrip('\r\n')))):
+            raise errors.InvalidFileFormatError('%s: sequence "%s" has lines of different lengths.' % (path,name))
+        newlines += full + tail.count('\n')
+        returns += chunk.count('\r')
+    return (name,end - start - newlines - returns,start,line_bases,line_width)
+
+def fasta_index(path):
+    """
+    returns the ``samtools faidx`` entries (name, length, offset, line bases, line width) of the FASTA ``path``.
+    """
+    in_file = open(path,'rb')
+    try:
+        size = os.fstat(in_file.fileno()).st_size
+        if not size:
+            raise errors.InvalidFileFormatError('%s: empty FASTA file.' % (path))
+        m = mmap.mmap(in_file.fileno(),0,access=mmap.ACCESS_READ)
+    finally:
+        in_file.close()
+    try:
+        if m[0] != '>':
+            raise errors.InvalidFileFormatError('%s: FASTA file does not start with ">".' % (path))
+        entries = []
+        pos = 0
+        while pos < size:
+            eol = m.find('\n',pos)
+            if eol < 0:
+                eol = size
+            header = m[pos + 1:eol].split()
+            if not header:
+                raise errors.InvalidFileFormatError('%s: FASTA header without a name at byte %s.' % (path,pos))
+            next_header = m.find('\n>',eol)
+            if next_header < 0:
+                seq_end = size
+            else:
+                seq_end = next_header + 1
+            entries.append(_sequence_entry(m,path,header[0],min(eol + 1,size),seq_end))
+            pos = seq_end
+    finally:
+        m.close()
+    names = [e[0] for e in entries]
+    if len(set(names)) != len(names):
+        raise errors.InvalidFileFormatError('%s: duplicate sequence names.' % (path))
+    return entries
+
+def format_fai(entries):
+    """
+    returns the ``.fai`` file text of ``entries``.
+    """
+    return ''.join(['%s\t%s\t%s\t%s\t%s\n' % entry for entry in entries])
+
+def read_fai(path):
+    """
+    returns a ``dict`` of sequence name to length from the ``.fai`` file ``path``.
+    """
+    lengths = {}
+    for line in open(path):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) >= 2:
+            lengths[fields[0]] = int(fields[1])
+    return lengths
+
+
+# ++++++++ GTF summary ++++++++
+
+def gtf_summary(path):
+    """
+    returns features by type, gene and transcript counts and the span of every seqname of the GTF ``path``.
+    """
+    features = defaultdict(int)
+    seqnames = {}
+    genes = set()
+    transcripts = set()
+    line_no = 0
+    for line in open(path):
+        line_no += 1
+        if line.startswith('#') or not line.strip():
+            continue
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) < 9:
+            raise errors.InvalidFileFormatError('%s line %s: expected 9 tab separated fields, found %s.' % (path,line_no,len(fields)))
+        try:
+            start,end = int(fields[3]),int(fields[4])
+        except ValueError:
+            raise errors.InvalidFileFormatError('%s line %s: start and end must be integers.' % (path,line_no))
+        features[fields[2]] += 1
+        span = seqnames.get(fields[0])
+        if span is None:
+            seqnames[fields[0]] = {'features':1,'start':start,'end':end}
+        else:
+            span['features'] += 1
+            span['start'] = min(span['start'],start)
+            span['end'] = max(span['end'],end)
+        for key,value in GTF_ID.findall(fields[8]):
+            if key == 'gene_id':
+                genes.add(value)
+            else:
+                transcripts.add(value)
+    return {'features':dict(features),
+            'genes':len(genes),
+            'transcripts':len(transcripts),
+            'seqnames':seqnames}
+
+def check_gtf_against_genome(summary,lengths):
+    """
+    returns problems of a GTF ``summary`` given the sequence ``lengths`` of its genome.
+    """
+    problems = []
+    missing = sorted([s for s in summary['seqnames'] if s not in lengths])
+    if missing:
+        problems.append('%s GTF seqname(s) not in the genome: %s%s'
+                        % (len(missing),', '.join(missing[:5]),' ...' if len(missing) > 5 else ''))
+    beyond = sorted([s for s,span in summary['seqnames'].iteritems() if s in lengths and span['end'] > lengths[s]])
+    if beyond:
+        problems.append('features run past the end of %s sequence(s): %s%s'
+                        % (len(beyond),', '.join(beyond[:5]),' ...' if len(beyond) > 5 else ''))
+    return problems
+
+
+# ++++++++ cache ++++++++
+
+class ReferenceCache(object):
+    """
+    Prepares genomes and GTFs once per distinct content under a shared directory.
+    """
+    def __init__(self,reference_dir):
+        """
+        initializes a ``ReferenceCache`` object
+
+        :param reference_dir: shared directory holding the prepared references; environment variables are expanded
+
+        :returns: an initialized ``ReferenceCache`` object
+        """
+        self.reference_dir = os.path.abspath(os.path.expanduser(os.path.expandvars(reference_dir)))
+        mkdirp('%s/identities' % (self.reference_dir))
+
+    def content_id(self,path):
+        """
+        returns the SHA1 of the content of ``path``, hashing it only if it changed since it was last seen.
+        """
+        stat = os.stat(path)
+        memo_path = '%s/identities/%s.json' % (self.reference_dir,hashlib.sha1(os.path.abspath(path)).hexdigest()[:16])
+        seen = [stat.st_size,int(stat.st_mtime),stat.st_ino]
+        if os.path.exists(memo_path):
+            try:
+                memo = json.load(open(memo_path))
+                if memo['stat'] == seen:
+                    return str(memo['sha1'])
+            except (ValueError,KeyError):
+                pass
+        sha1 = file_sha1(path)
+        write_atomic(memo_path,json.dumps({'path':os.path.abspath(path),'stat':seen,'sha1':sha1}))
+        return sha1
+
+    def entry_dir(self,path):
+        """
+        returns the directory of the cache entry for the content of ``path``.
+        """
+        return '%s/%s' % (self.reference_dir,self.content_id(path)[:16])
+
+    def _prepare(self,path,build,finish=None):
+        """
+        calls ``build(entry_dir)`` under the entry's lock unless the entry is complete, then
+        ``finish(entry_dir)`` (if given) under the same lock either way; returns
+        (entry_dir, seconds spent building or ``None`` if it was ready).
+        """
+        entry_dir = self.entry_dir(path)
+        mkdirp(entry_dir)
+        lock = open('%s.lock' % (entry_dir),'a')
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        try:
+            seconds = None
+            if not os.path.exists('%s/.complete' % (entry_dir)):
+                start = time.time()
+                build(entry_dir)
+                open('%s/.complete' % (entry_dir),'w').close()
+                seconds = round(time.time() - start,2)
+            if finish is not None:
+                finish(entry_dir)
+            return entry_dir,seconds
+        finally:
+            fcntl.flock(lock,fcntl.LOCK_UN)
+            lock.close()
+
+    def prepare_genome(self,path):
+        """
+        returns the prepared copy of the FASTA ``path`` (a link to it with a ``.fai`` beside it) as a ``dict``.
+        """
+        def build(entry_dir):
+            entries = fasta_index(path)
+            write_atomic('%s/reference.fai' % (entry_dir),format_fai(entries))
+            write_atomic('%s/reference.json' % (entry_dir),
+                         json.dumps({'kind':'genome','source':os.path.abspath(path),
+                                     'sequences':len(entries),'length':sum([e[1] for e in entries])},indent=2))
+
+        def add_links(entry_dir):
+            # the same content may turn up under other names or paths; each name gets its own link
+            link = '%s/%s' % (entry_dir,os.path.basename(path))
+            if not os.path.exists(link):
+                if os.path.lexists(link):
+                    os.remove(link)
+                os.symlink(os.path.abspath(path),link)
+            if not os.path.lexists('%s.fai' % (link)):
+                os.symlink('reference.fai','%s.fai' % (link))
+
+        entry_dir,seconds = self._prepare(path,build,finish=add_links)
+        link = '%s/%s' % (entry_dir,os.path.basename(path))
+        info = json.load(open('%s/reference.json' % (entry_dir)))
+        return {'source':path,'path':link,'sequences':info['sequences'],'length':info['length'],'seconds':seconds}
+
+    def prepare_gtf(self,path):
+        """
+        returns the summary of the GTF ``path`` (see ``gtf_summary``) as a ``dict``.
+        """
+        def build(entry_dir):
+            summary = gtf_summary(path)
+            summary['kind'] = 'gtf'
+            summary['source'] = os.path.abspath(path)
+            write_atomic('%s/reference.json' % (entry_dir),json.dumps(summary,indent=2,sort_keys=True))
+
+        entry_dir,seconds = self._prepare(path,build)
+        summary = json.load(open('%s/reference.json' % (entry_dir)))
+        summary['source'] = path
+        summary['seconds'] = seconds
+        return summary
+
+    def transcriptome_prefix(self,gtf,bowtie_index):
+        """
+        returns the prefix of the tophat transcriptome index for ``gtf`` and the bowtie2 index
+        ``bowtie_index`` (built or not); it is keyed by the content of all of their files.
+        """
+        key = hashlib.sha1(self.content_id(gtf))
+        for path in index_files(bowtie_index):
+            key.update('\0%s\0%s' % (path[len(bowtie_index):],self.content_id(path)))
+        return '%s/transcriptome/%s/%s' % (self.reference_dir,key.hexdigest()[:16],
+                                           os.path.splitext(os.path.basename(gtf))[0])
+
+    def genome_lengths(self,prepared):
+        """
+        returns the sequence lengths of a genome returned by ``prepare_genome``.
+        """
+        return read_fai('%s.fai' % (prepared['path']))
+
+
+def transcriptome_index_ready(prefix):
+    """
+    returns ``True`` if the transcriptome index ``prefix`` has been built.
+    """
+    return os.path.exists('%s/.complete' % (os.path.dirname(prefix)))
+
+def build_transcriptome_index(prefix,gtf,bowtie_index,tophat='tophat',threads=None):
+    """
+    builds the tophat transcriptome index ``prefix`` from ``gtf`` and ``bowtie_index`` unless it is
+    ready; other processes building the same index wait for the first one to finish.
+
+    :returns: the seconds spent building it or ``None`` if it was ready
+    """
+    entry_dir = os.path.dirname(prefix)
+    mkdirp(os.path.dirname(entry_dir))
+    lock = open('%s.lock' % (entry_dir),'a')
+    fcntl.flock(lock,fcntl.LOCK_EX)
+    try:
+        if transcriptome_index_ready(prefix):
+            return None
+        # whatever an interrupted build left behind
+        shutil.rmtree(entry_dir,ignore_errors=True)
+        mkdirp(entry_dir)
+        arg_list = ['-G',gtf,'--transcriptome-index',prefix,'-o','%s/tophat_out' % (entry_dir)]
+        if threads:
+            arg_list = ['-p',str(threads)] + arg_list
+        arg_list.append(bowtie_index)
+        start = time.time()
+        stdout,stderr = runExternalApp(tophat,argList=arg_list)
+        write_atomic('%s/build.log' % (entry_dir),'%s %s\n%s%s' % (tophat,' '.join(arg_list),stdout,stderr))
+        if not (glob.glob('%s.1.bt2*' % (prefix)) and os.path.exists('%s.gff' % (prefix))):
+            raise errors.BlacktieError('%s did not write the transcriptome index %s (see %s/build.log).' % (tophat,prefix,entry_dir))
+        seconds = round(time.time() - start,2)
+        write_atomic('%s/reference.json' % (entry_dir),
+                     json.dumps({'kind':'transcriptome','gtf':os.path.abspath(gtf),
+                                 'bowtie2_index':os.path.abspath(bowtie_index),'seconds':seconds},indent=2))
+        open('%s/.complete' % (entry_dir),'w').close()
+        return seconds
+    finally:
+        fcntl.flock(lock,fcntl.LOCK_UN)
+        lock.close()
+
+def use_gtf(command,prefix,gtf):
+    """
+    returns ``command`` with ``--transcriptome-index <prefix>`` replaced by ``-G <gtf>``.
+    """
+    command = list(command)
+    for i in range(len(command) - 1):
+        if command[i] == '--transcriptome-index' and command[i + 1] == prefix:
+            command[i:i + 2] = ['-G',gtf]
+            break
+    return command
+
+
+def _resolve(yargs,stage,option_name,key,condition):
+    """
+    returns the value of ``<stage>_options[option_name]`` for ``condition`` (``None`` if it is unset).
+    """
+    prog_yargs = yargs.get('%s_options' % (stage))
+    if not prog_yargs:
+        return None
+    option = prog_yargs.get(option_name)
+    if option == 'from_conditions':
+        option = condition.get(key)
+    return option or None
+
+def reference_needs(yargs,stages):
+    """
+    returns the distinct genomes and GTFs read by ``stages`` and the (genome, GTF) pairs of the conditions.
+    """
+    genomes = []
+    gtfs = []
+    pairs = []
+    for condition in yargs.condition_queue:
+        genome = None
+        gtf = None
+        for stage,option_name in GENOME_OPTIONS:
+            if stage in stages:
+                path = _resolve(yargs,stage,option_name,'genome_seq',condition)
+                if path and path not in genomes:
+                    genomes.append(path)
+                genome = genome or path
+        for stage,option_name in GTF_OPTIONS:
+            if stage in stages:
+                path = _resolve(yargs,stage,option_name,'gtf_annotation',condition)
+                if path and path not in gtfs:
+                    gtfs.append(path)
+                gtf = gtf or path
+        if genome and gtf and (genome,gtf) not in pairs:
+            pairs.append((genome,gtf))
+    return genomes,gtfs,pairs
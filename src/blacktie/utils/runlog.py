@@ -0,0 +1,171 @@
+#*****************************************************************************
+#  runlog.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+runlog.py
+####################
+Code defining a single-writer logger shared by every call in a run.
+
+The main process owns all log files and writes them from one background
+thread.  Callers (including calls running in forked ``pprocess`` workers)
+send messages to it over a ``channel.MessagePipe`` created before any worker
+is forked, so output from parallel calls never interleaves.
+
+Two kinds of output are kept:
+
+* the human readable per-call logs (``<call_id>.log``) and run log
+  (``<run_id>.log``), buffered in memory and appended to in batches, and
+* a run-wide JSON-lines event log (``<run_id>.events.jsonl``).
+"""
+import os
+import sys
+import atexit
+import json
+import time
+import threading
+
+from blacktie.utils.channel import MessagePipe
+
+
+class RunLogger(object):
+    """
+    Collects log text and structured events from all calls and writes them from a single thread.
+    """
+    def __init__(self,events_file,flush_interval=2.0,max_buffer=1024*1024):
+        """
+        initializes a ``RunLogger`` object and starts its writer thread
+
+        :param events_file: path of the JSON-lines event log
+        :param flush_interval: seconds between writes of buffered text to disk
+        :param max_buffer: bytes of buffered text that trigger an early write
+
+        :returns: an initialized ``RunLogger`` object
+        """
+        self.events_file = events_file
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._pipe = MessagePipe()
+        self._buffers = {}
+        self._buffered_bytes = 0
+        self._events = []
+        self._closed = False
+
+        self._writer = threading.Thread(target=self._write_loop,name='blacktie-run-logger')
+        self._writer.daemon = True
+        self._writer.start()
+        atexit.register(self.close)
+
+    def __getstate__(self):
+        """
+        keeps only what a sender needs so calls holding this object can be pickled by ``pprocess``.
+        """
+        return {'events_file':self.events_file,
+                'flush_interval':self.flush_interval,
+                'max_buffer':self.max_buffer,
+                '_pipe':self._pipe,
+                '_closed':self._closed}
+
+    # ++++++++ sending (any process) ++++++++
+    def _send(self,message):
+        if not self._closed:
+            self._pipe.send(message)
+
+    def log(self,log_file,text):
+        """
+        appends ``text`` to the human readable log ``log_file``.
+        """
+        self._send({'kind':'log','path':log_file,'text':text})
+
+    def event(self,event_type,**fields):
+        """
+        records a structured event in the JSON-lines event log.
+
+        :param event_type: short name of the event (e.g. 'call_start', 'progress')
+        :param fields: json-serializable details of the event
+        """
+        record = {'time':time.time(),'event':event_type,'pid':os.getpid()}
+        record.update(fields)
+        self._send({'kind':'event','record':record})
+
+    def flush(self):
+        """
+        asks the writer to write everything it has buffered so far.
+        """
+        self._send({'kind':'flush'})
+
+    # ++++++++ writing (owner process only) ++++++++
+    def _write_loop(self):
+        """
+        takes messages off the pipe and hands them to ``_handle()``, writing buffers out periodically.
+        """
+        last_flush = time.time()
+        while True:
+            try:
+                message = self._pipe.receive(timeout=self.flush_interval)
+            except EOFError:
+                break
+            if message is not None:
+                if message['kind'] == 'stop':
+                    break
+                self._handle(message)
+
+            if self._buffered_bytes >= self.max_buffer or (time.time() - last_flush) >= self.flush_interval:
+                self._write_buffers()
+                last_flush = time.time()
+        self._write_buffers()
+
+    def _handle(self,message):
+        kind = message['kind']
+        if kind == 'log':
+            text = message['text']
+            self._buffers.setdefault(message['path'],[]).append(text)
+            self._buffered_bytes += len(text)
+        elif kind == 'event':
+            line = json.dumps(message['record']) + '\n'
+            self._events.append(line)
+            self._buffered_bytes += len(line)
+        elif kind == 'flush':
+            self._write_buffers()
+
+    def _write_buffers(self):
+        """
+        appends buffered text to each log file with one open/write/close per file.
+        """
+        buffers,self._buffers = self._buffers,{}
+        events,self._events = self._events,[]
+        self._buffered_bytes = 0
+        for path,texts in buffers.iteritems():
+            self._append(path,''.join(texts))
+        if events:
+            self._append(self.events_file,''.join(events))
+
+    def _append(self,path,text):
+        if isinstance(text,unicode):
+            text = text.encode('utf-8')
+        try:
+            log = open(path,'a')
+            log.write(text)
+            log.close()
+        except IOError as exc:
+            sys.stderr.write("Warning: unable to write to log file %s: %s\n" % (path,exc))
+
+    def close(self):
+        """
+        writes everything still buffered and stops the writer thread (owner process only).
+        """
+        if self._closed or not self._pipe.is_owner():
+            return
+        self._send({'kind':'stop'})
+        self._closed = True
+        self._writer.join()
+        self._pipe.close()
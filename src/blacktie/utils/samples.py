@@ -0,0 +1,336 @@
+#*****************************************************************************
+#  samples.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+samples.py
+####################
+Code to build the ``condition_queue`` from sources other than the yaml
+config file itself.
+
+A TSV/CSV sample sheet named by ``run_options.sample_sheet`` is read one row
+at a time into the same condition records a yaml ``condition_queue`` holds.
+Paths repeated on many rows (genome, annotation, index) are stored once, so
+sheets with tens of thousands of rows stay small in memory.
+
+``run_options.fastq_discovery`` instead generates conditions by matching
+file name patterns against a sequencing delivery directory, which is listed
+one directory per thread so large network file systems are scanned quickly.
+"""
+import os
+import sys
+import csv
+import re
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+from blacktie.utils import errors
+
+
+SAMPLE_SHEET_COLUMNS = ['name','experiment_id','replicate_id',
+                        'left_reads','right_reads',
+                        'genome_seq','gtf_annotation','bowtie2_index']
+
+# columns holding lists of fastq files
+LIST_COLUMNS = ['left_reads','right_reads']
+
+_list_split_regex = re.compile(r'\s*[,;]\s*')
+_int_regex = re.compile(r'^[-+]?\d+$')
+
+
+def _sheet_delimiter(path,header_line):
+    """
+    returns the delimiter of a sample sheet: tab for .tsv/.txt files, comma for .csv files,
+    otherwise whichever of the two appears in the header line.
+    """
+    lower = path.lower()
+    if lower.endswith('.csv'):
+        return ','
+    if lower.endswith('.tsv') or lower.endswith('.txt'):
+        return '\t'
+    if '\t' in header_line:
+        return '\t'
+    return ','
+
+
+def _scalar(value):
+    """
+    converts whole numbers to ``int`` the way yaml would so call_ids match a yaml ``condition_queue``.
+    """
+    if _int_regex.match(value):
+        return int(value)
+    return value
+
+
+def iter_sample_sheet(path):
+    """
+    reads a TSV/CSV sample sheet one row at a time.
+
+    The first non-comment line names the columns and must contain every column in
+    ``SAMPLE_SHEET_COLUMNS``; other columns (e.g. ``mask_file``) are passed through.
+    ``left_reads`` and ``right_reads`` may list several files separated by ',' or ';'.
+    Blank lines and lines starting with '#' are skipped.
+
+    :param path: path to the sample sheet
+    :returns: generator of condition ``dict`` objects like those of a yaml ``condition_queue``
+    """
+    sheet = open(path,'rU')
+    try:
+        lines = (line for line in sheet if line.strip() and not line.startswith('#'))
+        try:
+            header_line = lines.next()
+        except StopIteration:
+            raise errors.InvalidFileFormatError('Sample sheet %s is empty.' % (path))
+
+        delimiter = _sheet_delimiter(path,header_line)
+        header = [column.strip() for column in csv.reader([header_line],delimiter=delimiter).next()]
+        missing = [column for column in SAMPLE_SHEET_COLUMNS if column not in header]
+        if missing:
+            raise errors.InvalidFileFormatError('Sample sheet %s is missing column(s): %s.' % (path,', '.join(missing)))
+
+        interned = {}
+        for row_number,row in enumerate(csv.reader(lines,delimiter=delimiter),2):
+            if len(row) != len(header):
+                raise errors.InvalidFileFormatError('Sample sheet %s: data row %s has %s fields but the header has %s.'
+                                                    % (path,row_number,len(row),len(header)))
+            condition = {}
+            for column,value in zip(header,row):
+                value = value.strip()
+                if column in LIST_COLUMNS:
+                    condition[column] = [interned.setdefault(f,f) for f in _list_split_regex.split(value) if f]
+                else:
+                    value = _scalar(value)
+                    condition[column] = interned.setdefault(value,value)
+            yield condition
+    finally:
+        sheet.close()
+
+
+# ++++++++ fastq directory discovery ++++++++
+# condition fields a pattern can fill; any other named field (e.g. ``lane``) tells technical replicates apart
+CONDITION_FIELDS = ['name','experiment_id','replicate_id','genome_seq','gtf_annotation','bowtie2_index','mask_file']
+
+_placeholder_regex = re.compile(r'\{([^{}]*)\}')
+
+
+def compile_fastq_pattern(pattern):
+    """
+    turns a file name pattern into a regex matched against paths relative to the delivery directory.
+
+    * ``{field}`` matches part of one path component and records it as ``field``
+    * ``{1,2}`` (any two comma separated alternatives) marks the read mate: the first
+      alternative is a left read, the second a right read
+    * ``*`` matches anything within one path component
+
+    e.g. ``'{name}_rep{replicate_id}_L{lane}_R{1,2}.fastq.gz'``
+
+    :param pattern: the file name pattern
+    :returns: (compiled regex with a ``mate`` group and one group per field, [left mate, right mate])
+    """
+    regex = []
+    fields = set()
+    mates = None
+    position = 0
+    for match in _placeholder_regex.finditer(pattern):
+        regex.append(_literal(pattern[position:match.start()]))
+        position = match.end()
+        content = match.group(1).strip()
+        if ',' in content:
+            alternatives = [a.strip() for a in content.split(',')]
+            if mates is not None or len(alternatives) != 2:
+                raise errors.InvalidOptionError(pattern,'fastq_discovery.pattern',
+                                                validVals='a pattern with one two-way mate alternative such as {1,2}')
+            mates = alternatives
+            regex.append('(?P<mate>%s)' % ('|'.join([re.escape(a) for a in alternatives])))
+        elif content in fields:
+            regex.append('(?P=%s)' % (content))
+        elif re.match(r'^[A-Za-z_]\w*$',content) and content != 'mate':
+            fields.add(content)
+            regex.append('(?P<%s>[^/]+?)' % (content))
+        else:
+            raise errors.InvalidOptionError(pattern,'fastq_discovery.pattern',
+                                            validVals='{field} names made of letters, digits and _')
+    regex.append(_literal(pattern[position:]))
+
+    if mates is None:
+        raise errors.InvalidOptionError(pattern,'fastq_discovery.pattern',
+                                        validVals='a pattern marking the read mate such as R{1,2}')
+    return re.compile('^%s$' % (''.join(regex))),mates
+
+
+def _literal(text):
+    return '[^/]*?'.join([re.escape(part) for part in text.split('*')])
+
+
+def _list_dir(path):
+    """
+    lists one directory.
+
+    :returns: (path, file names, sub-directory names, the ``OSError`` raised while listing it or ``None``)
+    """
+    files = []
+    dirs = []
+    error = None
+    try:
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.is_dir():
+                    dirs.append(entry.name)
+                else:
+                    files.append(entry.name)
+        else:
+            for name in os.listdir(path):
+                if os.path.isdir(os.path.join(path,name)):
+                    dirs.append(name)
+                else:
+                    files.append(name)
+    except OSError as exc:
+        error = exc
+    return path,files,dirs,error
+
+
+def scan_directory(directory,threads=8,max_depth=None):
+    """
+    lists every file below ``directory``, listing the directories of each level in parallel.
+
+    A sub-directory that can not be listed is left out with a warning; ``directory`` itself
+    must be listable.
+
+    :param directory: top of the tree to scan
+    :param threads: number of directories listed at once
+    :param max_depth: deepest level of sub-directories to enter (``None`` for no limit)
+    :returns: sorted ``list`` of file paths relative to ``directory``
+    """
+    from multiprocessing.pool import ThreadPool
+    directory = directory.rstrip('/') or '/'
+    found = []
+    level = [(directory,'')]
+    depth = 0
+    pool = ThreadPool(max(1,threads))
+    try:
+        while level:
+            listings = pool.map(_list_dir,[path for path,rel in level])
+            next_level = []
+            for (path,files,dirs,error),(unused,rel) in zip(listings,level):
+                if error is not None:
+                    if depth == 0:
+                        raise errors.SanityCheckError('Unable to list %s: %s' % (path,error.strerror or error))
+                    sys.stderr.write("Warning: unable to list %s; the files below it are left out: %s\n" % (path,error.strerror or error))
+                found.extend([rel + f for f in files])
+                if max_depth is None or depth < max_depth:
+                    next_level.extend([(os.path.join(path,d),'%s%s/' % (rel,d)) for d in dirs])
+            level = next_level
+            depth += 1
+    finally:
+        pool.close()
+        pool.join()
+    found.sort()
+    return found
+
+
+def discover_conditions(options):
+    """
+    generates condition records from the fastq files below ``options['directory']``.
+
+    Files matching ``options['pattern']`` (see ``compile_fastq_pattern()``; a pattern without
+    a '/' is matched against file names at any depth) are grouped into
+    conditions by the condition fields they capture; files of one condition that differ in any
+    other field (e.g. ``lane``) are technical replicates and are paired left to right.
+    ``options['defaults']`` supplies condition fields the pattern does not capture.
+
+    :param options: one ``run_options.fastq_discovery`` entry
+    :returns: ``list`` of condition ``dict`` objects in the order their first files sort
+    """
+    directory = options['directory'].rstrip('/')
+    regex,mates = compile_fastq_pattern(options['pattern'])
+    defaults = dict(options.get('defaults') or {})
+    whole_path = '/' in options['pattern']
+    max_depth = options.get('max_depth')
+    if max_depth is False:
+        max_depth = None
+
+    conditions = {}
+    order = []
+    for rel_path in scan_directory(directory,threads=options.get('threads') or 8,max_depth=max_depth):
+        # patterns without a '/' match file names at any depth
+        if whole_path:
+            prefix,target = '',rel_path
+        else:
+            prefix,target = os.path.split(rel_path)
+        match = regex.match(target)
+        if match is None:
+            continue
+        captured = match.groupdict()
+        mate = mates.index(captured.pop('mate'))
+
+        condition = dict(defaults)
+        tech_rep = []
+        for field,value in sorted(captured.items()):
+            if field in CONDITION_FIELDS:
+                condition[field] = _scalar(value)
+            else:
+                tech_rep.append(value)
+        # strip the mate so both files of a pair share one key
+        tech_rep.append((prefix,target[:match.start('mate')] + target[match.end('mate'):]))
+
+        key = tuple(sorted(condition.items()))
+        if key not in conditions:
+            conditions[key] = (condition,{})
+            order.append(key)
+        conditions[key][1].setdefault(tuple(tech_rep),[None,None])[mate] = '%s/%s' % (directory,rel_path)
+
+    queue = []
+    for key in order:
+        condition,pairs = conditions[key]
+        condition['left_reads'] = []
+        condition['right_reads'] = []
+        for tech_rep in sorted(pairs):
+            left,right = pairs[tech_rep]
+            if left is None or right is None:
+                raise errors.SanityCheckError('fastq_discovery found %s without its mate.' % (left or right))
+            condition['left_reads'].append(left)
+            condition['right_reads'].append(right)
+
+        missing = [f for f in SAMPLE_SHEET_COLUMNS if f not in condition]
+        if missing:
+            raise errors.MissingArgumentError('fastq_discovery conditions need %s: capture them in the pattern or set them in fastq_discovery.defaults.'
+                                              % (', '.join(missing)))
+        queue.append(condition)
+    return queue
+
+
+def build_condition_queue(yargs):
+    """
+    returns the run's ``condition_queue``: the yaml ``condition_queue`` (if any) followed by
+    the rows of ``run_options.sample_sheet`` and then the conditions found by
+    ``run_options.fastq_discovery`` (a single entry or a list of them), if set.
+
+    :param yargs: argument object generated from the yaml config file
+    :returns: ``list`` of condition ``dict`` objects
+    """
+    condition_queue = list(yargs.get('condition_queue') or [])
+
+    sample_sheet = yargs.run_options.get('sample_sheet')
+    if sample_sheet:
+        condition_queue.extend(iter_sample_sheet(sample_sheet))
+
+    discovery = yargs.run_options.get('fastq_discovery')
+    if discovery:
+        if isinstance(discovery,dict):
+            discovery = [discovery]
+        for options in discovery:
+            condition_queue.extend(discover_conditions(options))
+
+    return condition_queue
@@ -0,0 +1,409 @@
+#*****************************************************************************
+#  sharding.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+sharding.py
+####################
+Code to run one tophat call as several tophat processes over shards of its reads.
+
+``split_fastq()`` streams a condition's mate files in lockstep and deals
+the read pairs out to N shard files in blocks, checking that the mates'
+names agree.  ``ShardedTophat`` runs tophat on every shard at once (the
+``-p`` cores are divided between them), then merges the shard BAMs with
+``samtools merge`` into the ``accepted_hits.bam`` downstream stages expect
+and sums the shards' ``align_summary.txt`` counts into one summary in
+tophat's format.
+"""
+import os
+import re
+import sys
+import subprocess
+
+from blacktie.utils.externals import mkdirp,whereis,runExternalApp
+from blacktie.utils import errors
+
+
+class DecompressorPipe(object):
+    """
+    Reads the output of a decompressor process like a file.
+    """
+    def __init__(self,path,process):
+        self.path = path
+        self.process = process
+        self.read = process.stdout.read
+        self.readline = process.stdout.readline
+
+    def finish(self):
+        """
+        waits for the decompressor at the end of its output; raises ``InvalidFileFormatError`` if it failed,
+        since a corrupt or truncated file otherwise just ends early.
+        """
+        self.process.stdout.close()
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise errors.InvalidFileFormatError('%s: decompression failed with exit status %s (corrupt or truncated file?).'
+                                                % (self.path,returncode))
+
+    def close(self):
+        if not self.process.stdout.closed:
+            self.process.stdout.close()
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+def open_fastq(path):
+    """
+    returns a file object reading the (possibly gzipped) fastq at ``path``.
+
+    Gzipped files are decompressed by ``pigz`` (or ``gzip``) in a separate process; call
+    ``finish_fastq()`` once the file has been read to the end.
+    """
+    if not path.endswith('.gz'):
+        return open(path,'rb')
+    program = whereis('pigz') or whereis('gzip')
+    if program is None:
+        import gzip
+        return gzip.open(path,'rb')
+    process = subprocess.Popen([program,'-dc',path],stdout=subprocess.PIPE,bufsize=1024*1024,close_fds=True)
+    return DecompressorPipe(path,process)
+
+def finish_fastq(in_file):
+    """
+    checks a file from ``open_fastq()`` that has been read to the end (see ``DecompressorPipe.finish``).
+    """
+    if isinstance(in_file,DecompressorPipe):
+        in_file.finish()
+
+def iter_fastq(paths):
+    """
+    yields the 4-line records of the fastq files in ``paths`` (one after the other) as strings.
+    """
+    for path in paths:
+        in_file = open_fastq(path)
+        try:
+            while True:
+                header = in_file.readline()
+                if not header:
+                    break
+                record = header + in_file.readline() + in_file.readline() + in_file.readline()
+                if not header.startswith('@') or record.count('\n') != 4:
+                    raise errors.InvalidFileFormatError('%s: truncated or malformed fastq record: %r' % (path,header.strip()))
+                yield record
+            finish_fastq(in_file)
+        finally:
+            in_file.close()
+
+def mate_name(record):
+    """
+    returns the read name of a fastq ``record`` without its comment or /1, /2 mate suffix.
+    """
+    name = record[1:record.index('\n')].split()[0]
+    if name[-2:] in ['/1','/2']:
+        name = name[:-2]
+    return name
+
+def split_fastq(left_paths,right_paths,out_paths,block=10000):
+    """
+    deals the reads of ``left_paths`` (and their mates in ``right_paths``) out to the shard files
+    in ``out_paths``, ``block`` records at a time, so every shard keeps its mates in sync.
+
+    :param left_paths: list of left-mate (or single-end) fastq files, read one after the other
+    :param right_paths: matching list of right-mate fastq files (empty for single-end reads)
+    :param out_paths: one ``(left, right)`` pair of paths per shard (``right`` is ignored for single-end reads)
+    :returns: number of records written to each shard
+    """
+    shards = len(out_paths)
+    left_files = [open(l,'wb') for l,r in out_paths]
+    right_files = [open(r,'wb') for l,r in out_paths] if right_paths else []
+    counts = [0] * shards
+    try:
+        lefts = iter_fastq(left_paths)
+        rights = iter_fastq(right_paths) if right_paths else None
+        number = 0
+        for left in lefts:
+            shard = (number // block) % shards
+            left_files[shard].write(left)
+            if rights is not None:
+                try:
+                    right = rights.next()
+                except StopIteration:
+                    raise errors.InvalidFileFormatError('right reads ran out before the left reads at read %s.' % (number + 1))
+                if mate_name(left) != mate_name(right):
+                    raise errors.InvalidFileFormatError('mates out of sync at read %s: %s != %s.'
+                                                        % (number + 1,mate_name(left),mate_name(right)))
+                right_files[shard].write(right)
+            counts[shard] += 1
+            number += 1
+        if rights is not None:
+            for right in rights:
+                raise errors.InvalidFileFormatError('left reads ran out before the right reads at read %s.' % (number + 1))
+    finally:
+        for out_file in left_files + right_files:
+            out_file.close()
+    return counts
+
+
+_summary_side = re.compile(r'^(Left reads|Right reads|Reads):$')
+_summary_count = re.compile(r'^(Input|Mapped|Aligned pairs)\s*:\s*(\d+)')
+_summary_multiple = re.compile(r'^of these:\s*(\d+) \(\s*[\d.]+%\) have multiple alignments(?: \((\d+) have >(\d+)\))?$')
+_summary_discordant = re.compile(r'^(\d+) \(\s*[\d.]+%\) are discordant alignments$')
+
+def parse_align_summary(text):
+    """
+    returns the counts in tophat's ``align_summary.txt`` ``text`` as a ``dict`` or ``None`` if
+    the text is not in the format this code knows.
+    """
+    summary = {'sides':[],'pairs':None}
+    current = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.endswith('rate.'):
+            continue
+        side = _summary_side.match(line)
+        count = _summary_count.match(line)
+        multiple = _summary_multiple.match(line)
+        discordant = _summary_discordant.match(line)
+        if side:
+            current = {'name':side.group(1)}
+            summary['sides'].append(current)
+        elif count and count.group(1) == 'Aligned pairs':
+            current = summary['pairs'] = {'aligned':int(count.group(2))}
+        elif count and current is not None and summary['pairs'] is None:
+            current[count.group(1).lower()] = int(count.group(2))
+        elif multiple and current is not None:
+            current['multiple'] = int(multiple.group(1))
+            if multiple.group(2):
+                current['over'] = (int(multiple.group(2)),int(multiple.group(3)))
+        elif discordant and summary['pairs'] is not None:
+            summary['pairs']['discordant'] = int(discordant.group(1))
+        else:
+            return None
+    for side in summary['sides']:
+        if [k for k in ['input','mapped','multiple'] if k not in side]:
+            return None
+    if not summary['sides']:
+        return None
+    return summary
+
+def _percent(part,whole):
+    return 100.0 * part / whole if whole else 0.0
+
+def sum_align_summaries(texts):
+    """
+    returns the counts of several tophat ``align_summary.txt`` texts summed into one text in
+    tophat's format, or ``None`` if they cannot be summed.
+    """
+    summaries = [parse_align_summary(text) for text in texts]
+    if not summaries or None in summaries:
+        return None
+    first = summaries[0]
+    layout = [([s['name'] for s in summary['sides']],summary['pairs'] is None) for summary in summaries]
+    if [l for l in layout if l != layout[0]]:
+        return None
+
+    lines = []
+    total_input = total_mapped = 0
+    for number,side in enumerate(first['sides']):
+        sides = [summary['sides'][number] for summary in summaries]
+        counts = dict([(k,sum([s[k] for s in sides])) for k in ['input','mapped','multiple']])
+        total_input += counts['input']
+        total_mapped += counts['mapped']
+        lines.append('%s:' % (side['name']))
+        lines.append('          Input     : %9d' % (counts['input']))
+        lines.append('           Mapped   : %9d (%4.1f%% of input)' % (counts['mapped'],_percent(counts['mapped'],counts['input'])))
+        multiple = '            of these: %9d (%4.1f%%) have multiple alignments' % (counts['multiple'],_percent(counts['multiple'],counts['mapped']))
+        overs = [s.get('over') for s in sides]
+        if None not in overs and len(set([o[1] for o in overs])) == 1:
+            multiple += ' (%d have >%d)' % (sum([o[0] for o in overs]),overs[0][1])
+        lines.append(multiple)
+    lines.append('%4.1f%% overall read mapping rate.' % (_percent(total_mapped,total_input)))
+
+    if first['pairs'] is not None:
+        pairs = [summary['pairs'] for summary in summaries]
+        aligned = sum([p['aligned'] for p in pairs])
+        multiple = sum([p.get('multiple',0) for p in pairs])
+        discordant = sum([p.get('discordant',0) for p in pairs])
+        pair_input = sum([summary['sides'][0]['input'] for summary in summaries])
+        lines.append('')
+        lines.append('Aligned pairs: %9d' % (aligned))
+        lines.append('     of these: %9d (%4.1f%%) have multiple alignments' % (multiple,_percent(multiple,aligned)))
+        lines.append('               %9d (%4.1f%%) are discordant alignments' % (discordant,_percent(discordant,aligned)))
+        lines.append('%4.1f%% concordant pair alignment rate.' % (_percent(aligned - discordant,pair_input)))
+    return '\n'.join(lines) + '\n'
+
+def parse_tophat_argv(argv):
+    """
+    splits a tophat argv built by ``TophatCall`` into its options and its positional arguments.
+
+    :returns: (options, bowtie2 index, left reads, right reads) where the reads are lists of paths
+    """
+    if len(argv) < 3:
+        raise errors.MissingArgumentError('expected tophat options followed by <bowtie2_index> <left_reads> <right_reads>.')
+    options = list(argv[:-3])
+    bowtie_index,left_reads,right_reads = argv[-3:]
+    return options,bowtie_index,[p for p in left_reads.split(',') if p],[p for p in right_reads.split(',') if p]
+
+def set_option(options,flags,value):
+    """
+    returns ``options`` with the value of the first of ``flags`` present replaced by ``value`` (or added).
+    """
+    options = list(options)
+    for i,arg in enumerate(options[:-1]):
+        if arg in flags:
+            options[i + 1] = value
+            return options
+    return options + [flags[0],value]
+
+def get_option(options,flags,default=None):
+    """
+    returns the value of the first of ``flags`` in ``options`` or ``default``.
+    """
+    for i,arg in enumerate(options[:-1]):
+        if arg in flags:
+            return options[i + 1]
+    return default
+
+
+class ShardedTophat(object):
+    """
+    Runs one tophat call as ``shards`` tophat processes and merges their alignments.
+    """
+    def __init__(self,tophat_argv,shards,keep_shards=False,program='tophat'):
+        """
+        initializes a ``ShardedTophat`` object
+
+        :param tophat_argv: the tophat arguments of the call (options, then index, left reads, right reads)
+        :param shards: number of shards the reads are split into
+        :param keep_shards: keep the shard fastqs and BAMs after a successful merge
+        :param program: the tophat program to run
+
+        :returns: an initialized ``ShardedTophat`` object
+        """
+        if shards < 2:
+            raise errors.InvalidOptionError(shards,'shards')
+        self.options,self.bowtie_index,self.left_reads,self.right_reads = parse_tophat_argv(tophat_argv)
+        if self.right_reads and len(self.right_reads) != len(self.left_reads):
+            raise errors.SanityCheckError('%s left read files but %s right read files.' % (len(self.left_reads),len(self.right_reads)))
+        self.shards = shards
+        self.keep_shards = keep_shards
+        self.program = program
+        self.out_dir = get_option(self.options,['-o','--output-dir'],'./tophat_out').rstrip('/')
+        self.shard_dir = '%s/shards' % (self.out_dir)
+        cores = int(get_option(self.options,['-p','--num-threads'],1))
+        self.shard_cores = max(1,cores // shards)
+
+    def log(self,msg):
+        sys.stderr.write('[blacktie-tophat-shards] %s\n' % (msg))
+        sys.stderr.flush()
+
+    def shard_path(self,number,name):
+        return '%s/shard_%s/%s' % (self.shard_dir,number,name)
+
+    def split(self):
+        """
+        writes the shard fastqs.
+        """
+        out_paths = []
+        for number in range(self.shards):
+            mkdirp('%s/shard_%s' % (self.shard_dir,number))
+            out_paths.append((self.shard_path(number,'left.fq'),self.shard_path(number,'right.fq')))
+        self.log('splitting %s into %s shards' % (','.join(self.left_reads),self.shards))
+        counts = split_fastq(self.left_reads,self.right_reads,out_paths)
+        self.log('reads per shard: %s' % (', '.join([str(c) for c in counts])))
+        return counts
+
+    def shard_argv(self,number):
+        """
+        returns the tophat argv of shard ``number``.
+        """
+        options = set_option(self.options,['-o','--output-dir'],'%s/shard_%s/tophat_out' % (self.shard_dir,number))
+        options = set_option(options,['-p','--num-threads'],str(self.shard_cores))
+        argv = [self.program] + options + [self.bowtie_index,self.shard_path(number,'left.fq')]
+        if self.right_reads:
+            argv.append(self.shard_path(number,'right.fq'))
+        return argv
+
+    def align(self,shards):
+        """
+        runs tophat on ``shards`` (shard numbers) at once; each one's stderr goes to ``shard_<n>/tophat.stderr``.
+
+        :returns: list of the shard numbers that failed
+        """
+        processes = []
+        for number in shards:
+            stderr_file = open(self.shard_path(number,'tophat.stderr'),'w')
+            processes.append((number,subprocess.Popen(self.shard_argv(number),stdout=stderr_file,stderr=stderr_file,close_fds=True),stderr_file))
+        self.log('running tophat on %s shards with -p %s each' % (len(processes),self.shard_cores))
+
+        failed = []
+        for number,process,stderr_file in processes:
+            process.wait()
+            stderr_file.close()
+            if process.returncode != 0:
+                failed.append(number)
+                tail = open(self.shard_path(number,'tophat.stderr')).read()[-4000:]
+                self.log('shard %s failed with exit status %s:\n%s' % (number,process.returncode,tail))
+        return failed
+
+    def merge(self):
+        """
+        merges the shard BAMs into ``<out_dir>/accepted_hits.bam`` (and ``unmapped.bam``) and
+        sums the shards' ``align_summary.txt`` counts (a summary tophat wrote in some other format
+        makes the shards' summaries be concatenated under ``== shard N ==`` headers instead).
+        """
+        for name in ['accepted_hits.bam','unmapped.bam']:
+            shard_bams = [self.shard_path(n,'tophat_out/%s' % (name)) for n in range(self.shards)]
+            shard_bams = [p for p in shard_bams if os.path.exists(p)]
+            if not shard_bams:
+                continue
+            self.log('merging %s %s files' % (len(shard_bams),name))
+            runExternalApp(progName='samtools',argList=['merge','-f','%s/%s' % (self.out_dir,name)] + shard_bams)
+
+        texts = []
+        for number in range(self.shards):
+            path = self.shard_path(number,'tophat_out/align_summary.txt')
+            if os.path.exists(path):
+                texts.append((number,open(path).read()))
+        merged = sum_align_summaries([text for number,text in texts])
+        if merged is None:
+            merged = ''.join(['== shard %s ==\n%s\n' % (number,text) for number,text in texts])
+        summary = open('%s/align_summary.txt' % (self.out_dir),'w')
+        summary.write(merged)
+        summary.close()
+
+    def cleanup(self):
+        """
+        removes the shard fastqs and BAMs once they have been merged.
+        """
+        if self.keep_shards:
+            return
+        for number in range(self.shards):
+            for name in ['left.fq','right.fq','tophat_out/accepted_hits.bam','tophat_out/unmapped.bam']:
+                path = self.shard_path(number,name)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def run(self):
+        """
+        splits, aligns and merges; returns 0 on success and 1 if any shard failed.
+        """
+        mkdirp(self.out_dir)
+        counts = self.split()
+        failed = self.align([n for n in range(self.shards) if counts[n]])
+        if failed:
+            self.log('not merging: shards %s failed (their fastqs are kept in %s)' % (', '.join([str(n) for n in failed]),self.shard_dir))
+            return 1
+        self.merge()
+        self.cleanup()
+        return 0
@@ -0,0 +1,331 @@
+#*****************************************************************************
+#  staging.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+staging.py
+####################
+Code to copy a call's inputs to node-local scratch before its program runs.
+
+Inputs are hard-linked when the scratch directory is on the same filesystem
+and copied otherwise, several at a time, and each copy is checked against
+its source (size, or an md5 computed while copying).  Two kinds of inputs
+are kept apart:
+
+* call inputs (reads, BAMs) go into a directory of their own that is removed
+  when the call is done, and
+* references (bowtie2 indexes, GTFs, genome FASTAs with their ``.fai``) go
+  into one directory per file version (path, size and mtime) shared by
+  every call on the node.
+  ``<entry>.lock`` serializes staging and cleanup of an entry and every
+  call using it holds a shared lock on ``<entry>.users``; the last call out
+  removes the copy.
+"""
+import os
+import sys
+import glob
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+from blacktie.utils.externals import mkdirp
+from blacktie.utils import errors
+
+
+VERIFY_CHOICES = ['size','checksum']
+
+_copy_block = 4 * 1024 * 1024
+
+
+def copy_verified(src,dest,verify='size'):
+    """
+    hard-links ``src`` to ``dest`` or, across filesystems, copies it and checks the copy.
+
+    The file is written under a temporary name and renamed into place, so ``dest`` is
+    either complete or missing.
+
+    :param verify: 'size' to compare sizes, 'checksum' to also compare md5 sums
+        (the source's is computed while it is read for the copy)
+    """
+    tmp_path = '%s.%s.tmp' % (dest,os.getpid())
+    try:
+        # link the file itself, not a symlink to it (prepared references are symlinks)
+        os.link(os.path.realpath(src),tmp_path)
+    except OSError:
+        source_md5 = hashlib.md5()
+        try:
+            in_file = open(src,'rb')
+            out_file = open(tmp_path,'wb')
+            try:
+                while True:
+                    block = in_file.read(_copy_block)
+                    if not block:
+                        break
+                    source_md5.update(block)
+                    out_file.write(block)
+            finally:
+                in_file.close()
+                out_file.close()
+        except (IOError,OSError):
+            # a full or failing scratch disk must not be left holding a partial copy
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        if os.path.getsize(tmp_path) != os.path.getsize(src):
+            os.remove(tmp_path)
+            raise errors.SanityCheckError('staged copy of %s has the wrong size.' % (src))
+        if verify == 'checksum' and file_md5(tmp_path) != source_md5.hexdigest():
+            os.remove(tmp_path)
+            raise errors.SanityCheckError('staged copy of %s does not match its checksum.' % (src))
+    os.rename(tmp_path,dest)
+
+def file_md5(path):
+    """
+    returns the md5 hex digest of the file at ``path``.
+    """
+    md5 = hashlib.md5()
+    in_file = open(path,'rb')
+    try:
+        while True:
+            block = in_file.read(_copy_block)
+            if not block:
+                break
+            md5.update(block)
+    finally:
+        in_file.close()
+    return md5.hexdigest()
+
+def _copy_task(task):
+    """
+    runs one ``copy_verified`` from a thread pool; returns the error message or ``None``.
+    """
+    src,dest,verify = task
+    try:
+        copy_verified(src,dest,verify)
+    except (IOError,OSError,errors.SanityCheckError) as exc:
+        return '%s: %s' % (src,exc)
+    return None
+
+
+class ReferenceEntry(object):
+    """
+    A reference file (or the files of a bowtie2 index) staged once per node and shared by calls.
+    """
+    def __init__(self,refs_dir,path,index=False):
+        """
+        initializes a ``ReferenceEntry`` object
+
+        :param refs_dir: directory holding the node's staged references
+        :param path: path of the reference file (its ``<path>.fai`` is staged beside it if there is one),
+            or the prefix of a bowtie2 index
+        :param index: ``True`` if ``path`` is an index prefix (all ``<prefix>.*`` files are staged)
+
+        :returns: an initialized ``ReferenceEntry`` object
+        """
+        self.path = path
+        if index:
+            self.sources = sorted([p for p in glob.glob('%s.*' % (path)) if os.path.isfile(p)])
+        else:
+            self.sources = [path]
+            # a genome FASTA's index goes with it so that no call rebuilds it in the shared entry
+            if os.path.isfile('%s.fai' % (path)):
+                self.sources.append('%s.fai' % (path))
+
+        # a changed file gets a new entry instead of a stale copy
+        key = hashlib.sha1(os.path.abspath(path))
+        for source in self.sources:
+            stat = os.stat(source)
+            key.update('\0%s\0%s\0%s' % (os.path.basename(source),stat.st_size,int(stat.st_mtime)))
+        self.dir = '%s/%s' % (refs_dir,key.hexdigest()[:16])
+        self.staged_path = '%s/%s' % (self.dir,os.path.basename(path))
+        self._lock = None
+        self._users = None
+
+    def lock(self):
+        """
+        takes the entry's staging lock; returns the (src, dest) pairs still to be copied.
+        """
+        self._lock = open('%s.lock' % (self.dir),'a')
+        fcntl.flock(self._lock,fcntl.LOCK_EX)
+        if os.path.exists('%s.complete' % (self.dir)):
+            return []
+        mkdirp(self.dir)
+        return [(s,'%s/%s' % (self.dir,os.path.basename(s))) for s in self.sources
+                if not os.path.exists('%s/%s' % (self.dir,os.path.basename(s)))]
+
+    def use(self,complete=True):
+        """
+        marks the entry complete (if ``complete``), registers this process as a user and
+        releases the staging lock.
+        """
+        if complete:
+            open('%s.complete' % (self.dir),'w').close()
+        self._users = open('%s.users' % (self.dir),'a')
+        fcntl.flock(self._users,fcntl.LOCK_SH)
+        self.unlock()
+
+    def unlock(self):
+        if self._lock is not None:
+            fcntl.flock(self._lock,fcntl.LOCK_UN)
+            self._lock.close()
+            self._lock = None
+
+    def release(self,keep=False):
+        """
+        stops using the entry and removes the staged copy if no other call is using it.
+        """
+        if self._users is None:
+            return
+        self._lock = open('%s.lock' % (self.dir),'a')
+        fcntl.flock(self._lock,fcntl.LOCK_EX)
+        try:
+            fcntl.flock(self._users,fcntl.LOCK_UN)
+            if keep:
+                return
+            try:
+                fcntl.flock(self._users,fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as exc:
+                if exc.errno in [errno.EAGAIN,errno.EACCES]:
+                    return
+                raise
+            # the lock files stay: a stager may already be waiting on them
+            if os.path.exists('%s.complete' % (self.dir)):
+                os.remove('%s.complete' % (self.dir))
+            shutil.rmtree(self.dir,ignore_errors=True)
+        finally:
+            self._users.close()
+            self._users = None
+            self.unlock()
+
+
+class InputStager(object):
+    """
+    Stages the inputs of one call to node-local scratch and maps the call's arguments onto the copies.
+    """
+    def __init__(self,scratch_dir,threads=4,verify='size',keep_references=False):
+        """
+        initializes an ``InputStager`` object
+
+        :param scratch_dir: node-local directory to stage into (``$VARS`` are expanded)
+        :param threads: number of files copied at once
+        :param verify: 'size' or 'checksum' (see ``copy_verified()``)
+        :param keep_references: leave staged references on the node after the call
+
+        :returns: an initialized ``InputStager`` object
+        """
+        if verify not in VERIFY_CHOICES:
+            raise errors.InvalidOptionError(verify,'verify',VERIFY_CHOICES)
+        self.base_dir = '%s/blacktie-stage' % (os.path.expandvars(scratch_dir).rstrip('/'))
+        self.threads = threads
+        self.verify = verify
+        self.keep_references = keep_references
+        self.paths = {}
+        self.call_dir = None
+        self.references = []
+
+    def stage(self,call_inputs=(),references=(),indexes=()):
+        """
+        copies every input and records where each one went in ``self.paths``.
+
+        :param call_inputs: paths only this call reads
+        :param references: reference files that other calls may share
+        :param indexes: bowtie2 index prefixes that other calls may share
+        """
+        refs_dir = '%s/refs' % (self.base_dir)
+        mkdirp(refs_dir)
+        mkdirp('%s/calls' % (self.base_dir))
+        self.call_dir = tempfile.mkdtemp(prefix='call.',dir='%s/calls' % (self.base_dir))
+
+        entries = {}
+        for path in references:
+            entries[path] = ReferenceEntry(refs_dir,path)
+        for path in indexes:
+            entries[path] = ReferenceEntry(refs_dir,path,index=True)
+
+        tasks = []
+        for number,path in enumerate(call_inputs):
+            dest = '%s/%s_%s' % (self.call_dir,number,os.path.basename(path))
+            tasks.append((path,dest,self.verify))
+            self.paths[path] = dest
+
+        # staging locks are always taken in the same order so two calls can not wait on each other
+        locked = []
+        try:
+            for entry in sorted(set(entries.values()),key=lambda e: e.dir):
+                tasks.extend([(src,dest,self.verify) for src,dest in entry.lock()])
+                locked.append(entry)
+
+            # references another call has already staged take no more space
+            needed = sum([os.path.getsize(src) for src,dest,verify in tasks])
+            stat = os.statvfs(self.base_dir)
+            if needed > stat.f_bavail * stat.f_frsize:
+                raise errors.SanityCheckError('%s has too little free space for %s bytes of inputs.' % (self.base_dir,needed))
+
+            problems = self._copy(tasks)
+            for entry in locked:
+                entry.use(complete=not problems)
+                self.references.append(entry)
+            locked = []
+        finally:
+            for entry in locked:
+                entry.unlock()
+
+        if problems:
+            raise errors.SanityCheckError('unable to stage:\n  %s' % ('\n  '.join(problems)))
+        for path,entry in entries.iteritems():
+            self.paths[path] = entry.staged_path
+
+    def _copy(self,tasks):
+        """
+        runs the copy ``tasks`` from a pool of threads; returns the problems found.
+        """
+        if not tasks:
+            return []
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(max(1,min(self.threads,len(tasks))))
+        try:
+            results = pool.map(_copy_task,tasks)
+        finally:
+            pool.close()
+            pool.join()
+        return [r for r in results if r]
+
+    def rewrite(self,argv):
+        """
+        returns ``argv`` with every staged path (including those in comma separated lists) replaced by its copy.
+        """
+        new_argv = []
+        for arg in argv:
+            if arg in self.paths:
+                new_argv.append(self.paths[arg])
+            elif ',' in arg:
+                new_argv.append(','.join([self.paths.get(a,a) for a in arg.split(',')]))
+            else:
+                new_argv.append(arg)
+        return new_argv
+
+    def cleanup(self):
+        """
+        removes this call's inputs and releases its references.
+        """
+        if self.call_dir is not None:
+            shutil.rmtree(self.call_dir,ignore_errors=True)
+            self.call_dir = None
+        for entry in self.references:
+            try:
+                entry.release(keep=self.keep_references)
+            except (IOError,OSError) as exc:
+                sys.stderr.write("Warning: unable to release staged reference %s: %s\n" % (entry.path,exc))
+        self.references = []
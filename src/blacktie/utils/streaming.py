@@ -0,0 +1,186 @@
+#*****************************************************************************
+#  streaming.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+streaming.py
+####################
+Code to feed a program its compressed fastqs through named pipes.
+
+Each comma separated list of read files is replaced by one FIFO.  A feeder
+thread per FIFO runs a decompressor (``pigz``/``gzip``, ``pbzip2``/``bzip2``
+or ``cat``) for each file of the list in turn with the FIFO as its stdout,
+so technical replicates are concatenated on the fly, the left and right
+mates are decompressed by separate processes at the same time and nothing
+is written to disk.
+
+Programs like tophat open a read file more than once (a peek at the first
+records to guess its format, then the real pass).  A reader that closes the
+FIFO early makes the decompressor die of ``SIGPIPE`` and the feeder simply
+starts the list over for the next open.
+"""
+import os
+import sys
+import signal
+import shutil
+import tempfile
+import threading
+import subprocess
+
+from blacktie.utils.externals import whereis
+from blacktie.utils import errors
+
+
+# extension: decompressors to try, in order of preference
+DECOMPRESSORS = {'.gz':['pigz','gzip'],
+                 '.bz2':['pbzip2','bzip2']}
+
+
+def decompress_argv(path):
+    """
+    returns the argv that writes the uncompressed contents of ``path`` to stdout.
+    """
+    programs = DECOMPRESSORS.get(os.path.splitext(path)[1].lower())
+    if programs is None:
+        return ['cat',path]
+    for program in programs:
+        if whereis(program) is not None:
+            return [program,'-dc',path]
+    raise errors.SystemCallError(None,'none of %s found in your PATH environmental variable' % (', '.join(programs)))
+
+def is_streamable(paths):
+    """
+    returns ``True`` if any file in ``paths`` is compressed (so a FIFO saves the program decompressing it).
+    """
+    return any([os.path.splitext(p)[1].lower() in DECOMPRESSORS for p in paths])
+
+def _default_sigpipe():
+    # python ignores SIGPIPE and its children inherit that; the decompressors should die of it
+    signal.signal(signal.SIGPIPE,signal.SIG_DFL)
+
+
+class FifoFeeder(threading.Thread):
+    """
+    Serves the uncompressed, concatenated contents of a list of files through one FIFO.
+    """
+    def __init__(self,fifo_path,paths,on_error):
+        """
+        initializes a ``FifoFeeder`` object
+
+        :param fifo_path: path of the (already made) FIFO
+        :param paths: files streamed through the FIFO, one after the other
+        :param on_error: callable given an error message if a decompressor fails
+
+        :returns: an initialized ``FifoFeeder`` object
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.fifo_path = fifo_path
+        self.argvs = [decompress_argv(p) for p in paths]
+        self.on_error = on_error
+        self.passes = 0
+
+    def run(self):
+        while True:
+            # blocks until the program opens the FIFO
+            fifo = open(self.fifo_path,'wb')
+            try:
+                for argv in self.argvs:
+                    process = subprocess.Popen(argv,stdout=fifo,preexec_fn=_default_sigpipe,close_fds=True)
+                    process.wait()
+                    if process.returncode == -signal.SIGPIPE:
+                        # the reader closed early; start over for its next open
+                        break
+                    if process.returncode != 0:
+                        self.on_error('%s exited with status %s' % (' '.join(argv),process.returncode))
+                        return
+                else:
+                    self.passes += 1
+            finally:
+                try:
+                    fifo.close()
+                except IOError:
+                    pass
+
+
+class ReadStreamer(object):
+    """
+    Runs a program with its compressed read lists replaced by FIFOs fed by decompressors.
+    """
+    def __init__(self,argv,read_args,fifo_dir=None):
+        """
+        initializes a ``ReadStreamer`` object
+
+        :param argv: the program and its arguments
+        :param read_args: indexes in ``argv`` of the (comma separated) read file lists to stream
+        :param fifo_dir: directory the FIFOs are made in (default: a new directory under ``$TMPDIR``)
+
+        :returns: an initialized ``ReadStreamer`` object
+        """
+        self.argv = list(argv)
+        self.read_args = [i for i in read_args if is_streamable([p for p in self.argv[i].split(',') if p])]
+        self.fifo_dir = fifo_dir
+        self.feeders = []
+        self.errors = []
+        self.process = None
+
+    def log(self,msg):
+        sys.stderr.write('[blacktie-stream-reads] %s\n' % (msg))
+        sys.stderr.flush()
+
+    def setup(self):
+        """
+        makes the FIFOs, starts their feeders and returns the program's argv with the FIFO paths in place.
+        """
+        if not self.read_args:
+            return self.argv
+        self.fifo_dir = tempfile.mkdtemp(prefix='blacktie-fifos.',dir=self.fifo_dir)
+        argv = list(self.argv)
+        for i in self.read_args:
+            paths = [p for p in self.argv[i].split(',') if p]
+            # keep a fastq-looking name: programs pick their parser from the extension
+            fifo_path = '%s/reads_%s.fq' % (self.fifo_dir,i)
+            os.mkfifo(fifo_path)
+            feeder = FifoFeeder(fifo_path,paths,self._on_error)
+            self.feeders.append(feeder)
+            argv[i] = fifo_path
+            self.log('streaming %s through %s' % (','.join(paths),fifo_path))
+        for feeder in self.feeders:
+            feeder.start()
+        return argv
+
+    def _on_error(self,msg):
+        self.errors.append(msg)
+        self.log('Error: %s; stopping %s' % (msg,self.argv[0]))
+        # the program would otherwise take the truncated stream for the whole file
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def cleanup(self):
+        if self.fifo_dir is not None and self.read_args:
+            shutil.rmtree(self.fifo_dir,ignore_errors=True)
+
+    def run(self):
+        """
+        runs the program; returns its exit status (1 if a decompressor failed).
+        """
+        try:
+            argv = self.setup()
+            self.process = subprocess.Popen(argv)
+            self.process.wait()
+        finally:
+            self.cleanup()
+        if self.errors:
+            return 1
+        if self.process.returncode < 0:
+            return 128 - self.process.returncode
+        return self.process.returncode
@@ -0,0 +1,208 @@
+#*****************************************************************************
+#  warmup.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+warmup.py
+####################
+Code to pull bowtie2 indexes into the page cache before tophat reads them.
+
+Every tophat call of a run maps its reads against one of a few multi-GB
+indexes.  Started together, the calls all cold-read the same ``.bt2`` files
+from the shared filesystem at the same moment.  ``IndexWarmer`` reads each
+distinct index once (its files side by side from a pool of threads) so the
+calls that follow start from a warm page cache:
+
+    - ``read``: every file is read through to the end; returns once the index is cached.
+    - ``advise``: the kernel is asked to read the files ahead (``posix_fadvise``
+      with ``POSIX_FADV_WILLNEED``) and the call returns at once.
+
+On a cluster node ``warm_index`` takes a per-index lock, so jobs starting
+together on the node read the index from the filesystem only once.
+"""
+import os
+import io
+import glob
+import time
+import fcntl
+import hashlib
+import tempfile
+
+from blacktie.utils import errors
+
+
+METHODS = ['read','advise']
+BLOCK_SIZE = 8 * 1024 * 1024
+POSIX_FADV_WILLNEED = 3
+
+# set by _fadvise_func(): False if this platform has no posix_fadvise
+_fadvise = None
+
+
+def _fadvise_func():
+    """
+    returns libc's ``posix_fadvise`` or ``None`` if it is not available.
+    """
+    global _fadvise
+    if _fadvise is None:
+        func = False
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno=True)
+            func = libc.posix_fadvise
+            func.argtypes = [ctypes.c_int,ctypes.c_long,ctypes.c_long,ctypes.c_int]
+            func.restype = ctypes.c_int
+        except (ImportError,OSError,AttributeError):
+            func = False
+        _fadvise = func
+    return _fadvise or None
+
+def index_files(prefix):
+    """
+    returns the files of the bowtie2 index ``prefix`` (all ``<prefix>.*`` files, largest first).
+    """
+    paths = [p for p in glob.glob('%s.*' % (prefix)) if os.path.isfile(p)]
+    if not paths:
+        raise errors.BlacktieError('No bowtie2 index files found for "%s".' % (prefix))
+    return sorted(paths,key=os.path.getsize,reverse=True)
+
+def warm_file(path,method='read'):
+    """
+    pulls ``path`` into the page cache; returns the number of bytes read (0 when only advised).
+    """
+    if method == 'advise':
+        fadvise = _fadvise_func()
+        if fadvise is not None:
+            fd = os.open(path,os.O_RDONLY)
+            try:
+                if fadvise(fd,0,0,POSIX_FADV_WILLNEED) == 0:
+                    return 0
+            finally:
+                os.close(fd)
+        # no (working) posix_fadvise here: fall back to reading the file
+
+    buf = bytearray(BLOCK_SIZE)
+    total = 0
+    in_file = io.open(path,'rb',buffering=0)
+    try:
+        while True:
+            n = in_file.readinto(buf)
+            if not n:
+                break
+            total += n
+    finally:
+        in_file.close()
+    return total
+
+
+def _warm_task(task):
+    path,method = task
+    return warm_file(path,method)
+
+
+class IndexWarmer(object):
+    """
+    Pulls the files of one or more bowtie2 indexes into the page cache.
+    """
+    def __init__(self,method='read',threads=4,lock_dir=None):
+        """
+        initializes an ``IndexWarmer`` object
+
+        :param method: one of ``METHODS``
+        :param threads: number of files read at once
+        :param lock_dir: directory holding the per-index locks (``None`` for no locking)
+
+        :returns: an initialized ``IndexWarmer`` object
+        """
+        if method not in METHODS:
+            raise errors.InvalidOptionError(method,'method',METHODS)
+        self.method = method
+        self.threads = threads
+        self.lock_dir = lock_dir
+
+    def lock_path(self,prefix):
+        """
+        returns the lock file that serializes warming ``prefix`` on this node.
+        """
+        key = hashlib.sha1(os.path.abspath(prefix)).hexdigest()[:16]
+        return '%s/blacktie-warm-%s.lock' % (self.lock_dir.rstrip('/'),key)
+
+    def warm_index(self,prefix):
+        """
+        warms the bowtie2 index ``prefix``; returns what was done as a ``dict``.
+        """
+        paths = index_files(prefix)
+        lock = None
+        if self.lock_dir is not None:
+            lock = open(self.lock_path(prefix),'a')
+            fcntl.flock(lock,fcntl.LOCK_EX)
+        start = time.time()
+        try:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(max(1,min(self.threads,len(paths))))
+            try:
+                read = pool.map(_warm_task,[(p,self.method) for p in paths])
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            if lock is not None:
+                fcntl.flock(lock,fcntl.LOCK_UN)
+                lock.close()
+        return {'index':prefix,
+                'method':self.method,
+                'files':len(paths),
+                'bytes':sum([os.path.getsize(p) for p in paths]),
+                'bytes_read':sum(read),
+                'seconds':round(time.time() - start,2)}
+
+    def warm(self,prefixes):
+        """
+        warms each distinct index in ``prefixes`` in turn; returns the list of their results.
+        """
+        results = []
+        for prefix in prefixes:
+            if prefix in [r['index'] for r in results]:
+                continue
+            results.append(self.warm_index(prefix))
+        return results
+
+
+def warm_method(option):
+    """
+    returns the method named by ``run_options.warm_indexes`` (``True`` means 'read') or ``None`` if it is off.
+    """
+    if not option:
+        return None
+    if option is True:
+        return 'read'
+    if option not in METHODS:
+        raise errors.InvalidOptionError(option,'run_options.warm_indexes',[False,True] + METHODS)
+    return option
+
+def default_lock_dir():
+    """
+    returns the node-local directory ``blacktie-warm-index`` keeps its locks in.
+    """
+    return tempfile.gettempdir()
+
+def describe(result):
+    """
+    returns a one-line description of a ``warm_index`` result.
+    """
+    mb = result['bytes'] / float(1024 * 1024)
+    if result['method'] == 'read' or result['bytes_read']:
+        rate = ' (%.0f MB/s)' % (mb / max(result['seconds'],0.01))
+    else:
+        rate = ' (read-ahead requested)'
+    return '%s: %s files, %.1f MB in %.2fs%s' % (result['index'],result['files'],mb,result['seconds'],rate)
@@ -0,0 +1,123 @@
+#*****************************************************************************
+#  test_notify.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+test_notify.py
+####################
+Sends notifications through ``blacktie.utils.notify.Notifier`` to a local
+SMTP stand-in, including one that answers slowly: a burst of notifications
+must be queued (not dropped) and ``notify()`` must not wait for the server.
+Run with ``python -m unittest discover tests``.
+"""
+import os
+import sys
+import time
+import smtpd
+import asyncore
+import unittest
+import threading
+from StringIO import StringIO
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0,SRC_DIR)
+
+
+class StandInSMTPServer(smtpd.SMTPServer):
+    """
+    Keeps every message it receives, taking ``delay`` seconds to accept each one.
+    """
+    def __init__(self,delay=0):
+        smtpd.SMTPServer.__init__(self,('127.0.0.1',0),None)
+        self.delay = delay
+        self.received = []
+        self.port = self.socket.getsockname()[1]
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.05,count=1)
+
+    def process_message(self,peer,mailfrom,rcpttos,data):
+        time.sleep(self.delay)
+        self.received.append(data)
+
+    def subjects(self):
+        return [line[len('Subject: '):] for data in self.received for line in data.split('\n') if line.startswith('Subject: ')]
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        asyncore.close_all()
+
+
+class NotifierTests(unittest.TestCase):
+
+    def setUp(self):
+        self.stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.stderr
+
+    def notifier(self,server,**kw):
+        from blacktie.utils.notify import Notifier
+        server_info = {'host':'127.0.0.1','port':server.port,'starttls':False,'login':False,'timeout':10}
+        return Notifier('from@example.com','to@example.com','',server_info,**kw)
+
+    def test_each_notification_is_sent(self):
+        server = StandInSMTPServer()
+        try:
+            notifier = self.notifier(server)
+            for number in range(5):
+                notifier.notify('call %s done' % (number),'body %s' % (number))
+            notifier.close()
+        finally:
+            server.stop()
+        self.assertEqual(server.subjects(),['call %s done' % (n) for n in range(5)])
+
+    def test_stage_digest(self):
+        server = StandInSMTPServer()
+        try:
+            notifier = self.notifier(server,digest='stage')
+            for number in range(3):
+                notifier.notify('tophat call %s done' % (number),'body',stage='tophat')
+            notifier.end_stage('tophat')
+            notifier.close()
+        finally:
+            server.stop()
+        self.assertEqual(server.subjects(),['3 notifications for tophat'])
+
+    def test_slow_server_queues_a_burst(self):
+        from blacktie.utils.notify import MAX_BODY
+        server = StandInSMTPServer(delay=0.1)
+        try:
+            notifier = self.notifier(server)
+            start = time.time()
+            # each body is as large as a notification gets: far more than the pipe holds
+            for number in range(20):
+                notifier.notify('call %s done' % (number),'x' * MAX_BODY)
+            queued_in = time.time() - start
+            notifier.close()
+        finally:
+            server.stop()
+        self.assertTrue(queued_in < 1.0,'notify() waited %.1fs for the SMTP server' % (queued_in))
+        self.assertEqual(server.subjects(),['call %s done' % (n) for n in range(20)])
+        self.assertFalse('dropped' in sys.stderr.getvalue(),sys.stderr.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+#*****************************************************************************
+#  test_qsub.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+test_qsub.py
+####################
+Runs the cluster scripts of ``blacktie.utils.qsub`` against local stand-ins
+for ``sbatch``/``qsub``/``qstat``/``qdel`` that run each job at once and
+honour its dependencies: a failed job must end with a failed exit status
+so the jobs that depend on it never start.
+Run with ``python -m unittest discover tests``.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'src')
+if SRC_DIR not in sys.path:
+    sys.path.insert(0,SRC_DIR)
+
+try:
+    import mako
+except ImportError:
+    mako = None
+
+
+# a template shaped like examples/qsub.template: the program, then packing and clean-up
+TEMPLATE = """#!/bin/bash
+#$ -N ${job_name}
+#SBATCH --job-name=${job_name}
+
+${cmd_str}
+
+# pack up and clean up; these succeed whatever the program did
+true
+"""
+
+# runs the job at once unless a job it depends on did not exit 0 (like --kill-on-invalid-dep=yes)
+SBATCH = """#!/bin/bash
+STATE=%(state)s
+N=$(( $(cat $STATE/counter 2>/dev/null || echo 100) + 1 )); echo $N > $STATE/counter
+echo "$@" >> $STATE/submitted
+for arg in "$@"; do case "$arg" in --dependency=*) DEPS="${arg#--dependency=}";; esac; done
+for dep in $(echo "$DEPS" | tr ',:' '  '); do
+    case "$dep" in after*) continue;; esac
+    if [ "$(cat $STATE/$dep.status)" != 0 ]; then echo cancelled > $STATE/$N.status; echo "$N"; exit 0; fi
+done
+bash "${@: -1}" > $STATE/$N.out 2>&1; echo $? > $STATE/$N.status
+echo "$N"
+"""
+
+# runs the job at once unless it is held on a job that did not exit 0; jobs exiting 100 (error
+# state) and held jobs stay in the queue until qdel removes them
+QSUB = """#!/bin/bash
+STATE=%(state)s
+N=$(( $(cat $STATE/counter 2>/dev/null || echo 100) + 1 )); echo $N > $STATE/counter
+PREV=""; for arg in "$@"; do if [ "$PREV" = "-hold_jid" ]; then DEPS="$arg"; fi; PREV="$arg"; done
+for dep in $(echo "$DEPS" | tr ',' ' '); do
+    if [ "$(cat $STATE/$dep.status)" != 0 ]; then echo held > $STATE/$N.status; echo $N >> $STATE/queue; echo "$N"; exit 0; fi
+done
+bash "${@: -1}" > $STATE/$N.out 2>&1; STATUS=$?; echo $STATUS > $STATE/$N.status
+if [ $STATUS = 100 ]; then echo $N >> $STATE/queue; fi
+echo "$N"
+"""
+
+QSTAT = """#!/bin/bash
+echo "job-ID  prior   name"
+echo "------------------------"
+cat %(state)s/queue 2>/dev/null
+exit 0
+"""
+
+QDEL = """#!/bin/bash
+echo "$@" >> %(state)s/deleted
+grep -v "^$1$" %(state)s/queue > %(state)s/queue.new; mv %(state)s/queue.new %(state)s/queue
+"""
+
+
+class FakeCall(object):
+    """
+    Stands in for a ``BaseCall``: records what the executor reports about it.
+    """
+    def __init__(self,writer,prog_name,call_id,cmd_str,after=()):
+        self.writer = writer
+        self.prog_name = prog_name
+        self.call_id = call_id
+        self.cmd_str = cmd_str
+        self.after = list(after)
+        self.arg_list = []
+        self.out_dir = call_id
+        self.returncode = None
+        self.stderr_msg = ''
+        self.states = []
+
+    def build_qsub(self):
+        from blacktie.utils.misc import Bunch
+        self.writer.add(self.call_id,Bunch(job_name=self.call_id,cmd_str=self.cmd_str,out_dir=self.out_dir),
+                        stage=self.prog_name,after=self.after)
+
+    def update_metrics(self,state):
+        self.states.append(state)
+
+    def log_event(self,event_type,**kw):
+        pass
+
+    def log_start(self):
+        pass
+
+    def log_end(self):
+        pass
+
+    def notify_start_of_call(self):
+        pass
+
+    def notify_end_of_call(self):
+        pass
+
+
+@unittest.skipIf(mako is None,'Mako is not installed')
+class QsubScriptTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='blacktie-test-qsub.')
+        self.state = '%s/state' % (self.tmp_dir)
+        os.mkdir(self.state)
+        os.mkdir('%s/bin' % (self.tmp_dir))
+        self.template = '%s/qsub.template' % (self.tmp_dir)
+        open(self.template,'w').write(TEMPLATE)
+        for name,text in [('sbatch',SBATCH),('qsub',QSUB),('qstat',QSTAT),('qdel',QDEL)]:
+            self.write_program(name,text % {'state':self.state})
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull,'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmp_dir)
+
+    def write_program(self,name,text):
+        path = '%s/bin/%s' % (self.tmp_dir,name)
+        open(path,'w').write(text)
+        os.chmod(path,0755)
+        return path
+
+    def writer(self,scheduler,submit_command,status_dir=None):
+        from blacktie.utils.qsub import QsubScriptWriter
+        return QsubScriptWriter(self.template,'%s/qsub' % (self.tmp_dir),run_id='test',scheduler=scheduler,
+                                submit_command='%s/bin/%s' % (self.tmp_dir,submit_command),status_dir=status_dir)
+
+    def add_calls(self,writer):
+        """
+        adds two tophat calls (B fails) and a cufflinks call reading each of them.
+        """
+        for name,cmd in [('A','true'),('B','false')]:
+            writer.add('tophat_%s' % (name),{'job_name':'th_%s' % (name),'cmd_str':cmd},stage='tophat')
+        writer.end_stage('tophat')
+        for name in ['A','B']:
+            writer.add('cufflinks_%s' % (name),{'job_name':'cl_%s' % (name),'cmd_str':'true'},
+                       stage='cufflinks',after=['tophat_%s' % (name)])
+        writer.end_stage('cufflinks')
+        writer.close()
+
+    def job_status(self,job_id):
+        return open('%s/%s.status' % (self.state,job_id)).read().strip()
+
+    def test_script_ends_with_the_program_status(self):
+        status_dir = '%s/status' % (self.tmp_dir)
+        os.mkdir(status_dir)
+        for scheduler,failed_status in [('slurm',1),('sge',100)]:
+            writer = self.writer(scheduler,'sbatch',status_dir=status_dir)
+            for cmd,status in [('true',0),('false',failed_status)]:
+                call_id = '%s_%s' % (scheduler,cmd)
+                writer.add(call_id,{'job_name':call_id,'cmd_str':cmd})
+                writer.flush()
+                returncode = subprocess.call(['bash','%s/qsub/%s.qsub.sh' % (self.tmp_dir,call_id)])
+                self.assertEqual(returncode,status)
+                self.assertEqual(open('%s/%s.exit' % (status_dir,call_id)).read().strip(),'0' if cmd == 'true' else '1')
+
+    def test_submit_all_holds_back_jobs_of_a_failed_call(self):
+        writer = self.writer('slurm','sbatch')
+        self.add_calls(writer)
+        submit_all = '%s/qsub/submit_all.sh' % (self.tmp_dir)
+        output = subprocess.check_output([submit_all])
+        job_ids = dict([line.split() for line in output.strip().split('\n')])
+        self.assertEqual(sorted(job_ids.keys()),['cufflinks_A','cufflinks_B','tophat_A','tophat_B'])
+
+        submitted = open('%s/submitted' % (self.state)).read()
+        self.assertTrue('--dependency=afterok:%s --kill-on-invalid-dep=yes' % (job_ids['tophat_B']) in submitted)
+        self.assertEqual(self.job_status(job_ids['tophat_A']),'0')
+        self.assertEqual(self.job_status(job_ids['tophat_B']),'1')
+        self.assertEqual(self.job_status(job_ids['cufflinks_A']),'0')
+        self.assertEqual(self.job_status(job_ids['cufflinks_B']),'cancelled')
+
+    def test_submit_records_job_ids(self):
+        writer = self.writer('slurm','sbatch')
+        self.add_calls(writer)
+        jobs = writer.submit()
+        rows = [line.split('\t') for line in open('%s/qsub/jobs.tsv' % (self.tmp_dir)).read().strip().split('\n')]
+        self.assertEqual([r[1] for r in rows],['tophat_A','tophat_B','cufflinks_A','cufflinks_B'])
+        self.assertEqual([r[0] for r in rows],[job.job_id for job in jobs])
+        self.assertEqual(self.job_status(rows[3][0]),'cancelled')
+
+    def test_cluster_executor_cancels_calls_held_on_a_failed_call(self):
+        from blacktie.utils.executors import ClusterExecutor
+        writer = self.writer('sge','qsub',status_dir='%s/status' % (self.tmp_dir))
+        executor = ClusterExecutor(writer,'sge',poll_interval=0.01,
+                                   status_command='%s/bin/qstat' % (self.tmp_dir),cancel_command='%s/bin/qdel' % (self.tmp_dir))
+        calls = {}
+        for stage,names in [('tophat',[('A','true',[]),('B','false',[])]),
+                            ('cufflinks',[('A','true',['tophat_A']),('B','true',['tophat_B'])])]:
+            for name,cmd,after in names:
+                call = FakeCall(writer,stage,'%s_%s' % (stage,name),cmd,after)
+                calls[call.call_id] = call
+                executor.execute(call)
+            executor.end_stage(stage)
+        executor.close()
+
+        self.assertEqual(calls['tophat_A'].returncode,0)
+        self.assertEqual(calls['cufflinks_A'].returncode,0)
+        self.assertEqual(calls['tophat_B'].returncode,1)
+        self.assertEqual(calls['cufflinks_B'].returncode,None)
+        self.assertTrue('tophat_B, which it depends on, failed' in calls['cufflinks_B'].stderr_msg)
+        self.assertEqual(calls['cufflinks_B'].states[-1],'failed')
+        # the failed job (error state) and the job held on it are both gone from the queue
+        self.assertEqual(open('%s/queue' % (self.state)).read().strip(),'')
+
+    def test_flagged_library_gates_the_jobs_downstream(self):
+        from blacktie.utils.executors import ClusterExecutor
+        writer = self.writer('slurm','sbatch',status_dir='%s/status' % (self.tmp_dir))
+        executor = ClusterExecutor(writer,'slurm',poll_interval=0.01,
+                                   status_command='%s/bin/qstat' % (self.tmp_dir),cancel_command='%s/bin/qdel' % (self.tmp_dir))
+        calls = {}
+        # blacktie-bam-stats exits 1 for the flagged library B
+        for stage,names in [('tophat',[('A','true',[]),('B','true',[])]),
+                            ('blacktie-bam-stats',[('A','true',['tophat_A']),('B','exit 1',['tophat_B'])]),
+                            ('cufflinks',[('A','true',['tophat_A','blacktie-bam-stats_A']),
+                                          ('B','true',['tophat_B','blacktie-bam-stats_B'])]),
+                            ('cuffmerge',[('AB','true',['cufflinks_A','cufflinks_B'])])]:
+            for name,cmd,after in names:
+                call = FakeCall(writer,stage,'%s_%s' % (stage,name),cmd,after)
+                calls[call.call_id] = call
+                executor.execute(call)
+            executor.end_stage(stage)
+        executor.close()
+
+        self.assertEqual(calls['blacktie-bam-stats_B'].returncode,1)
+        self.assertEqual(calls['cufflinks_A'].returncode,0)
+        for call_id in ['cufflinks_B','cuffmerge_AB']:
+            self.assertEqual(calls[call_id].returncode,None)
+            self.assertEqual(calls[call_id].states[-1],'failed')
+        self.assertTrue('blacktie-bam-stats_B, which it depends on, failed' in calls['cufflinks_B'].stderr_msg)
+
+
+if __name__ == '__main__':
+    unittest.main()
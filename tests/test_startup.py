@@ -0,0 +1,74 @@
+#*****************************************************************************
+#  test_startup.py (part of the blacktie package)
+#
+#  (c) 2013 - Augustine Dunn
+#  James Laboratory
+#  Department of Biochemistry and Molecular Biology
+#  University of California Irvine
+#  wadunn83@gmail.com
+#
+#  Licensed under the GNU General Public License 3.0 license.
+#******************************************************************************
+
+"""
+####################
+test_startup.py
+####################
+Guards blacktie's start-up time: importing the package or the pipeline script
+must not load the heavy optional modules, which are imported where they are used.
+Run with ``python -m unittest discover tests``.
+"""
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),'src')
+
+HEAVY_MODULES = ['mako','rpy2','pprocess','numpy','yaml','smtplib','cProfile']
+
+# seconds; generous, so only a heavy import (rpy2/R, numpy, ...) creeping back trips it
+IMPORT_TIME_LIMIT = 1.0
+
+CHECK = """
+import sys, time, json
+start = time.time()
+import %s
+elapsed = time.time() - start
+json.dump({'elapsed':elapsed,'loaded':sorted([m for m in %r if m in sys.modules])},sys.stdout)
+"""
+
+
+def import_in_subprocess(module):
+    """
+    imports ``module`` in a fresh interpreter; returns its import time and which of ``HEAVY_MODULES`` it loaded.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([SRC_DIR] + [p for p in [env.get('PYTHONPATH')] if p])
+    process = subprocess.Popen([sys.executable,'-c',CHECK % (module,HEAVY_MODULES)],
+                               stdout=subprocess.PIPE,stderr=subprocess.PIPE,env=env)
+    stdout,stderr = process.communicate()
+    if process.returncode != 0:
+        raise AssertionError('importing %s failed:\n%s' % (module,stderr))
+    return json.loads(stdout)
+
+
+class StartupTests(unittest.TestCase):
+
+    def check_module(self,module):
+        result = import_in_subprocess(module)
+        self.assertEqual(result['loaded'],[],'importing %s loaded %s' % (module,', '.join(result['loaded'])))
+        self.assertTrue(result['elapsed'] < IMPORT_TIME_LIMIT,
+                        'importing %s took %.2fs (limit %.2fs)' % (module,result['elapsed'],IMPORT_TIME_LIMIT))
+
+    def test_import_package(self):
+        self.check_module('blacktie')
+
+    def test_import_pipeline(self):
+        self.check_module('blacktie.scripts.blacktie_pipeline')
+
+
+if __name__ == '__main__':
+    unittest.main()